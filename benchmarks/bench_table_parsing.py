@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of the console table parsing on a 5,000 line bundle:list output
+
+Compares the parser working on the raw bytes of the client output with the
+former one, which decoded the whole output and split every line into
+stripped columns, after checking that both return the same bundles. Run
+from the root of the repository, with Python 2.7 and 3.x:
+
+    python benchmarks/bench_table_parsing.py
+
+The peak memory is only measured where tracemalloc exists, Python 3.4+.
+"""
+
+import os
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'module_utils'))
+
+import karaf
+
+LINES = 5000
+REPEAT = 20
+
+SEPARATOR = u'│'
+
+
+def listing(lines=LINES):
+    """Output of BUNDLE_LIST_COMMAND, as the client writes it"""
+    count = lines // 2 - 2
+    rows = []
+    for columns in ((u'ID', u'State', u'Lvl', u'Version', u'Location'),
+                    (u'ID', u'State', u'Lvl', u'Version', u'Symbolic name')):
+        rows.append(u' │ '.join(columns))
+        rows.append(u'─' * 120)
+        for i in range(count):
+            last = u'mvn:com.example.group%d/artifact-%d/1.0.%d' % (i % 50, i, i) if columns[4] == u'Location' \
+                else u'com.example.group%d.artifact-%d' % (i % 50, i)
+            rows.append(u'%4d │ %-8s │ %3d │ 1.0.%-6d │ %-60s' % (i, u'Active', 80, i, last))
+    return (u'\n'.join(rows) + u'\n').encode('utf-8')
+
+
+def legacy_parse_bundle_list(raw):
+    """Former parser: decode everything, split and strip every column"""
+    out = raw.decode('utf-8')
+    tables = []
+    current = None
+
+    for line in out.split(u'\n'):
+        columns = [e.strip() for e in line.split(SEPARATOR)]
+        if len(columns) < 5:
+            continue
+
+        if columns[0] == u'ID':
+            current = {}
+            tables.append(current)
+            continue
+
+        try:
+            bundle_id = int(columns[0])
+        except ValueError:
+            continue
+
+        if current is None or bundle_id in current:
+            current = {}
+            tables.append(current)
+        current[bundle_id] = columns
+
+    names = tables[1] if len(tables) > 1 else {}
+    return [{
+        'id':               bundle_id,
+        'state':            columns[1],
+        'start_level':      int(columns[2]),
+        'version':          columns[3],
+        'url':              columns[4],
+        'symbolic_name':    names[bundle_id][4] if bundle_id in names else None,
+    } for bundle_id, columns in tables[0].items()]
+
+
+def by_id(bundles):
+    return sorted(bundles, key=lambda b: b['id'])
+
+
+def peak_memory(parse, raw):
+    tracemalloc.start()
+    try:
+        parse(raw)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    raw = listing()
+    print('%d lines, %d bytes, python %s' % (raw.count(b'\n'), len(raw), sys.version.split()[0]))
+
+    parsers = [('split and strip', legacy_parse_bundle_list), ('bytes and memoryview', karaf.parse_bundle_list)]
+
+    # Both parsers must return the same bundles, field by field
+    expected = by_id(legacy_parse_bundle_list(raw))
+    for name, parse in parsers:
+        assert by_id(parse(raw)) == expected, name
+
+    for name, parse in parsers:
+        seconds = min(timeit.repeat(lambda: parse(raw), number=1, repeat=REPEAT))
+        line = '%-22s %8.2f ms' % (name, seconds * 1000)
+        if tracemalloc is not None:
+            line += '  peak %8.1f KiB' % (peak_memory(parse, raw) / 1024.0)
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
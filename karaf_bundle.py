@@ -2,7 +2,9 @@
 # -*- coding: utf-8 -*-
 
 from ansible.module_utils.basic import *
-import os.path
+from ansible.module_utils.karaf import karaf_argument_spec, karaf_client, list_bundles, start_bundles
+from ansible.module_utils.karaf import start_job, resume_job, karaf_home_path, offline_bundle
+import time
 
 """
 Ansible module to manage karaf bundles
@@ -27,11 +29,124 @@ options:
         required: false
         default: present
         choices: [ "present", "absent", "start", "stop", "restart", "refresh", "update" ]
+    symbolic_name:
+        description:
+            - symbolic name of the bundle. Used to find the bundle when it was installed from an equivalent url,
+              e.g. a 'file:' url instead of a 'mvn:' url
+        required: false
+        default: null
+    upgrade:
+        description:
+            - when the bundle is not installed but another version of it is (same symbolic name, or same maven
+              group and artifact), update that bundle in place from url instead of installing a new one
+        required: false
+        default: false
+    wait:
+        description:
+            - wait for the bundle action to finish. When false, the console command is started in the background
+              and the module returns right away with status "pending". Running the module again reports the
+              progress, and fails if the background command failed.
+        required: false
+        default: true
+    wait_timeout:
+        description:
+            - how long to wait, in seconds, for a background command started by a previous run to finish
+        required: false
+        default: 600
+    offline:
+        description:
+            - edit etc/startup.properties instead of talking to a running container, so that the bundle is
+              started when karaf first boots. Only for state present and absent. The bundle must be available in
+              the system/ repository of the installation. The karaf installation is found from client_bin
+        required: false
+        default: false
+    start_level:
+        description:
+            - start level of the bundle in etc/startup.properties, when offline
+        required: false
+        default: 80
     client_bin:
         description:
             - path to the 'client' program in karaf, can also point to the root of the karaf installation '/opt/karaf'
         required: false
         default: /opt/karaf/bin/client
+    retries:
+        description:
+            - number of times a transient failure (container restarting, timeout, lock contention) is retried
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - initial delay in seconds between two retries, doubled on every attempt
+        required: false
+        default: 2
+    transport:
+        description:
+            - how to reach the karaf console. 'client' runs the karaf client program on the managed host,
+              'ssh' connects to the karaf ssh console directly and needs no JVM, only the paramiko python library
+            - 'jolokia' reads bundles, features, repositories and configurations, and starts or stops bundles,
+              through a Jolokia agent. Other commands, configuration changes included, go through the client
+              program if it is installed, over ssh otherwise
+        required: false
+        default: client
+        choices: [ "client", "ssh", "jolokia" ]
+    jolokia_url:
+        description:
+            - url of the Jolokia agent, when transport is 'jolokia'. user and password are used to authenticate
+        required: false
+        default: http://localhost:8181/jolokia
+    validate_certs:
+        description:
+            - validate the certificate of an https jolokia_url
+        required: false
+        default: true
+    host:
+        description:
+            - host of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: localhost
+    port:
+        description:
+            - port of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: 8101
+    user:
+        description:
+            - user of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: karaf
+    password:
+        description:
+            - password of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    private_key:
+        description:
+            - private key file of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    connect_timeout:
+        description:
+            - ssh connection timeout in seconds, when transport is 'ssh'
+        required: false
+        default: 10
+    host_key_checking:
+        description:
+            - check the host key of the karaf ssh console against the system known_hosts and known_hosts, when
+              transport is 'ssh'. When false, an unknown host key is accepted, and saved to known_hosts if set
+        required: false
+        default: true
+    known_hosts:
+        description:
+            - known_hosts file checked on top of the system one, when transport is 'ssh'
+        required: false
+        default: null
+    lock_timeout:
+        description:
+            - how long to wait, in seconds, for another module run changing the same karaf installation. Changes
+              take a host local lock under the karaf data directory, listings do not
+        required: false
+        default: 600
 '''
 
 EXAMPLES = '''
@@ -44,6 +159,20 @@ EXAMPLES = '''
 # Refresh karaf bundle
 - karaf_bundle: state="refresh" url="mvn:org.apache.camel/camel-example-osgi/2.15.2"
 
+# Start a bundle at first boot, before karaf is started
+- karaf_bundle: state="present" url="mvn:com.google.code.gson/gson/2.8.5" offline=true start_level=30
+
+# Upgrade the installed camel-example-osgi bundle to 2.16.0 in place
+- karaf_bundle: state="present" url="mvn:org.apache.camel/camel-example-osgi/2.16.0" upgrade=true
+
+# Refresh karaf bundle in the background, then poll until it is done
+- karaf_bundle: state="refresh" url="mvn:org.apache.camel/camel-example-osgi/2.15.2" wait=false
+- karaf_bundle: state="refresh" url="mvn:org.apache.camel/camel-example-osgi/2.15.2" wait=false
+  register: refresh
+  until: refresh.status != "pending"
+  retries: 30
+  delay: 10
+
 '''
 
 PACKAGE_STATE_MAP = dict(
@@ -56,32 +185,21 @@ PACKAGE_STATE_MAP = dict(
     update="update"
 )
 
-CLIENT_KARAF_COMMAND = "{0} 'bundle:{1}'"
-CLIENT_KARAF_COMMAND_WITH_ARGS = "{0} 'bundle:{1} {2}'"
-
-_KARAF_COLUMN_SEPARATOR = '\xe2\x94\x82'
-
-def run_with_check(module, cmd):
-    rc, out, err = module.run_command(cmd)
-    
-    bundle_id = None
-    if  rc != 0 or \
-        'Error executing command' in out or \
-        'Command not found' in out:
-        reason = parse_error(out)
-        module.fail_json(msg=reason)
-        raise Exception(out)
+CLIENT_KARAF_COMMAND = "bundle:{0}"
+CLIENT_KARAF_COMMAND_WITH_ARGS = "bundle:{0} {1}"
 
-    return out
+def bundle_job_key(url, action):
+    return CLIENT_KARAF_COMMAND_WITH_ARGS.format(action, url)
 
-def launch_bundle_action(client_bin, module, url, bundle_id, action):
+def launch_bundle_action(client, module, url, bundle_id, action, wait=True):
     """Call karaf client command to execute a bundle action on a bundle id
 
-    :param client_bin: karaf client command bin
+    :param client: karaf client
     :param module: ansible module
     :param url: url of bundle to install
     :param bundle_id: id of bundle to execute action
     :param action: bundle action to perform
+    :param wait: wait for the command to finish, otherwise run it in the background
     :return: command, ouput command message, error command message
     """
     result = dict(
@@ -89,97 +207,137 @@ def launch_bundle_action(client_bin, module, url, bundle_id, action):
         original_message='',
         name = bundle_id,
         message='',
+        status='done',
     )
     
     if module.check_mode:
         return result
     
+    if client.jolokia is not None and action in ('start', 'stop'):
+        start_bundles(client, [bundle_id], action)
+        return result
+
     bnd_ref = url if action == 'install' else bundle_id
 
-    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format(client_bin, action, bnd_ref)
-    out = run_with_check(module, cmd)
+    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format(action, bnd_ref)
+    if not wait:
+        job = start_job(client, bundle_job_key(url, action), cmd)
+        result['status'] = 'pending'
+        result['job'] = dict(pid=job['pid'], log=job['log'], elapsed=0)
+        return result
+
+    out = client.run_with_check(cmd)
     
     return result
 
-def is_bundles_installed(client_bin, module, bundle_url):
-    karaf_cmd = '%s "bundle:list -t 0 -u"' % (client_bin)
-    out = run_with_check(module, karaf_cmd)
-    
-    existing_bundle = None
-    
-    for line in out.split('\n'):
-        if line[-len(bundle_url):] != bundle_url:
-            continue
-        
-        columns = [e.strip() for e in line.split(_KARAF_COLUMN_SEPARATOR)]
-
-        existing_bundle = {
-            'id':           int(columns[0]),
-            'state':        columns[1],
-            'start_level':  int(columns[2]),
-            'version':      columns[3],
-            'url':          columns[4]
-            }
-    
-    return existing_bundle
+def upgrade_bundle(client, module, url, bundle):
+    """Call karaf client command to update an installed bundle from a new url
 
-def parse_error(string):
-    return string
+    :param client: karaf client
+    :param module: ansible module
+    :param url: url of the new version of the bundle
+    :param bundle: installed bundle
+    :return: command, ouput command message, error command message
+    """
+    result = dict(
+        changed=True,
+        original_message='',
+        name = bundle['id'],
+        message='',
+        status='done',
+        previous_version=bundle['version'],
+    )
 
-def check_client_bin_path(client_bin):
-    if os.path.isfile(client_bin):
-        return client_bin
-    
-    if os.path.isdir(client_bin):
-        test = os.path.join(client_bin, 'bin/client')
-        if os.path.isfile(test):
-            return test
-    else:
-        raise Exception('client_bin parameter not supported: %s' % client_bin)
+    if module.check_mode:
+        return result
+
+    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format('update', '%s %s' % (bundle['id'], url))
+    out = client.run_with_check(cmd)
+
+    return result
 
 def main():
+    argument_spec = karaf_argument_spec()
+    argument_spec.update(
+        url=dict(required=True),
+        state=dict(default="present", choices=PACKAGE_STATE_MAP.keys()),
+        symbolic_name=dict(default=None),
+        upgrade=dict(default=False, type="bool"),
+        wait=dict(default=True, type="bool"),
+        wait_timeout=dict(default=600, type="int"),
+        offline=dict(default=False, type="bool"),
+        start_level=dict(default=80, type="int")
+    )
     module = AnsibleModule(
-        argument_spec=dict(
-            url=dict(required=True),
-            state=dict(default="present", choices=PACKAGE_STATE_MAP.keys()),
-            client_bin=dict(default="/opt/karaf/bin/client", type="path")
-        ),
+        argument_spec=argument_spec,
         supports_check_mode=True
     )
 
     url = module.params["url"]
     state = module.params["state"]
-    client_bin = module.params["client_bin"]
-    
-    client_bin = check_client_bin_path(client_bin)
+    symbolic_name = module.params["symbolic_name"]
+    upgrade = module.params["upgrade"]
+    wait = module.params["wait"]
+    wait_timeout = module.params["wait_timeout"]
+
+    if module.params["offline"]:
+        if state not in ('present', 'absent'):
+            module.fail_json(msg='Only state present and absent are supported offline')
+        changed = offline_bundle(module, karaf_home_path(module.params["client_bin"]), url,
+                                 module.params["start_level"], state)
+        return module.exit_json(changed=changed, url=url, state=state, offline=True)
 
-    existing_bundle = is_bundles_installed(client_bin, module, url)
+    client = karaf_client(module)
+
+    # A previous run may have left the same action running in the background
+    job = resume_job(client, bundle_job_key(url, PACKAGE_STATE_MAP[state]), wait, wait_timeout)
+    if job is not None:
+        if job['running']:
+            return module.exit_json(changed=False, status='pending', msg='Bundle action still running',
+                                    job=dict(pid=job['pid'], log=job['log'], elapsed=time.time() - job['started']),
+                                    retries=client.retry_count)
+
+        # Actions without a target state (restart, refresh, update) must not be
+        # started again by the run that polls for their completion
+        if state not in ('present', 'absent', 'start', 'stop'):
+            return module.exit_json(changed=False, status='done', msg='Bundle action finished',
+                                    retries=client.retry_count)
+
+    bundles = list_bundles(client)
+    existing_bundle = bundles.find(url, symbolic_name)
     
     # Bundle is installed
     if existing_bundle is not None:
-        if  state == 'present' and \
-            existing_bundle['url'] == url:
-            return module.exit_json(changed=False, name=existing_bundle['id'], msg = 'Bundle already installed')
+        if state == 'present':
+            return module.exit_json(changed=False, name=existing_bundle['id'], msg = 'Bundle already installed', retries=client.retry_count)
 
         if state == 'start' and existing_bundle['state'] == 'Active':
-            return module.exit_json(changed = False, name=existing_bundle['id'], msg = 'Bundle already started')
+            return module.exit_json(changed = False, name=existing_bundle['id'], msg = 'Bundle already started', retries=client.retry_count)
 
         if state == 'stop' and existing_bundle['state'] != 'Active':
-            return module.exit_json(changed = False, name=existing_bundle['id'], msg = 'Bundle already stopped')
+            return module.exit_json(changed = False, name=existing_bundle['id'], msg = 'Bundle already stopped', retries=client.retry_count)
     
     # if no bundle installed with given URL
     else:
         if state != 'present':
             return module.fail_json(msg = "Can not execute action on a non-existing bundle, Could not find a bundle installed with URL: %s" % (url,))
 
+        other_version = bundles.find_other_version(url, symbolic_name) if upgrade else None
+        if other_version is not None:
+            result = upgrade_bundle(client, module, url, other_version)
+            result['retries'] = client.retry_count
+            return module.exit_json(**result)
+
     result = launch_bundle_action(
-            client_bin,
+            client,
             module, 
             url, 
             existing_bundle['id'] if existing_bundle is not None else None, 
-            PACKAGE_STATE_MAP[state]
+            PACKAGE_STATE_MAP[state],
+            wait
             )
 
+    result['retries'] = client.retry_count
     module.exit_json(**result)
 
 if __name__ == '__main__':
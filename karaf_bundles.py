@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 from ansible.module_utils.basic import *
-import os.path
+from ansible.module_utils.karaf import karaf_argument_spec, batch_argument_spec, karaf_client
+from ansible.module_utils.karaf import list_bundles, start_bundles, run_batch
 
 DOCUMENTATION = '''
 ---
@@ -13,7 +14,8 @@ description:
 options:
     urls:
         description:
-            - Urls of the bundles to install or uninstall
+            - Urls of the bundles to install or uninstall. An entry can also be a dict with the url and the
+              start_level of the bundle, e.g. '{url: "mvn:com.google.code.gson/gson/2.8.5", start_level: 60}'
         required: true
         type: list
     state:
@@ -22,11 +24,118 @@ options:
         required: false
         default: present
         choices: [ "present", "absent", "start", "stop", "restart", "refresh", "update" ]
+    start_level:
+        description:
+            - start level of the bundles that do not give their own. Installed bundles are moved to it with
+              bundle:start-level
+        required: false
+        default: null
+    start:
+        description:
+            - with state present, start the bundles once they are all installed. The bundles are installed without
+              being started, resolved together with a single bundle:resolve, then started with a single bundle:start,
+              in start level order
+        required: false
+        default: false
+    upgrade:
+        description:
+            - when a bundle is not installed but another version of the same maven group and artifact is,
+              update that bundle in place from the new url instead of installing a new one
+        required: false
+        default: false
+    batch_size:
+        description:
+            - maximum number of console commands sent in one call. Bigger sets are split in chunks, run one after
+              the other. When a chunk fails, the module reports the completed and remaining items
+        required: false
+        default: 100
+    batch_bytes:
+        description:
+            - maximum size in bytes of the console commands sent in one call
+        required: false
+        default: 65536
     client_bin:
         description:
             - path to the 'client' program in karaf, can also point to the root of the karaf installation '/opt/karaf'
         required: false
         default: /opt/karaf/bin/client
+    retries:
+        description:
+            - number of times a transient failure (container restarting, timeout, lock contention) is retried
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - initial delay in seconds between two retries, doubled on every attempt
+        required: false
+        default: 2
+    transport:
+        description:
+            - how to reach the karaf console. 'client' runs the karaf client program on the managed host,
+              'ssh' connects to the karaf ssh console directly and needs no JVM, only the paramiko python library
+            - 'jolokia' reads bundles, features, repositories and configurations, and starts or stops bundles,
+              through a Jolokia agent. Other commands, configuration changes included, go through the client
+              program if it is installed, over ssh otherwise
+        required: false
+        default: client
+        choices: [ "client", "ssh", "jolokia" ]
+    jolokia_url:
+        description:
+            - url of the Jolokia agent, when transport is 'jolokia'. user and password are used to authenticate
+        required: false
+        default: http://localhost:8181/jolokia
+    validate_certs:
+        description:
+            - validate the certificate of an https jolokia_url
+        required: false
+        default: true
+    host:
+        description:
+            - host of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: localhost
+    port:
+        description:
+            - port of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: 8101
+    user:
+        description:
+            - user of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: karaf
+    password:
+        description:
+            - password of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    private_key:
+        description:
+            - private key file of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    connect_timeout:
+        description:
+            - ssh connection timeout in seconds, when transport is 'ssh'
+        required: false
+        default: 10
+    host_key_checking:
+        description:
+            - check the host key of the karaf ssh console against the system known_hosts and known_hosts, when
+              transport is 'ssh'. When false, an unknown host key is accepted, and saved to known_hosts if set
+        required: false
+        default: true
+    known_hosts:
+        description:
+            - known_hosts file checked on top of the system one, when transport is 'ssh'
+        required: false
+        default: null
+    lock_timeout:
+        description:
+            - how long to wait, in seconds, for another module run changing the same karaf installation. Changes
+              take a host local lock under the karaf data directory, listings do not
+        required: false
+        default: 600
 '''
 
 EXAMPLES = '''
@@ -37,6 +146,24 @@ EXAMPLES = '''
       - mvn:com.google.code.gson/gson/2.8.5
       - mvn:com.google.code.gson/gson/2.8.4
       - mvn:com.google.code.gson/gson/2.8.3
+
+# Install bundles with their start level, then start them all at once
+- karaf_bundles:
+    state: present
+    start: true
+    start_level: 80
+    urls:
+      - url: mvn:org.apache.commons/commons-lang3/3.9
+        start_level: 60
+      - mvn:com.google.code.gson/gson/2.8.5
+
+# Upgrade installed bundles in place
+- karaf_bundles:
+    state: present
+    upgrade: true
+    urls:
+      - mvn:com.google.code.gson/gson/2.8.6
+      - mvn:org.apache.commons/commons-lang3/3.9
 '''
 
 
@@ -50,25 +177,72 @@ PACKAGE_STATE_MAP = dict(
     update="update"
 )
 
-_KARAF_COLUMN_SEPARATOR = '\xe2\x94\x82'
+def bundle_specs(module, urls, start_level):
+    """Normalize the urls option
 
-def run_with_check(module, cmd):
-    rc, out, err = module.run_command(cmd)
-    
-    bundle_id = None
-    if  rc != 0 or \
-        'Error executing command' in out or \
-        'Command not found' in out:
-        reason = out
-        module.fail_json(msg=reason)
-        raise Exception(out)
+    :param module: ansible module
+    :param urls: bundle urls, or dicts with the url and start_level of a bundle
+    :param start_level: start level of the bundles that do not give their own
+    :return: list of dicts with url and start_level
+    """
+    specs = []
+    for entry in urls:
+        if isinstance(entry, dict):
+            if not entry.get('url'):
+                module.fail_json(msg='Bundle entry without url: %s' % entry)
+            level = entry.get('start_level', start_level)
+            specs.append({'url': entry['url'], 'start_level': int(level) if level is not None else None})
+        else:
+            specs.append({'url': entry, 'start_level': start_level})
+    return specs
+
+def bundle_command(action, bundle):
+    if action == 'install':
+        if bundle.get('start_level') is not None:
+            return 'bundle:install -l %d %s' % (bundle['start_level'], bundle['url'])
+        return 'bundle:install %s' % bundle['url']
+    return 'bundle:%s %s' % (action, bundle['id'])
+
+def start_bundle_set(client, bundles, action):
+    """Call karaf client command to start or stop a set of bundles in a single command
 
-    return out
+    :param client: karaf client
+    :param bundles: installed bundles
+    :param action: 'start' or 'stop'
+    :return: command
+    """
+    # Lower start levels first, like the framework does when it starts
+    ordered = sorted(bundles, key=lambda b: (b['start_level'], int(b['id'])), reverse=(action == 'stop'))
+    ids = [str(b['id']) for b in ordered]
+
+    if client.jolokia is not None:
+        start_bundles(client, ids, action)
+        return None
+
+    cmd = 'bundle:%s %s' % (action, ' '.join(ids))
+    if action == 'start':
+        # bundle:start starts the bundles one by one, each resolved on its
+        # own. The set is resolved first, in one pass, in the same console call.
+        cmd = 'bundle:resolve %s && %s' % (' '.join(ids), cmd)
+    client.run_with_check(cmd)
+    return cmd
+
+def set_start_levels(client, module, changes):
+    """Call karaf client command to move installed bundles to another start level
+
+    :param client: karaf client
+    :param module: ansible module
+    :param changes: list of (installed bundle, start level)
+    :return: results of the chunks
+    """
+    cmds = ['bundle:start-level %s %d' % (b['id'], level) for b, level in changes]
+    return run_batch(client, [b['url'] for b, level in changes], cmds,
+                     module.params['batch_size'], module.params['batch_bytes'])
 
-def launch_bundles_action(client_bin, module, bundles, state):
+def launch_bundles_action(client, module, bundles, state):
     """Call karaf client command to execute a bundle action on a bundle id
 
-    :param client_bin: karaf client command bin
+    :param client: karaf client
     :param module: ansible module
     :param bundles: list of bundle to execute action on 
     :param action: bundle action to perform
@@ -106,61 +280,71 @@ def launch_bundles_action(client_bin, module, bundles, state):
     result['changed'] = True
     if module.check_mode:
         return result
+
+    if karaf_action in ('start', 'stop'):
+        result['meta']['cmd'] = start_bundle_set(client, affected_bundles, karaf_action)
+        return result
     
-    karaf_cmd_base = 'bundle:%s %s'
-    bundles_dict_key= 'url' if karaf_action == 'install' else 'id'
-    
-    cmds = [karaf_cmd_base % (karaf_action, b[bundles_dict_key]) for b in affected_bundles]
+    cmds = [bundle_command(karaf_action, b) for b in affected_bundles]
+    items = [b.get('url', b.get('id')) for b in affected_bundles]
     
-    out = run_with_check(module, '%s "%s"' % (client_bin, ' && '.join(cmds)))
+    result['meta']['chunks'] = run_batch(client, items, cmds,
+                                         module.params['batch_size'], module.params['batch_bytes'])
     
     return result
 
-def is_bundles_installed(client_bin, module, urls):
-    tmp = frozenset(urls)
-    
-    karaf_cmd = '%s "bundle:list -t 0 -u"' % (client_bin)
-    out = run_with_check(module, karaf_cmd)
-    
+def upgrade_bundles(client, module, upgrades):
+    """Call karaf client command to update installed bundles from new urls
+
+    :param client: karaf client
+    :param module: ansible module
+    :param upgrades: list of (installed bundle, new url)
+    :return: command, ouput command message, error command message
+    """
+    result = dict(
+        changed=True,
+        original_message='',
+        message='',
+        meta = {'upgraded': [url for b, url in upgrades]}
+    )
+
+    if module.check_mode:
+        return result
+
+    cmds = ['bundle:update %s %s' % (b['id'], url) for b, url in upgrades]
+    result['meta']['upgrade_chunks'] = run_batch(client, [url for b, url in upgrades], cmds,
+                                         module.params['batch_size'], module.params['batch_bytes'])
+
+    return result
+
+def is_bundles_installed(bundles, urls):
+    """Find the installed bundles among urls
+
+    :param bundles: index of the installed bundles
+    :param urls: bundle urls
+    :return: dict of url to installed bundle
+    """
     existing_bundles = {}
-    
-    for line in out.split('\n'):
-        columns = [e.strip() for e in line.split(_KARAF_COLUMN_SEPARATOR)]
-        
-        if len(columns) < 3:
-            continue
 
-        if columns[4] not in tmp:
-            continue
-        
-        existing_bundles[columns[4]] = {
-            'id':           int(columns[0]),
-            'state':        columns[1],
-            'start_level':  int(columns[2]),
-            'version':      columns[3],
-            'url':          columns[4]
-            }
+    for url in urls:
+        bundle = bundles.find(url)
+        if bundle is not None:
+            existing_bundles[url] = bundle
 
     return existing_bundles
 
-def check_client_bin_path(client_bin):
-    if os.path.isfile(client_bin):
-        return client_bin
-    
-    if os.path.isdir(client_bin):
-        test = os.path.join(client_bin, 'bin/client')
-        if os.path.isfile(test):
-            return test
-    else:
-        raise Exception('client_bin parameter not supported: %s' % client_bin)
-
 def main():
+    argument_spec = karaf_argument_spec()
+    argument_spec.update(batch_argument_spec())
+    argument_spec.update(
+        urls=dict(required=True, type='list'),
+        state=dict(default="present", choices=PACKAGE_STATE_MAP.keys()),
+        start_level=dict(default=None, type="int"),
+        start=dict(default=False, type="bool"),
+        upgrade=dict(default=False, type="bool")
+    )
     module = AnsibleModule(
-        argument_spec=dict(
-            urls=dict(required=True, type='list'),
-            state=dict(default="present", choices=PACKAGE_STATE_MAP.keys()),
-            client_bin=dict(default="/opt/karaf/bin/client", type="path")
-        ),
+        argument_spec=argument_spec,
         supports_check_mode=True
     )
     
@@ -168,23 +352,77 @@ def main():
         changed=False,
         original_message='',
         message='',
+        meta={}
     )
 
-    urls = module.params["urls"]
+    specs = bundle_specs(module, module.params["urls"], module.params["start_level"])
+    urls = [spec['url'] for spec in specs]
     state = module.params["state"]
-    client_bin = module.params["client_bin"]
+    start = module.params["start"]
+    upgrade = module.params["upgrade"]
 
-    client_bin = check_client_bin_path(client_bin)
+    client = karaf_client(module)
+
+    bundles = list_bundles(client)
+    existing = is_bundles_installed(bundles, urls)
+
+    # Installed bundles that are not at their desired start level
+    level_changes = []
+    if state in ('present', 'start'):
+        moved_ids = set()
+        for spec in specs:
+            bundle = existing.get(spec['url'])
+            if bundle is None or spec['start_level'] is None or bundle['id'] in moved_ids:
+                continue
+            if bundle['start_level'] != spec['start_level']:
+                moved_ids.add(bundle['id'])
+                level_changes.append((bundle, spec['start_level']))
+
+    if level_changes:
+        result['changed'] = True
+        result['meta']['start_levels'] = dict((b['url'], level) for b, level in level_changes)
+        if not module.check_mode:
+            result['meta']['start_level_chunks'] = set_start_levels(client, module, level_changes)
 
-    existing = is_bundles_installed(client_bin, module, urls)
-    
     if state == 'present':
-        needs_install = [{'url': bnd_url} for bnd_url in urls if bnd_url not in existing]
-        if not needs_install:
-            module.exit_json(**result)
-            return
-        
-        result = launch_bundles_action(client_bin, module, needs_install, state)
+        needs_install = [spec for spec in specs if spec['url'] not in existing]
+
+        needs_upgrade = []
+        if upgrade:
+            # A bundle that is requested as-is, or already upgraded, can not be upgraded again
+            used_ids = set(b['id'] for b in existing.values())
+            for bnd in list(needs_install):
+                other_version = bundles.find_other_version(bnd['url'])
+                if other_version is not None and other_version['id'] not in used_ids:
+                    used_ids.add(other_version['id'])
+                    needs_upgrade.append((other_version, bnd['url']))
+                    needs_install.remove(bnd)
+
+        if needs_upgrade:
+            meta = result['meta']
+            result = upgrade_bundles(client, module, needs_upgrade)
+            result['meta'].update(meta)
+
+        if needs_install:
+            meta = result['meta']
+            result = launch_bundles_action(client, module, needs_install, state)
+            result['meta'].update(meta)
+
+        if start:
+            if needs_install or needs_upgrade:
+                if module.check_mode:
+                    result['changed'] = True
+                    result['retries'] = client.retry_count
+                    module.exit_json(**result)
+                    return
+                existing = is_bundles_installed(list_bundles(client), urls)
+
+            meta = result['meta']
+            changed = result['changed']
+            unique = dict((b['id'], b) for b in existing.values())
+            result = launch_bundles_action(client, module, list(unique.values()), 'start')
+            result['meta'].update(meta)
+            result['changed'] = result['changed'] or changed
         
     else:
         not_installed = [bnd_url for bnd_url in urls if bnd_url not in existing]
@@ -192,10 +430,15 @@ def main():
             module.fail_json(msg="The following bundles are not installed: %s"  % (', '.join(not_installed)))
             return
 
-        result = launch_bundles_action(client_bin, module, existing.values(), state)
+        # Equivalent urls may point to the same bundle
+        unique = dict((b['id'], b) for b in existing.values())
+        meta = result['meta']
+        changed = result['changed']
+        result = launch_bundles_action(client, module, list(unique.values()), state)
+        result['meta'].update(meta)
+        result['changed'] = result['changed'] or changed
 
-    
-#     module.fail_json(msg=str(existing))
+    result['retries'] = client.retry_count
     module.exit_json(**result)
 
 
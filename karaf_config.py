@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 
 from ansible.module_utils.basic import *
-import os.path
+from ansible.module_utils.karaf import karaf_argument_spec, karaf_client, run_batch
+from ansible.module_utils.karaf import list_config_properties, property_equals, encode_property, quote_console_arg
 
 DOCUMENTATION = '''
 ---
@@ -23,6 +24,9 @@ options:
     properties:
         description:
             - a dictionary with property name (key) and its value
+            - values are compared with the current ones by type, so that 1 and "1.0", or true and "true", are equal.
+              Lists are set as comma separated strings, and values may use the typed .config syntax,
+              e.g. 'I"8080"' or '[ "a", "b" ]'
         required: true
         type: dict
     state:
@@ -36,6 +40,83 @@ options:
             - path to the 'client' program in karaf, can also point to the root of the karaf installation '/opt/karaf'
         required: false
         default: /opt/karaf/bin/client
+    retries:
+        description:
+            - number of times a transient failure (container restarting, timeout, lock contention) is retried
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - initial delay in seconds between two retries, doubled on every attempt
+        required: false
+        default: 2
+    transport:
+        description:
+            - how to reach the karaf console. 'client' runs the karaf client program on the managed host,
+              'ssh' connects to the karaf ssh console directly and needs no JVM, only the paramiko python library
+            - 'jolokia' reads bundles, features, repositories and configurations, and starts or stops bundles,
+              through a Jolokia agent. Other commands, configuration changes included, go through the client
+              program if it is installed, over ssh otherwise
+        required: false
+        default: client
+        choices: [ "client", "ssh", "jolokia" ]
+    jolokia_url:
+        description:
+            - url of the Jolokia agent, when transport is 'jolokia'. user and password are used to authenticate
+        required: false
+        default: http://localhost:8181/jolokia
+    validate_certs:
+        description:
+            - validate the certificate of an https jolokia_url
+        required: false
+        default: true
+    host:
+        description:
+            - host of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: localhost
+    port:
+        description:
+            - port of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: 8101
+    user:
+        description:
+            - user of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: karaf
+    password:
+        description:
+            - password of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    private_key:
+        description:
+            - private key file of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    connect_timeout:
+        description:
+            - ssh connection timeout in seconds, when transport is 'ssh'
+        required: false
+        default: 10
+    host_key_checking:
+        description:
+            - check the host key of the karaf ssh console against the system known_hosts and known_hosts, when
+              transport is 'ssh'. When false, an unknown host key is accepted, and saved to known_hosts if set
+        required: false
+        default: true
+    known_hosts:
+        description:
+            - known_hosts file checked on top of the system one, when transport is 'ssh'
+        required: false
+        default: null
+    lock_timeout:
+        description:
+            - how long to wait, in seconds, for another module run changing the same karaf installation. Changes
+              take a host local lock under the karaf data directory, listings do not
+        required: false
+        default: 600
 '''
 
 EXAMPLES = '''
@@ -46,6 +127,15 @@ EXAMPLES = '''
     state: present
     properties:
       noAutoStartBundles: false
+
+# Set typed, list and quoted values, compared with what is already set
+- karaf_config:
+    name: com.example.app
+    properties:
+      port: 8080
+      timeout: 'L"30000"'
+      hosts: [ "alpha", "beta" ]
+      greeting: "Hello \"world\""
       
 # Remove property
 - name: Test2 - Delete config
@@ -61,70 +151,42 @@ PACKAGE_STATE_MAP = dict(
     absent="property-delete"
 )
 
-_BOOL_TYPES = frozenset(['true', 'false', 'yes', 'no', 'y', 'n'])
-
-def check_bool(value):
-    if not value.lower() in _BOOL_TYPES:
-        raise ValueError()
-    
-    v = value.lower()
-    return  v == 'true' or \
-            v == 'yes' or \
-            v == 'y'
-    
-def convert(val):
-    constructors = [int, float, check_bool, str]
-    for c in constructors:
-        try:
-            return c(val);
-        except ValueError:
-            pass
-
-def run_with_check(module, cmd):
-    rc, out, err = module.run_command(cmd)
-    
-    if  rc != 0 or \
-        'Error executing command' in out or \
-        'Command not found' in out:
-        reason = out
-        module.fail_json(msg=reason)
-        raise Exception(out)
-
-    return out
-
-def existing_properties(module, client_bin, name, new_properties):
-    karaf_cmd = 'config:property-list --pid %s' % (name,)
-
-    out = run_with_check(module, '%s "%s"' % (client_bin, karaf_cmd))    
-    lines = out.split('\n')
-    
+def existing_properties(module, client, name, new_properties):
     result = {}
     
-    for line in lines:
-        if '=' not in line:
-            continue
-        
-        i = line.find('=')
-        prop_name = line[:i].strip()
-        
+    for prop_name, value in list_config_properties(client, name).items():
         # Don't bother to save properties that is not in new_properties
         if prop_name not in new_properties:
             continue
             
-        value = convert(line[i+1:].strip())
         result[prop_name] = value
     
     return result
 
-def config_property_set(client_bin, module, name, new_properties):
+def edit_config(client, name, cmds):
+    """Run property commands in a single config:edit session
+
+    The session is sent on the standard input of the client, which has no
+    size limit, and ends with one config:update: the pid is updated once,
+    with every change or none.
+
+    :param client: karaf client
+    :param name: service pid
+    :param cmds: config:property-set or config:property-delete commands
+    :return: chunk results
+    """
+    session = ['config:edit %s' % quote_console_arg(name)] + cmds + ['config:update']
+    return run_batch(client, [name], [' && '.join(session)])
+
+def config_property_set(client, module, name, new_properties):
     result = dict(
         changed=False,
         original_message='',
         message=''
     )
 
-    existing_props = existing_properties(module, client_bin, name, new_properties)
-    need_change = [k for k,v in new_properties.items() if k not in existing_props or existing_props[k] != v]
+    existing_props = existing_properties(module, client, name, new_properties)
+    need_change = [k for k,v in new_properties.items() if k not in existing_props or not property_equals(existing_props[k], v)]
         
     if not need_change:
         return result
@@ -135,23 +197,19 @@ def config_property_set(client_bin, module, name, new_properties):
 
     cmd_base = 'config:property-set %s %s'
     
-    cmds = []
-    cmds.append('config:edit %s' % name)  
-    cmds.extend([cmd_base % (k, v) for k,v in new_properties.items() if k in need_change])
-    cmds.append("config:update")
-    cmd = ' && '.join(cmds)
-    out = run_with_check(module, '%s "%s"' % (client_bin, cmd))
+    cmds = [cmd_base % (quote_console_arg(k), quote_console_arg(encode_property(new_properties[k]))) for k in need_change]
+    result['chunks'] = edit_config(client, name, cmds)
     
     return result
 
-def config_property_delete(client_bin, module, name, properties):
+def config_property_delete(client, module, name, properties):
     result = dict(
         changed=False,
         original_message='',
         message='',
     )
     
-    existing_props = existing_properties(module, client_bin, name, properties)
+    existing_props = existing_properties(module, client, name, properties)
     
     need_delete = [k for k in properties.keys() if k in existing_props]
     
@@ -162,45 +220,35 @@ def config_property_delete(client_bin, module, name, properties):
     if module.check_mode:
         return result
     
-    cmd_base = 'config:property-delete --pid "%s" %s'
-    cmd = ' && '.join([ cmd_base % (name, k) for k in properties.keys() if k in need_delete])
-    run_with_check(module, '%s "%s"' % (client_bin, cmd))
+    cmd_base = 'config:property-delete %s'
+    cmds = [cmd_base % quote_console_arg(k) for k in need_delete]
+    result['chunks'] = edit_config(client, name, cmds)
     return result
 
-def check_client_bin_path(client_bin):
-    if os.path.isfile(client_bin):
-        return client_bin
-    
-    if os.path.isdir(client_bin):
-        test = os.path.join(client_bin, 'bin/client')
-        if os.path.isfile(test):
-            return test
-    else:
-        raise Exception('client_bin parameter not supported: %s' % client_bin)
-
 def main():
+    argument_spec = karaf_argument_spec()
+    argument_spec.update(
+        name=dict(required=True),
+        state=dict(default="present", choices=PACKAGE_STATE_MAP.keys()),
+        properties=dict(required=True, type="dict")
+    )
     module = AnsibleModule(
-        argument_spec=dict(
-            name=dict(required=True),
-            state=dict(default="present", choices=PACKAGE_STATE_MAP.keys()),
-            properties=dict(required=True, type="dict"),
-            client_bin=dict(default="/opt/karaf/bin/client", type="path")
-        ),
+        argument_spec=argument_spec,
         supports_check_mode=True
     )
 
     name = module.params["name"]
     state = module.params["state"]
-    client_bin = module.params["client_bin"]
     properties = module.params["properties"]
     
-    client_bin = check_client_bin_path(client_bin)
+    client = karaf_client(module)
     
     if state == "present":
-        result = config_property_set(client_bin, module, name, properties)
+        result = config_property_set(client, module, name, properties)
     elif state == "absent":
-        result = config_property_delete(client_bin, module, name, properties)
+        result = config_property_delete(client, module, name, properties)
 
+    result['retries'] = client.retry_count
     module.exit_json(**result)
 
 if __name__ == '__main__':
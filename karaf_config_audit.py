@@ -0,0 +1,284 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.karaf import karaf_argument_spec, karaf_client, KarafError
+from ansible.module_utils.karaf import CONFIG_LIST_COMMAND, iter_config_list, property_digest, is_numeric_property
+import hashlib
+
+"""
+Ansible module to audit the configuration of a karaf container
+(c) 2017, Matthieu Rémy <remy.matthieu@gmail.com>
+"""
+
+DOCUMENTATION = '''
+---
+module: karaf_config_audit
+short_description: Compare every configuration of a karaf container with a desired state.
+description:
+    - Stream the output of config:list and compare it with a desired state, pid by pid. Values are compared by
+      type, like karaf_config does.
+    - Only digests are kept while the output is read, never the values, so that large containers can be audited
+      with little memory. The module reports the drift of every pid, and a digest of every configuration that
+      can be compared across nodes.
+options:
+    desired:
+        description:
+            - dictionary of service pid to a dictionary of property name and value. A null value means that the
+              property must not be set
+        required: false
+        type: dict
+        default: {}
+    strict:
+        description:
+            - also report the properties of the desired pids that are set but not in the desired state
+        required: false
+        default: false
+    ignore_properties:
+        description:
+            - properties left out of the comparison and of the digests, set by karaf itself
+        required: false
+        type: list
+        default: [ "service.pid", "service.factoryPid", "felix.fileinstall.filename" ]
+    fail_on_drift:
+        description:
+            - fail when a pid drifted from the desired state
+        required: false
+        default: false
+    client_bin:
+        description:
+            - path to the 'client' program in karaf, can also point to the root of the karaf installation '/opt/karaf'
+        required: false
+        default: /opt/karaf/bin/client
+    retries:
+        description:
+            - number of times a transient failure (container restarting, timeout, lock contention) is retried
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - initial delay in seconds between two retries, doubled on every attempt
+        required: false
+        default: 2
+    transport:
+        description:
+            - how to reach the karaf console. 'client' runs the karaf client program on the managed host,
+              'ssh' connects to the karaf ssh console directly and needs no JVM, only the paramiko python library
+            - 'jolokia' reads bundles, features, repositories and configurations, and starts or stops bundles,
+              through a Jolokia agent. Other commands, configuration changes included, go through the client
+              program if it is installed, over ssh otherwise
+        required: false
+        default: client
+        choices: [ "client", "ssh", "jolokia" ]
+    jolokia_url:
+        description:
+            - url of the Jolokia agent, when transport is 'jolokia'. user and password are used to authenticate
+        required: false
+        default: http://localhost:8181/jolokia
+    validate_certs:
+        description:
+            - validate the certificate of an https jolokia_url
+        required: false
+        default: true
+    host:
+        description:
+            - host of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: localhost
+    port:
+        description:
+            - port of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: 8101
+    user:
+        description:
+            - user of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: karaf
+    password:
+        description:
+            - password of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    private_key:
+        description:
+            - private key file of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    connect_timeout:
+        description:
+            - ssh connection timeout in seconds, when transport is 'ssh'
+        required: false
+        default: 10
+    host_key_checking:
+        description:
+            - check the host key of the karaf ssh console against the system known_hosts and known_hosts, when
+              transport is 'ssh'. When false, an unknown host key is accepted, and saved to known_hosts if set
+        required: false
+        default: true
+    known_hosts:
+        description:
+            - known_hosts file checked on top of the system one, when transport is 'ssh'
+        required: false
+        default: null
+    lock_timeout:
+        description:
+            - how long to wait, in seconds, for another module run changing the same karaf installation. Changes
+              take a host local lock under the karaf data directory, listings do not
+        required: false
+        default: 600
+'''
+
+EXAMPLES = '''
+# Audit the configuration, fail if it drifted
+- karaf_config_audit:
+    fail_on_drift: true
+    desired:
+      org.apache.karaf.log:
+        size: 500
+      org.ops4j.pax.web:
+        org.osgi.service.http.port: 8181
+        org.osgi.service.http.secure.enabled: false
+        org.ops4j.pax.web.ssl.password:
+
+# Collect the digests of every configuration, to compare the nodes
+- karaf_config_audit:
+  register: audit
+'''
+
+IGNORED_PROPERTIES = ['service.pid', 'service.factoryPid', 'felix.fileinstall.filename']
+
+
+def property_hash(name, digest):
+    return int(hashlib.sha1(('%s\0%s' % (name, digest)).encode('utf-8')).hexdigest(), 16)
+
+
+def audit_config(lines, desired, ignored, strict):
+    """Compute the digests of the listed configurations
+
+    The digest of a configuration does not depend on the order of its
+    properties. For the desired pids, the digest of every desired property is
+    kept too, and the name of the other properties when strict.
+
+    :param lines: output lines of CONFIG_LIST_COMMAND
+    :param desired: dict of pid to its desired properties
+    :param ignored: names of the properties left out
+    :param strict: keep the names of the properties that are not desired
+    :return: dict of pid to its digest, dict of desired pid to a dict of property name to its digest
+    """
+    numeric = dict(
+        (pid, dict((k, is_numeric_property(v)) for k, v in (props or {}).items()))
+        for pid, props in desired.items()
+    )
+
+    digests = {}
+    found = {}
+    for pid, name, value in iter_config_list(lines):
+        if name is None:
+            digests[pid] = 0
+            if pid in desired:
+                found[pid] = {}
+            continue
+
+        if name in ignored:
+            continue
+
+        # The digest of the configuration does not depend on the desired state,
+        # so that it can be compared across nodes
+        digest = property_digest(value)
+        digests[pid] ^= property_hash(name, digest)
+
+        wanted = numeric.get(pid)
+        if wanted is not None and (name in wanted or strict):
+            found[pid][name] = property_digest(value, True) if wanted.get(name) else digest
+
+    return dict((pid, '%040x' % digest) for pid, digest in digests.items()), found
+
+
+def config_drift(desired, found, strict):
+    """Compare the desired configurations with the listed ones
+
+    :param desired: dict of pid to its desired properties
+    :param found: dict of desired pid to a dict of property name to its digest
+    :param strict: report the properties that are set but not desired
+    :return: dict of pid to its drift, for the pids that drifted
+    """
+    drift = {}
+    for pid, props in desired.items():
+        if pid not in found:
+            drift[pid] = dict(missing=True)
+            continue
+
+        props = props or {}
+        existing = found[pid]
+        changed = []
+        missing_keys = []
+        extra_keys = []
+        for name, value in props.items():
+            if value is None:
+                if name in existing:
+                    extra_keys.append(name)
+            elif name not in existing:
+                missing_keys.append(name)
+            elif existing[name] != property_digest(value, is_numeric_property(value)):
+                changed.append(name)
+
+        if strict:
+            extra_keys.extend(name for name in existing if name not in props)
+
+        if changed or missing_keys or extra_keys:
+            drift[pid] = dict(
+                missing=False,
+                changed=sorted(changed),
+                missing_keys=sorted(missing_keys),
+                extra_keys=sorted(extra_keys),
+            )
+
+    return drift
+
+
+def main():
+    argument_spec = karaf_argument_spec()
+    argument_spec.update(
+        desired=dict(default={}, type="dict"),
+        strict=dict(default=False, type="bool"),
+        ignore_properties=dict(default=IGNORED_PROPERTIES, type="list"),
+        fail_on_drift=dict(default=False, type="bool")
+    )
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    desired = module.params["desired"] or {}
+    strict = module.params["strict"]
+    ignored = set(module.params["ignore_properties"])
+
+    client = karaf_client(module)
+
+    # A failed listing is read again from the start
+    try:
+        digests, found = client.retry(
+            lambda: audit_config(client.stream(CONFIG_LIST_COMMAND), desired, ignored, strict)
+        )
+    except KarafError as e:
+        client.fail(e)
+
+    drift = config_drift(desired, found, strict)
+
+    result = dict(
+        changed=False,
+        drifted=bool(drift),
+        drift=drift,
+        digests=digests,
+        pids=len(digests),
+        retries=client.retry_count,
+    )
+
+    if drift and module.params["fail_on_drift"]:
+        module.fail_json(msg='Configuration drifted for: %s' % ', '.join(sorted(drift)), **result)
+
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
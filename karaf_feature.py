@@ -2,7 +2,9 @@
 # -*- coding: utf-8 -*-
 
 from ansible.module_utils.basic import *
-import os.path
+from ansible.module_utils.karaf import karaf_argument_spec, karaf_client, list_features, start_job, resume_job
+from ansible.module_utils.karaf import FEATURE_STATE_UNINSTALLED, karaf_home_path, offline_feature
+import time
 
 """
 Ansible module to manage karaf features
@@ -32,11 +34,106 @@ options:
         required: false
         default: present
         choices: [ "present", "absent" ]
+    wait:
+        description:
+            - wait for the feature to be installed or uninstalled. When false, the console command is started
+              in the background and the module returns right away with status "pending". Running the module
+              again reports the progress, and fails if the background command failed.
+        required: false
+        default: true
+    wait_timeout:
+        description:
+            - how long to wait, in seconds, for a background command started by a previous run to finish
+        required: false
+        default: 600
+    offline:
+        description:
+            - edit featuresBoot in etc/org.apache.karaf.features.cfg instead of talking to a running container,
+              so that the feature is installed when karaf first boots. The karaf installation is found from client_bin
+        required: false
+        default: false
     client_bin:
         description:
             - path to the 'client' program in karaf, can also point to the root of the karaf installation '/opt/karaf'
         required: false
         default: /opt/karaf/bin/client
+    retries:
+        description:
+            - number of times a transient failure (container restarting, timeout, lock contention) is retried
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - initial delay in seconds between two retries, doubled on every attempt
+        required: false
+        default: 2
+    transport:
+        description:
+            - how to reach the karaf console. 'client' runs the karaf client program on the managed host,
+              'ssh' connects to the karaf ssh console directly and needs no JVM, only the paramiko python library
+            - 'jolokia' reads bundles, features, repositories and configurations, and starts or stops bundles,
+              through a Jolokia agent. Other commands, configuration changes included, go through the client
+              program if it is installed, over ssh otherwise
+        required: false
+        default: client
+        choices: [ "client", "ssh", "jolokia" ]
+    jolokia_url:
+        description:
+            - url of the Jolokia agent, when transport is 'jolokia'. user and password are used to authenticate
+        required: false
+        default: http://localhost:8181/jolokia
+    validate_certs:
+        description:
+            - validate the certificate of an https jolokia_url
+        required: false
+        default: true
+    host:
+        description:
+            - host of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: localhost
+    port:
+        description:
+            - port of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: 8101
+    user:
+        description:
+            - user of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: karaf
+    password:
+        description:
+            - password of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    private_key:
+        description:
+            - private key file of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    connect_timeout:
+        description:
+            - ssh connection timeout in seconds, when transport is 'ssh'
+        required: false
+        default: 10
+    host_key_checking:
+        description:
+            - check the host key of the karaf ssh console against the system known_hosts and known_hosts, when
+              transport is 'ssh'. When false, an unknown host key is accepted, and saved to known_hosts if set
+        required: false
+        default: true
+    known_hosts:
+        description:
+            - known_hosts file checked on top of the system one, when transport is 'ssh'
+        required: false
+        default: null
+    lock_timeout:
+        description:
+            - how long to wait, in seconds, for another module run changing the same karaf installation. Changes
+              take a host local lock under the karaf data directory, listings do not
+        required: false
+        default: 600
 '''
 
 EXAMPLES = '''
@@ -56,6 +153,17 @@ EXAMPLES = '''
     - { name: "camel-jms", version: "2.18.1" }
     - { name: "camel-xml", version: "2.18.1" }
 
+# Install a feature at first boot, before karaf is started
+- karaf_feature: state="present" name="camel-jms" version="2.18.1" offline=true client_bin="/opt/karaf"
+
+# Start a long install in the background, then poll until it is done
+- karaf_feature: state="present" name="cxf" wait=false
+- karaf_feature: state="present" name="cxf" wait=false
+  register: cxf
+  until: cxf.status != "pending"
+  retries: 60
+  delay: 10
+
 '''
 
 PACKAGE_STATE_MAP = dict(
@@ -63,79 +171,83 @@ PACKAGE_STATE_MAP = dict(
     absent="uninstall"
 )
 
-FEATURE_STATE_UNINSTALLED = 'Uninstalled'
-CLIENT_KARAF_COMMAND = "{0} 'feature:{1}'"
-CLIENT_KARAF_COMMAND_WITH_ARGS = "{0} 'feature:{1} {2}'"
+CLIENT_KARAF_COMMAND = "feature:{0}"
+CLIENT_KARAF_COMMAND_WITH_ARGS = "feature:{0} {1}"
 
-_KARAF_COLUMN_SEPARATOR = '\xe2\x94\x82'
+def feature_full_name(feature_name, feature_version):
+    full_qualified_name = feature_name
+    if feature_version:
+        full_qualified_name = full_qualified_name + "/" + feature_version
+    return full_qualified_name
 
-def install_feature(client_bin, module, feature_name, feature_version):
+
+def start_feature_action(client, module, state, feature_name, feature_version):
+    """Start a feature install or uninstall in the background
+
+    :param client: karaf client
+    :param module: ansible module
+    :param state: desired feature state
+    :param feature_name: name of feature
+    :param feature_version: version of feature
+    :return: command, background job
+    """
+    full_qualified_name = feature_full_name(feature_name, feature_version)
+    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format(PACKAGE_STATE_MAP[state], full_qualified_name)
+    job = start_job(client, cmd, cmd)
+    return cmd, job
+
+
+def install_feature(client, module, feature_name, feature_version):
     """Call karaf client command to install a feature
 
-    :param client_bin: karaf client command bin
+    :param client: karaf client
     :param module: ansible module
     :param feature_name: name of feature to install
     :param feature_version: version of feature to install
     :return: command, ouput command message, error command message
     """
-    full_qualified_name = feature_name
-    if feature_version:
-        full_qualified_name = full_qualified_name + "/" + feature_version
-    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format(client_bin, PACKAGE_STATE_MAP["present"], full_qualified_name)
-    rc, out, err = module.run_command(cmd)
-
-    if rc != 0:
-        reason = parse_error(out)
-        module.fail_json(msg=reason)
+    full_qualified_name = feature_full_name(feature_name, feature_version)
+    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format(PACKAGE_STATE_MAP["present"], full_qualified_name)
+    out = client.run_with_check(cmd)
 
     # If feature is still uninstalled, fails.
-    is_installed = is_feature_installed(client_bin, module, feature_name, feature_version)
+    is_installed = is_feature_installed(client, module, feature_name, feature_version)
     if not is_installed:
-        module.fail_json(msg='Feature fails to install')
+        module.fail_json(msg='Feature fails to install', retries=client.retry_count)
 
-    return True, cmd, out, err
+    return True, cmd, out, ''
 
 
-def uninstall_feature(client_bin, module, feature_name, feature_version):
+def uninstall_feature(client, module, feature_name, feature_version):
     """Call karaf client command to uninstall a feature
 
-    :param client_bin: karaf client command bin
+    :param client: karaf client
     :param module: ansible module
     :param feature_name: name of feature to install
     :param feature_version: version of feature to install
     :return: command, ouput command message, error command message
     """
-    full_qualified_name = feature_name
-    if feature_version:
-        full_qualified_name = full_qualified_name + "/" + feature_version
-    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format(client_bin, PACKAGE_STATE_MAP["absent"], full_qualified_name)
-    rc, out, err = module.run_command(cmd)
-
-    if rc != 0:
-        reason = parse_error(out)
-        module.fail_json(msg=reason)
+    full_qualified_name = feature_full_name(feature_name, feature_version)
+    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format(PACKAGE_STATE_MAP["absent"], full_qualified_name)
+    out = client.run_with_check(cmd)
 
-    is_installed = is_feature_installed(client_bin, module, feature_name, feature_version)
+    is_installed = is_feature_installed(client, module, feature_name, feature_version)
     if is_installed:
-        module.fail_json(msg='Feature fails to uninstall')
+        module.fail_json(msg='Feature fails to uninstall', retries=client.retry_count)
 
-    return True, cmd, out, err
+    return True, cmd, out, ''
 
 
-def is_feature_installed(client_bin, module, feature_name, feature_version):
+def is_feature_installed(client, module, feature_name, feature_version):
     """ Check if a feature with given version is installed.
 
-    :param client_bin: karaf client command bin
+    :param client: karaf client
     :param module: ansible module
     :param feature_name: name of feature to install
     :param feature_version: version of feature to install. Optional.
     :return: True if feature is installed, False if not
     """
 
-    cmd = CLIENT_KARAF_COMMAND.format(client_bin, 'list -i')
-    rc, out, err = module.run_command(cmd)
-    lines = out.split('\n')
-    
     if not feature_version:
         feature_version = ''
 
@@ -143,77 +255,79 @@ def is_feature_installed(client_bin, module, feature_name, feature_version):
     # For instance, snapshot version will be 1.0.0.SNAPSHOT instead of 1.0.0-SNAPSHOT
     feature_version = feature_version.replace('-', '.')
 
-    is_installed = False
-    for line in lines:
-        feature_data = line.split(_KARAF_COLUMN_SEPARATOR)
-        if len(feature_data) < 4:
+    for feature in list_features(client):
+        if feature['name'] != feature_name:
             continue
-        
-        name = feature_data[0].strip()
-        version = feature_data[1].strip()
-        state = feature_data[3].strip()
-        
-        if name != feature_name:
+
+        if feature['state'] == FEATURE_STATE_UNINSTALLED:
             continue
-        
-        if state != FEATURE_STATE_UNINSTALLED:
-            if feature_version:
-                if version == feature_version:
-                    is_installed = True
-                    return is_installed
-            else:
-                is_installed = True
-                return is_installed
-
-    return is_installed
-
-
-def parse_error(string):
-    reason = "reason: "
-    try:
-        return string[string.index(reason) + len(reason):].strip()
-    except ValueError:
-        return string
-
-def check_client_bin_path(client_bin):
-    if os.path.isfile(client_bin):
-        return client_bin
-    
-    if os.path.isdir(client_bin):
-        test = os.path.join(client_bin, 'bin/client')
-        if os.path.isfile(test):
-            return test
-    else:
-        raise Exception('client_bin parameter not supported: %s' % client_bin)
+
+        if not feature_version or feature['version'] == feature_version:
+            return True
+
+    return False
+
 
 def main():
+    argument_spec = karaf_argument_spec()
+    argument_spec.update(
+        name=dict(required=True),
+        version=dict(default=None),
+        state=dict(default="present", choices=PACKAGE_STATE_MAP.keys()),
+        wait=dict(default=True, type="bool"),
+        wait_timeout=dict(default=600, type="int"),
+        offline=dict(default=False, type="bool")
+    )
     module = AnsibleModule(
-        argument_spec=dict(
-            name=dict(required=True),
-            version=dict(default=None),
-            state=dict(default="present", choices=PACKAGE_STATE_MAP.keys()),
-            client_bin=dict(default="/opt/karaf/bin/client", type="path")
-        )
+        argument_spec=argument_spec,
+        supports_check_mode=True
     )
 
     name = module.params["name"]
     version = module.params["version"]
     state = module.params["state"]
-    client_bin = module.params["client_bin"]
+    wait = module.params["wait"]
+    wait_timeout = module.params["wait_timeout"]
+
+    if module.params["offline"]:
+        changed = offline_feature(module, karaf_home_path(module.params["client_bin"]), name, version, state)
+        module.exit_json(changed=changed, name=name, state=state, offline=True)
+
+    client = karaf_client(module)
+
+    # A previous run may have left the same command running in the background
+    job_key = CLIENT_KARAF_COMMAND_WITH_ARGS.format(PACKAGE_STATE_MAP[state], feature_full_name(name, version))
+    job = resume_job(client, job_key, wait, wait_timeout)
+    if job is not None and job['running']:
+        module.exit_json(changed=False, cmd=job['cmd'], name=name, state=state, status='pending',
+                         job=dict(pid=job['pid'], log=job['log'], elapsed=time.time() - job['started']),
+                         retries=client.retry_count)
+
+    is_installed = is_feature_installed(client, module, name, version)
+    needs_change = (state == "present") != is_installed
+    if needs_change and job is not None:
+        module.fail_json(msg='Feature fails to %s' % PACKAGE_STATE_MAP[state], stdout=job['output'],
+                         retries=client.retry_count)
+
+    if needs_change and module.check_mode:
+        module.exit_json(changed=True, name=name, state=state, retries=client.retry_count)
 
-    client_bin = check_client_bin_path(client_bin)
+    if needs_change and not wait:
+        cmd, job = start_feature_action(client, module, state, name, version)
+        module.exit_json(changed=True, cmd=cmd, name=name, state=state, status='pending',
+                         job=dict(pid=job['pid'], log=job['log'], elapsed=0), retries=client.retry_count)
 
-    is_installed = is_feature_installed(client_bin, module, name, version)
     changed = False
     cmd = ''
     out = ''
     err = ''
     if state == "present" and not is_installed:
-        changed, cmd, out, err = install_feature(client_bin, module, name, version)
+        changed, cmd, out, err = install_feature(client, module, name, version)
     elif state == "absent" and is_installed:
-        changed, cmd, out, err = uninstall_feature(client_bin, module, name, version)
+        changed, cmd, out, err = uninstall_feature(client, module, name, version)
 
-    module.exit_json(changed=changed, cmd=cmd, name=name, state=state, stdout=out, stderr=err)
+    status = 'installed' if state == 'present' else 'uninstalled'
+    module.exit_json(changed=changed, cmd=cmd, name=name, state=state, status=status, stdout=out, stderr=err, retries=client.retry_count)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.karaf import karaf_argument_spec, karaf_client, list_bundles, list_features
+from ansible.module_utils.karaf import KarafError, FEATURE_STATE_UNINSTALLED
+from ansible.module_utils.urls import open_url
+import time
+
+"""
+Ansible module to wait for a karaf container to be healthy
+(c) 2017, Matthieu Rémy <remy.matthieu@gmail.com>
+"""
+
+DOCUMENTATION = '''
+---
+module: karaf_health
+short_description: Wait until a karaf container is healthy.
+description:
+    - Wait until the given bundles are Active, the given features are installed and an optional health probe
+      passes. Fails when the timeout is reached, or right away when one of the bundles is in the Failure state.
+    - Meant to gate rolling deployments, see the README.
+options:
+    bundles:
+        description:
+            - urls or symbolic names of the bundles that must be Active
+        required: false
+        type: list
+        default: []
+    features:
+        description:
+            - names of the features that must be installed
+        required: false
+        type: list
+        default: []
+    probe_url:
+        description:
+            - url that must answer with probe_status, e.g. a servlet or a Jolokia endpoint
+        required: false
+        default: null
+    probe_status:
+        description:
+            - expected HTTP status of probe_url
+        required: false
+        default: 200
+    probe_command:
+        description:
+            - karaf console command that must succeed, e.g. 'camel:context-list'
+        required: false
+        default: null
+    timeout:
+        description:
+            - how long to wait for the container to be healthy, in seconds
+        required: false
+        default: 300
+    interval:
+        description:
+            - delay between two checks, in seconds
+        required: false
+        default: 5
+    client_bin:
+        description:
+            - path to the 'client' program in karaf, can also point to the root of the karaf installation '/opt/karaf'
+        required: false
+        default: /opt/karaf/bin/client
+    retries:
+        description:
+            - number of times a transient failure (container restarting, timeout, lock contention) is retried
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - initial delay in seconds between two retries, doubled on every attempt
+        required: false
+        default: 2
+    transport:
+        description:
+            - how to reach the karaf console. 'client' runs the karaf client program on the managed host,
+              'ssh' connects to the karaf ssh console directly and needs no JVM, only the paramiko python library
+            - 'jolokia' reads bundles, features, repositories and configurations, and starts or stops bundles,
+              through a Jolokia agent. Other commands, configuration changes included, go through the client
+              program if it is installed, over ssh otherwise
+        required: false
+        default: client
+        choices: [ "client", "ssh", "jolokia" ]
+    jolokia_url:
+        description:
+            - url of the Jolokia agent, when transport is 'jolokia'. user and password are used to authenticate
+        required: false
+        default: http://localhost:8181/jolokia
+    validate_certs:
+        description:
+            - validate the certificate of an https jolokia_url
+        required: false
+        default: true
+    host:
+        description:
+            - host of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: localhost
+    port:
+        description:
+            - port of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: 8101
+    user:
+        description:
+            - user of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: karaf
+    password:
+        description:
+            - password of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    private_key:
+        description:
+            - private key file of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    connect_timeout:
+        description:
+            - ssh connection timeout in seconds, when transport is 'ssh'
+        required: false
+        default: 10
+    host_key_checking:
+        description:
+            - check the host key of the karaf ssh console against the system known_hosts and known_hosts, when
+              transport is 'ssh'. When false, an unknown host key is accepted, and saved to known_hosts if set
+        required: false
+        default: true
+    known_hosts:
+        description:
+            - known_hosts file checked on top of the system one, when transport is 'ssh'
+        required: false
+        default: null
+    lock_timeout:
+        description:
+            - how long to wait, in seconds, for another module run changing the same karaf installation. Changes
+              take a host local lock under the karaf data directory, listings do not
+        required: false
+        default: 600
+'''
+
+EXAMPLES = '''
+# Wait for the application bundles and a servlet
+- karaf_health:
+    bundles:
+      - mvn:org.apache.camel/camel-example-osgi/2.15.2
+      - com.google.gson
+    features:
+      - camel-jms
+    probe_url: http://localhost:8181/health
+    timeout: 600
+'''
+
+BUNDLE_STATE_ACTIVE = 'Active'
+BUNDLE_STATE_FAILURE = 'Failure'
+
+
+def check_bundles(client, bundle_refs):
+    """Check the state of the bundles
+
+    :param client: karaf client
+    :param bundle_refs: urls or symbolic names of the bundles
+    :return: dict of bundle reference to its state, None when not installed
+    """
+    bundles = list_bundles(client, check=False)
+
+    states = {}
+    for ref in bundle_refs:
+        bundle = bundles.find(ref)
+        if bundle is None and ref in bundles.by_name:
+            bundle = bundles.by_name[ref][0]
+        states[ref] = bundle['state'] if bundle is not None else None
+
+    return states
+
+
+def check_features(client, feature_names):
+    """Check which features are installed
+
+    :param client: karaf client
+    :param feature_names: names of the features
+    :return: dict of feature name to its state, None when not installed
+    """
+    installed = dict(
+        (f['name'], f['state']) for f in list_features(client, check=False) if f['state'] != FEATURE_STATE_UNINSTALLED
+    )
+    return dict((name, installed.get(name)) for name in feature_names)
+
+
+def check_probe(client, probe_url, probe_status, probe_command):
+    """Run the health probes
+
+    :return: None if the probes passed, otherwise the reason why they did not
+    """
+    if probe_command:
+        try:
+            client.run(probe_command)
+        except KarafError as e:
+            return 'probe command failed: %s' % e.reason
+
+    if probe_url:
+        try:
+            status = open_url(probe_url, timeout=10).getcode()
+        except Exception as e:
+            status = getattr(e, 'code', None)
+            if status is None:
+                return 'probe url failed: %s' % e
+        if status != probe_status:
+            return 'probe url answered %s' % status
+
+    return None
+
+
+def main():
+    argument_spec = karaf_argument_spec()
+    argument_spec.update(
+        bundles=dict(default=[], type="list"),
+        features=dict(default=[], type="list"),
+        probe_url=dict(default=None),
+        probe_status=dict(default=200, type="int"),
+        probe_command=dict(default=None),
+        timeout=dict(default=300, type="int"),
+        interval=dict(default=5, type="int")
+    )
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    bundle_refs = module.params["bundles"]
+    feature_names = module.params["features"]
+    timeout = module.params["timeout"]
+    interval = module.params["interval"]
+
+    client = karaf_client(module)
+
+    started = time.time()
+    attempts = 0
+    while True:
+        attempts += 1
+        reasons = []
+        bundles = {}
+        features = {}
+
+        try:
+            if bundle_refs:
+                bundles = check_bundles(client, bundle_refs)
+            if feature_names:
+                features = check_features(client, feature_names)
+        except KarafError as e:
+            reasons.append(e.reason)
+
+        failed = [ref for ref, state in bundles.items() if state == BUNDLE_STATE_FAILURE]
+        if failed:
+            module.fail_json(msg='Bundles in Failure state: %s' % ', '.join(failed), bundles=bundles,
+                             features=features, elapsed=time.time() - started, retries=client.retry_count)
+
+        reasons.extend('bundle %s is %s' % (ref, state or 'not installed')
+                       for ref, state in bundles.items() if state != BUNDLE_STATE_ACTIVE)
+        reasons.extend('feature %s is not installed' % name
+                       for name, state in features.items() if state is None)
+
+        if not reasons:
+            probe_failure = check_probe(client, module.params["probe_url"],
+                                        module.params["probe_status"], module.params["probe_command"])
+            if probe_failure is not None:
+                reasons.append(probe_failure)
+
+        elapsed = time.time() - started
+        if not reasons:
+            module.exit_json(changed=False, healthy=True, bundles=bundles, features=features,
+                             attempts=attempts, elapsed=elapsed, retries=client.retry_count)
+
+        if elapsed + interval > timeout:
+            module.fail_json(msg='Container not healthy after %ss: %s' % (timeout, '; '.join(reasons)),
+                             healthy=False, bundles=bundles, features=features,
+                             attempts=attempts, elapsed=elapsed, retries=client.retry_count)
+
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    main()
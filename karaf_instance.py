@@ -0,0 +1,387 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.karaf import karaf_argument_spec, karaf_client, karaf_home_path, karaf_lock
+from ansible.module_utils.karaf import ConsoleTable
+import errno
+import os.path
+import re
+import socket
+import time
+
+"""
+Ansible module to start and stop karaf containers
+(c) 2017, Matthieu Rémy <remy.matthieu@gmail.com>
+"""
+
+DOCUMENTATION = '''
+---
+module: karaf_instance
+short_description: Start, stop or restart a Karaf container.
+description:
+    - Start, stop or restart a karaf container with bin/start, bin/stop and bin/status, or a child instance with
+      instance:start and instance:stop.
+    - A started container is ready when its ssh port accepts connections and, if ready_pattern is given, when
+      the pattern shows up in data/log/karaf.log. The log is tailed and the port probed, without spawning the
+      karaf client. A stopped container has closed its ssh port and its process, from data/karaf.pid or
+      karaf.pid, has exited: bin/status is only called once, to tell if the container runs. The ssh port and state
+      of a child instance are read once with instance:list, and its log is instances/<name>/data/log/karaf.log.
+options:
+    state:
+        description:
+            - container state
+        required: false
+        default: started
+        choices: [ "started", "stopped", "restarted" ]
+    name:
+        description:
+            - name of a child instance, managed with the instance:* commands of the root container
+        required: false
+        default: null
+    ready_pattern:
+        description:
+            - regular expression that must show up in data/log/karaf.log, or in the log of the child instance, after
+              the start, for the container to be ready
+        required: false
+        default: null
+    wait_timeout:
+        description:
+            - how long to wait for the container to start or stop, in seconds
+        required: false
+        default: 300
+    host:
+        description:
+            - host of the ssh console, probed to detect that the container, or the child instance, is ready
+        required: false
+        default: localhost
+    port:
+        description:
+            - port of the ssh console, probed to detect that the container is ready. The port of a child instance
+              is read from instance:list
+        required: false
+        default: 8101
+    client_bin:
+        description:
+            - path to the 'client' program in karaf, can also point to the root of the karaf installation '/opt/karaf'
+        required: false
+        default: /opt/karaf/bin/client
+    retries:
+        description:
+            - number of times a transient failure (container restarting, timeout, lock contention) is retried
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - initial delay in seconds between two retries, doubled on every attempt
+        required: false
+        default: 2
+    lock_timeout:
+        description:
+            - how long to wait, in seconds, for another module run changing the same karaf installation. Changes
+              take a host local lock under the karaf data directory, listings do not
+        required: false
+        default: 600
+'''
+
+EXAMPLES = '''
+# Start karaf and wait for the ssh console
+- karaf_instance: state="started" client_bin="/opt/karaf"
+
+# Restart karaf and wait for the boot features to be installed
+- karaf_instance: state="restarted" ready_pattern="Done\\\\." wait_timeout=600
+
+# Stop a child instance
+- karaf_instance: state="stopped" name="child1"
+'''
+
+KARAF_LOG = 'data/log/karaf.log'
+# Where karaf.pid.file points to by default, in karaf 4 and in older versions
+KARAF_PID_FILES = ('data/karaf.pid', 'karaf.pid')
+INSTANCES_DIR = 'instances'
+POLL_INTERVAL = 0.5
+
+INSTANCE_LIST_COMMAND = 'instance:list'
+INSTANCE_STATE_STARTED = 'Started'
+
+
+class LogTail(object):
+    """Reads what is appended to a log file after it was opened"""
+
+    def __init__(self, path):
+        self.path = path
+        self.inode, self.offset = self._stat()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None, 0
+        return st.st_ino, st.st_size
+
+    def read(self):
+        inode, size = self._stat()
+        if inode is None:
+            return ''
+
+        # The log was rotated, or truncated: read the new one from the start
+        if inode != self.inode or size < self.offset:
+            self.inode = inode
+            self.offset = 0
+
+        with open(self.path) as f:
+            f.seek(self.offset)
+            data = f.read()
+            self.offset = f.tell()
+        return data
+
+
+def is_port_open(host, port):
+    try:
+        sock = socket.create_connection((host, port), timeout=1)
+    except (socket.error, socket.timeout):
+        return False
+    sock.close()
+    return True
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def read_pid(karaf_home):
+    """Process of the root container, from its pid file
+
+    :return: the pid, or None if there is no pid file
+    """
+    for path in KARAF_PID_FILES:
+        try:
+            with open(os.path.join(karaf_home, path)) as f:
+                pid = f.read().strip()
+        except (IOError, OSError):
+            continue
+        if pid.isdigit():
+            return int(pid)
+    return None
+
+
+def is_running(module, karaf_home):
+    rc, out, err = module.run_command([os.path.join(karaf_home, 'bin', 'status')])
+    return rc == 0
+
+
+def wait_until(condition, timeout):
+    """Poll condition until it is true
+
+    :return: True if condition became true before the timeout
+    """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(POLL_INTERVAL)
+    return True
+
+
+def wait_until_ready(module, log, host, port, ready_pattern, timeout, what='Karaf'):
+    """Wait for the ssh port to accept connections and the pattern to be logged
+
+    :param log: LogTail opened before the start, or None
+    """
+    pattern = re.compile(ready_pattern) if ready_pattern else None
+    logged = []
+
+    def ready():
+        if log is not None:
+            logged.append(log.read())
+        if pattern is not None and not pattern.search(''.join(logged)):
+            return False
+        return is_port_open(host, port)
+
+    if not wait_until(ready, timeout):
+        module.fail_json(msg='%s not ready after %ss' % (what, timeout), log=''.join(logged)[-4096:])
+
+
+def start_root(module, karaf_home, host, port, ready_pattern, timeout):
+    """Call bin/start and wait for the container to be ready
+
+    :return: startup time in seconds
+    """
+    log = LogTail(os.path.join(karaf_home, KARAF_LOG))
+    started = time.time()
+
+    with karaf_lock(module, karaf_home):
+        rc, out, err = module.run_command([os.path.join(karaf_home, 'bin', 'start')])
+    if rc != 0:
+        module.fail_json(msg='bin/start failed', stdout=out, stderr=err)
+
+    wait_until_ready(module, log, host, port, ready_pattern, timeout)
+
+    return time.time() - started
+
+
+def stop_root(module, karaf_home, host, port, timeout):
+    """Call bin/stop and wait for the container to exit
+
+    The ssh port must be closed, and the process of the pid file gone:
+    bin/status starts a JVM, it is not polled.
+
+    :return: stop time in seconds
+    """
+    started = time.time()
+    # Read before bin/stop, karaf removes its pid file on the way out
+    pid = read_pid(karaf_home)
+
+    with karaf_lock(module, karaf_home):
+        rc, out, err = module.run_command([os.path.join(karaf_home, 'bin', 'stop')])
+    if rc != 0:
+        module.fail_json(msg='bin/stop failed', stdout=out, stderr=err)
+
+    def stopped():
+        if pid is not None and is_process_alive(pid):
+            return False
+        return not is_port_open(host, port)
+
+    if not wait_until(stopped, timeout):
+        module.fail_json(msg='Karaf still running after %ss' % timeout)
+
+    return time.time() - started
+
+
+def parse_instance_list(out):
+    """Parse the output of INSTANCE_LIST_COMMAND
+
+    The columns are found by their header, they changed across karaf versions.
+
+    :param out: console output
+    :return: dict of instance name to a dict with its 'ssh_port', 'state' and 'pid'
+    """
+    table = ConsoleTable(out)
+    columns = None
+    instances = {}
+    for row in table.rows():
+        fields = [table.text(row, i) for i in range(len(row) - 1)]
+        if columns is None:
+            if 'Name' in fields and 'SSH Port' in fields:
+                columns = dict((field, i) for i, field in enumerate(fields))
+            continue
+
+        pid = fields[columns['PID']] if 'PID' in columns else ''
+        instances[fields[columns['Name']]] = {
+            'ssh_port':     int(fields[columns['SSH Port']]),
+            'state':        fields[columns['State']],
+            'pid':          int(pid) if pid.isdigit() and pid != '0' else None,
+        }
+    return instances
+
+
+def child_instance(client, module, name):
+    """Read the ssh port, state and pid of a child instance with a single console call"""
+    instances = parse_instance_list(client.run_with_check(INSTANCE_LIST_COMMAND, raw=True))
+    if name not in instances:
+        module.fail_json(msg='Instance %s not found' % name, retries=client.retry_count)
+    return instances[name]
+
+
+def start_child(client, module, name, host, port, ready_pattern, timeout):
+    """Call instance:start and wait for the child instance to be ready
+
+    :return: startup time in seconds
+    """
+    log = None
+    if client.karaf_home is not None:
+        log = LogTail(os.path.join(client.karaf_home, INSTANCES_DIR, name, KARAF_LOG))
+    started = time.time()
+
+    client.run_with_check('instance:start %s' % name)
+    wait_until_ready(module, log, host, port, ready_pattern, timeout, 'Instance %s' % name)
+
+    return time.time() - started
+
+
+def stop_child(client, module, name, host, port, pid, timeout):
+    """Call instance:stop and wait for the child instance to exit
+
+    :param pid: process of the instance, waited for when karaf runs on this host
+    :return: stop time in seconds
+    """
+    started = time.time()
+    client.run_with_check('instance:stop %s' % name)
+
+    def stopped():
+        if pid is not None and client.karaf_home is not None and is_process_alive(pid):
+            return False
+        return not is_port_open(host, port)
+
+    if not wait_until(stopped, timeout):
+        module.fail_json(msg='Instance %s still running after %ss' % (name, timeout), retries=client.retry_count)
+
+    return time.time() - started
+
+
+def main():
+    argument_spec = karaf_argument_spec()
+    argument_spec.update(
+        state=dict(default="started", choices=["started", "stopped", "restarted"]),
+        name=dict(default=None),
+        ready_pattern=dict(default=None),
+        wait_timeout=dict(default=300, type="int")
+    )
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    state = module.params["state"]
+    name = module.params["name"]
+    host = module.params["host"]
+    port = module.params["port"]
+    timeout = module.params["wait_timeout"]
+
+    result = dict(
+        changed=False,
+        state=state,
+    )
+
+    if name:
+        client = karaf_client(module)
+        instance = child_instance(client, module, name)
+        running = instance['state'] == INSTANCE_STATE_STARTED
+        result['name'] = name
+        result['port'] = instance['ssh_port']
+
+        if state == 'stopped' and running or state == 'restarted':
+            result['changed'] = True
+            if not module.check_mode and running:
+                result['stop_time'] = stop_child(client, module, name, host, instance['ssh_port'],
+                                                 instance['pid'], timeout)
+        if state == 'started' and not running or state == 'restarted':
+            result['changed'] = True
+            if not module.check_mode:
+                result['startup_time'] = start_child(client, module, name, host, instance['ssh_port'],
+                                                     module.params["ready_pattern"], timeout)
+
+        result['retries'] = client.retry_count
+        module.exit_json(**result)
+
+    karaf_home = karaf_home_path(module.params["client_bin"])
+    running = is_running(module, karaf_home)
+
+    if state == 'stopped' and running or state == 'restarted':
+        result['changed'] = True
+        if not module.check_mode and running:
+            result['stop_time'] = stop_root(module, karaf_home, host, port, timeout)
+    if state == 'started' and not running or state == 'restarted':
+        result['changed'] = True
+        if not module.check_mode:
+            result['startup_time'] = start_root(module, karaf_home, host, port,
+                                                module.params["ready_pattern"], timeout)
+
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.karaf import karaf_argument_spec, karaf_client, parse_mvn_url, ensure_dir
+from ansible.module_utils.karaf import parse_name_list
+import hashlib
+import os.path
+
+"""
+Ansible module to manage karaf archives
+(c) 2017, Matthieu Rémy <remy.matthieu@gmail.com>
+"""
+
+DOCUMENTATION = '''
+---
+module: karaf_kar
+short_description: Install, upgrade or uninstall Karaf archives (KAR).
+description:
+    - Install, upgrade or uninstall a KAR with kar:install and kar:uninstall.
+    - A checksum of the archive is stored under the karaf data directory. When the archive is installed and its
+      checksum did not change, nothing is done. When it changed, the archive is uninstalled and installed again
+      in a single console call.
+    - Without a karaf installation on the managed host, e.g. with transport 'ssh' from another host, no checksum
+      is stored and an archive listed by kar:list is left alone.
+options:
+    url:
+        description:
+            - url of the archive, e.g. 'file:/tmp/my-app-1.0.kar' or 'mvn:com.example/my-app/1.0/kar'. An absolute
+              path is installed as a file url
+        required: true if state is "present"
+        default: null
+    name:
+        description:
+            - name of the archive in kar:list. Defaults to the file name of url without the .kar extension,
+              or 'artifact-version' for a maven url
+        required: false
+        default: null
+    checksum:
+        description:
+            - checksum of the archive content. Computed from the file for 'file:' urls and local paths.
+              When there is no checksum, an installed archive is never upgraded
+        required: false
+        default: null
+    state:
+        description:
+            - archive state
+        required: false
+        default: present
+        choices: [ "present", "absent" ]
+    client_bin:
+        description:
+            - path to the 'client' program in karaf, can also point to the root of the karaf installation '/opt/karaf'
+        required: false
+        default: /opt/karaf/bin/client
+    retries:
+        description:
+            - number of times a transient failure (container restarting, timeout, lock contention) is retried
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - initial delay in seconds between two retries, doubled on every attempt
+        required: false
+        default: 2
+    transport:
+        description:
+            - how to reach the karaf console. 'client' runs the karaf client program on the managed host,
+              'ssh' connects to the karaf ssh console directly and needs no JVM, only the paramiko python library
+            - 'jolokia' reads bundles, features, repositories and configurations, and starts or stops bundles,
+              through a Jolokia agent. Other commands, configuration changes included, go through the client
+              program if it is installed, over ssh otherwise
+        required: false
+        default: client
+        choices: [ "client", "ssh", "jolokia" ]
+    jolokia_url:
+        description:
+            - url of the Jolokia agent, when transport is 'jolokia'. user and password are used to authenticate
+        required: false
+        default: http://localhost:8181/jolokia
+    validate_certs:
+        description:
+            - validate the certificate of an https jolokia_url
+        required: false
+        default: true
+    host:
+        description:
+            - host of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: localhost
+    port:
+        description:
+            - port of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: 8101
+    user:
+        description:
+            - user of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: karaf
+    password:
+        description:
+            - password of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    private_key:
+        description:
+            - private key file of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    connect_timeout:
+        description:
+            - ssh connection timeout in seconds, when transport is 'ssh'
+        required: false
+        default: 10
+    host_key_checking:
+        description:
+            - check the host key of the karaf ssh console against the system known_hosts and known_hosts, when
+              transport is 'ssh'. When false, an unknown host key is accepted, and saved to known_hosts if set
+        required: false
+        default: true
+    known_hosts:
+        description:
+            - known_hosts file checked on top of the system one, when transport is 'ssh'
+        required: false
+        default: null
+    lock_timeout:
+        description:
+            - how long to wait, in seconds, for another module run changing the same karaf installation. Changes
+              take a host local lock under the karaf data directory, listings do not
+        required: false
+        default: 600
+'''
+
+EXAMPLES = '''
+# Install or upgrade a karaf archive
+- karaf_kar: state="present" url="file:/opt/deploy/my-app-1.0.kar"
+
+# Install a karaf archive from maven, upgraded when the given checksum changes
+- karaf_kar: state="present" url="mvn:com.example/my-app/1.0/kar" checksum="{{ my_app_sha256 }}"
+
+# Uninstall karaf archive
+- karaf_kar: state="absent" name="my-app-1.0"
+'''
+
+CLIENT_KARAF_COMMAND = "kar:{0}"
+CLIENT_KARAF_COMMAND_WITH_ARGS = "kar:{0} {1}"
+
+
+def kar_name(url):
+    """Name karaf gives to the archive installed from url"""
+    coordinates = parse_mvn_url(url)
+    if coordinates is not None:
+        return '%s-%s' % (coordinates[1], coordinates[2])
+
+    name = os.path.basename(url.rstrip('/'))
+    if name.endswith('.kar'):
+        name = name[:-len('.kar')]
+    return name
+
+
+def kar_url(url):
+    """Url kar:install understands: a bare local path becomes a file: url"""
+    if os.path.isabs(url):
+        return 'file:' + url
+    return url
+
+
+def kar_local_path(url):
+    """Local file of the archive, or None if it is not a local file"""
+    if url.startswith('file:'):
+        path = url[len('file:'):]
+        if path.startswith('//'):
+            path = path[len('//'):]
+        return path
+    return None
+
+
+def kar_checksum(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def checksum_path(client, name):
+    if client.karaf_home is None:
+        return None
+    return os.path.join(client.karaf_home, 'data', 'ansible', 'kar', name + '.sha256')
+
+
+def read_checksum(client, name):
+    path = checksum_path(client, name)
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+def write_checksum(client, name, checksum):
+    path = checksum_path(client, name)
+    if path is None:
+        return
+
+    if checksum is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    try:
+        ensure_dir(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(checksum)
+    except (IOError, OSError) as e:
+        client.module.fail_json(msg='Can not store the checksum in %s: %s' % (path, e.strerror or e),
+                                retries=client.retry_count)
+
+
+def get_existing_kars(client):
+    """List the installed archives
+
+    :param client: karaf client
+    :return: set of archive names
+    """
+    out = client.run_with_check(CLIENT_KARAF_COMMAND.format('list'), raw=True)
+    return set(parse_name_list(out, b'KAR Name'))
+
+
+def install_kar(client, module, url, name, upgrade):
+    """Call karaf client command to install an archive
+
+    :param client: karaf client
+    :param module: ansible module
+    :param url: url of the archive
+    :param name: name of the archive
+    :param upgrade: uninstall the installed archive first, in the same call
+    :return: command, ouput command message, error command message
+    """
+    cmds = []
+    if upgrade:
+        cmds.append(CLIENT_KARAF_COMMAND_WITH_ARGS.format('uninstall', name))
+    cmds.append(CLIENT_KARAF_COMMAND_WITH_ARGS.format('install', url))
+    cmd = ' && '.join(cmds)
+
+    result = dict(
+        changed=True,
+        original_message='',
+        message='',
+        name=name,
+        upgraded=upgrade,
+        cmd=cmd,
+    )
+
+    if module.check_mode:
+        return result
+
+    result['out'] = client.run_with_check(cmd)
+
+    if name not in get_existing_kars(client):
+        module.fail_json(msg='Archive ("%s") did not install' % name, retries=client.retry_count)
+
+    return result
+
+
+def uninstall_kar(client, module, name):
+    """Call karaf client command to uninstall an archive
+
+    :param client: karaf client
+    :param module: ansible module
+    :param name: name of the archive
+    :return: command, ouput command message, error command message
+    """
+    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format('uninstall', name)
+
+    result = dict(
+        changed=True,
+        original_message='',
+        message='',
+        name=name,
+        cmd=cmd,
+    )
+
+    if module.check_mode:
+        return result
+
+    result['out'] = client.run_with_check(cmd)
+    return result
+
+
+def main():
+    argument_spec = karaf_argument_spec()
+    argument_spec.update(
+        url=dict(default=None),
+        name=dict(default=None),
+        checksum=dict(default=None),
+        state=dict(default="present", choices=["present", "absent"])
+    )
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        required_one_of=[["url", "name"]],
+        required_if=[["state", "present", ["url"]]],
+        supports_check_mode=True
+    )
+
+    url = kar_url(module.params["url"]) if module.params["url"] else None
+    state = module.params["state"]
+    name = module.params["name"] or kar_name(url)
+    checksum = module.params["checksum"]
+
+    client = karaf_client(module)
+
+    existing_kars = get_existing_kars(client)
+
+    result = dict(
+        changed=False,
+        original_message='',
+        message='',
+        name=name,
+    )
+
+    if state == "present":
+        if checksum is None:
+            path = kar_local_path(url)
+            if path is not None:
+                if not os.path.isfile(path):
+                    module.fail_json(msg='Archive not found: %s' % path)
+                checksum = kar_checksum(path)
+
+        installed = name in existing_kars
+        stored_checksum = read_checksum(client, name) if installed else None
+        # Without a local karaf installation the checksum can not be stored,
+        # only kar:list tells whether the archive is installed
+        unchanged = installed and (checksum is None or checksum_path(client, name) is None
+                                   or checksum == stored_checksum)
+
+        if not unchanged:
+            result = install_kar(client, module, url, name, installed)
+            if not module.check_mode:
+                write_checksum(client, name, checksum)
+        result['checksum'] = checksum
+
+    elif state == "absent" and name in existing_kars:
+        result = uninstall_kar(client, module, name)
+        if not module.check_mode:
+            write_checksum(client, name, None)
+
+    result['retries'] = client.retry_count
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from ansible.module_utils.basic import *
+from ansible.module_utils.karaf import karaf_argument_spec, karaf_client, run_batch
+from ansible.module_utils.karaf import list_log_levels, quote_console_arg, LOG_LEVEL_DEFAULT
+
+"""
+Ansible module to manage karaf logger levels
+(c) 2017, Matthieu Rémy <remy.matthieu@gmail.com>
+"""
+
+DOCUMENTATION = '''
+---
+module: karaf_log
+short_description: Set or restore the level of Karaf loggers.
+description:
+    - Set the level of one or more loggers with log:set. The current levels are read once with log:get ALL and
+      only the loggers at another level are changed, in a single console call.
+    - The levels the loggers had before are returned in 'previous', so that a later task can restore them all
+      at once.
+options:
+    levels:
+        description:
+            - dictionary of logger name to its level. ROOT is the root logger. DEFAULT, or a null value, removes
+              the level of the logger so that it inherits the level of its parent. An unquoted OFF, which YAML reads
+              as false, is taken as OFF
+        required: true
+        type: dict
+    client_bin:
+        description:
+            - path to the 'client' program in karaf, can also point to the root of the karaf installation '/opt/karaf'
+        required: false
+        default: /opt/karaf/bin/client
+    retries:
+        description:
+            - number of times a transient failure (container restarting, timeout, lock contention) is retried
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - initial delay in seconds between two retries, doubled on every attempt
+        required: false
+        default: 2
+    transport:
+        description:
+            - how to reach the karaf console. 'client' runs the karaf client program on the managed host,
+              'ssh' connects to the karaf ssh console directly and needs no JVM, only the paramiko python library
+            - 'jolokia' reads bundles, features, repositories and configurations, and starts or stops bundles,
+              through a Jolokia agent. Other commands, configuration changes included, go through the client
+              program if it is installed, over ssh otherwise
+        required: false
+        default: client
+        choices: [ "client", "ssh", "jolokia" ]
+    jolokia_url:
+        description:
+            - url of the Jolokia agent, when transport is 'jolokia'. user and password are used to authenticate
+        required: false
+        default: http://localhost:8181/jolokia
+    validate_certs:
+        description:
+            - validate the certificate of an https jolokia_url
+        required: false
+        default: true
+    host:
+        description:
+            - host of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: localhost
+    port:
+        description:
+            - port of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: 8101
+    user:
+        description:
+            - user of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: karaf
+    password:
+        description:
+            - password of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    private_key:
+        description:
+            - private key file of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    connect_timeout:
+        description:
+            - ssh connection timeout in seconds, when transport is 'ssh'
+        required: false
+        default: 10
+    host_key_checking:
+        description:
+            - check the host key of the karaf ssh console against the system known_hosts and known_hosts, when
+              transport is 'ssh'. When false, an unknown host key is accepted, and saved to known_hosts if set
+        required: false
+        default: true
+    known_hosts:
+        description:
+            - known_hosts file checked on top of the system one, when transport is 'ssh'
+        required: false
+        default: null
+    lock_timeout:
+        description:
+            - how long to wait, in seconds, for another module run changing the same karaf installation. Changes
+              take a host local lock under the karaf data directory, listings do not
+        required: false
+        default: 600
+'''
+
+EXAMPLES = '''
+# Debug the application during the deployment, then restore the levels
+- karaf_log:
+    levels:
+      com.example.app: DEBUG
+      org.apache.camel: DEBUG
+  register: debug_logs
+
+- karaf_bundle: state="present" url="mvn:com.example/app/1.0"
+
+- karaf_log:
+    levels: "{{ debug_logs.previous }}"
+'''
+
+LOG_LEVELS = ['TRACE', 'DEBUG', 'INFO', 'WARN', 'ERROR', 'OFF', LOG_LEVEL_DEFAULT]
+ROOT_LOGGER = 'ROOT'
+
+
+def desired_levels(module, levels):
+    """Normalize the levels option
+
+    :param module: ansible module
+    :param levels: dict of logger name to its level
+    :return: dict of logger name to its upper case level
+    """
+    result = {}
+    for logger, level in levels.items():
+        # YAML 1.1 reads an unquoted OFF as false
+        if level is False:
+            level = 'OFF'
+        level = str(level).upper() if level is not None else LOG_LEVEL_DEFAULT
+        if level not in LOG_LEVELS:
+            module.fail_json(msg='Invalid level %s for logger %s, expected one of: %s'
+                             % (level, logger, ', '.join(LOG_LEVELS)))
+        if level == LOG_LEVEL_DEFAULT and logger == ROOT_LOGGER:
+            module.fail_json(msg='The ROOT logger can not be reset to DEFAULT')
+        result[logger] = level
+    return result
+
+
+def set_log_levels(client, module, changes):
+    """Call karaf client command to set the level of loggers
+
+    :param client: karaf client
+    :param module: ansible module
+    :param changes: dict of logger name to its level
+    :return: results of the chunks
+    """
+    loggers = sorted(changes)
+    cmds = ['log:set %s %s' % (changes[logger], quote_console_arg(logger)) for logger in loggers]
+    return run_batch(client, loggers, cmds)
+
+
+def main():
+    argument_spec = karaf_argument_spec()
+    argument_spec.update(
+        levels=dict(required=True, type="dict")
+    )
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        supports_check_mode=True
+    )
+
+    levels = desired_levels(module, module.params["levels"])
+
+    client = karaf_client(module)
+
+    # Loggers without a level of their own are not listed
+    current = list_log_levels(client)
+    previous = dict((logger, current.get(logger, LOG_LEVEL_DEFAULT)) for logger in levels)
+    changes = dict((logger, level) for logger, level in levels.items() if previous[logger] != level)
+
+    result = dict(
+        changed=bool(changes),
+        levels=levels,
+        previous=previous,
+        updated=sorted(changes),
+    )
+
+    if changes and not module.check_mode:
+        result['chunks'] = set_log_levels(client, module, changes)
+
+    result['retries'] = client.retry_count
+    module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
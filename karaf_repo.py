@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from ansible.module_utils.basic import *
-import os.path
+from ansible.module_utils.karaf import karaf_argument_spec, karaf_client, list_repos, karaf_home_path, offline_repo
 
 """
 Ansible module to manage karaf repositories
@@ -26,11 +26,95 @@ options:
         required: false
         default: present
         choices: [ "present", "absent", "refresh" ]
+    offline:
+        description:
+            - edit featuresRepositories in etc/org.apache.karaf.features.cfg instead of talking to a running
+              container, so that the repository is known when karaf first boots. Only for state present and absent.
+              The karaf installation is found from client_bin
+        required: false
+        default: false
     client_bin:
         description:
             - path to the 'client' program in karaf, can also point to the root of the karaf installation '/opt/karaf'
         required: false
         default: /opt/karaf/bin/client
+    retries:
+        description:
+            - number of times a transient failure (container restarting, timeout, lock contention) is retried
+        required: false
+        default: 3
+    retry_delay:
+        description:
+            - initial delay in seconds between two retries, doubled on every attempt
+        required: false
+        default: 2
+    transport:
+        description:
+            - how to reach the karaf console. 'client' runs the karaf client program on the managed host,
+              'ssh' connects to the karaf ssh console directly and needs no JVM, only the paramiko python library
+            - 'jolokia' reads bundles, features, repositories and configurations, and starts or stops bundles,
+              through a Jolokia agent. Other commands, configuration changes included, go through the client
+              program if it is installed, over ssh otherwise
+        required: false
+        default: client
+        choices: [ "client", "ssh", "jolokia" ]
+    jolokia_url:
+        description:
+            - url of the Jolokia agent, when transport is 'jolokia'. user and password are used to authenticate
+        required: false
+        default: http://localhost:8181/jolokia
+    validate_certs:
+        description:
+            - validate the certificate of an https jolokia_url
+        required: false
+        default: true
+    host:
+        description:
+            - host of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: localhost
+    port:
+        description:
+            - port of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: 8101
+    user:
+        description:
+            - user of the karaf ssh console, when transport is 'ssh'
+        required: false
+        default: karaf
+    password:
+        description:
+            - password of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    private_key:
+        description:
+            - private key file of the karaf ssh console user, when transport is 'ssh'
+        required: false
+        default: null
+    connect_timeout:
+        description:
+            - ssh connection timeout in seconds, when transport is 'ssh'
+        required: false
+        default: 10
+    host_key_checking:
+        description:
+            - check the host key of the karaf ssh console against the system known_hosts and known_hosts, when
+              transport is 'ssh'. When false, an unknown host key is accepted, and saved to known_hosts if set
+        required: false
+        default: true
+    known_hosts:
+        description:
+            - known_hosts file checked on top of the system one, when transport is 'ssh'
+        required: false
+        default: null
+    lock_timeout:
+        description:
+            - how long to wait, in seconds, for another module run changing the same karaf installation. Changes
+              take a host local lock under the karaf data directory, listings do not
+        required: false
+        default: 600
 '''
 
 EXAMPLES = '''
@@ -42,6 +126,9 @@ EXAMPLES = '''
 
 # Refresh karaf repo
 - karaf_repo: state="refresh" url="mvn:org.apache.camel.karaf/apache-camel/2.18.1/xml/features"
+
+# Add karaf repo before karaf is started
+- karaf_repo: state="present" url="mvn:org.apache.camel.karaf/apache-camel/2.18.1/xml/features" offline=true
 '''
 
 STATE_PRESENT = "present"
@@ -55,56 +142,19 @@ PACKAGE_STATE_MAP = dict(
 
 )
 
-CLIENT_KARAF_COMMAND = "{0} 'feature:{1}'"
-CLIENT_KARAF_COMMAND_WITH_ARGS = "{0} 'feature:{1} {2}'"
+CLIENT_KARAF_COMMAND = "feature:{0}"
+CLIENT_KARAF_COMMAND_WITH_ARGS = "feature:{0} {1}"
 
-_KARAF_COLUMN_SEPARATOR = '\xe2\x94\x82'
-
-def run_with_check(module, cmd):
-    rc, out, err = module.run_command(cmd)
-    
-    bundle_id = None
-    if  rc != 0 or \
-        'Error executing command' in out or \
-        'Command not found' in out:
-        reason = out
-        module.fail_json(msg=reason)
-        raise Exception(out)
-
-    return out
-
-def get_existing_repos(module, client_bin):
-    karaf_cmd = '%s "feature:repo-list"'
-    out = run_with_check(module, karaf_cmd % (client_bin,))
-    
-    existing_repos = {}
-    
-    for line in out.split('\n'):
-        split = line.split(_KARAF_COLUMN_SEPARATOR)
-
-        if len(split) != 2:
-            continue
-        
-        repo_name = split[0].strip()
-        repo_url = split[1].strip()
-        
-        existing_repos[repo_url] = {
-                'name': repo_name,
-                'url': repo_url,
-            }
-
-    return existing_repos
-
-def add_repo(client_bin, module, repo_url):
+def add_repo(client, module, repo_url):
     """Call karaf client command to add a repo
 
-    :param client_bin: karaf client command bin
+    :param client: karaf client
     :param module: ansible module
     :param repo_url: url of repo to add
     :return: command, ouput command message, error command message
     """
-    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format(client_bin, PACKAGE_STATE_MAP[STATE_PRESENT], repo_url)
-    out = run_with_check(module, cmd)
+    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format(PACKAGE_STATE_MAP[STATE_PRESENT], repo_url)
+    out = client.run_with_check(cmd)
 
     result = dict(
         changed=True,
@@ -115,7 +165,7 @@ def add_repo(client_bin, module, repo_url):
         cmd = cmd,
     )
 
-    repos = get_existing_repos(module, client_bin)
+    repos = list_repos(client)
     if repo_url not in repos:
         module.fail_json(msg='Repo ("%s") did not install' % repo_url)
         raise Exception(out)
@@ -123,16 +173,16 @@ def add_repo(client_bin, module, repo_url):
     return result
 
 
-def remove_repo(client_bin, module, repo_url):
+def remove_repo(client, module, repo_url):
     """Call karaf client command to remove a repo
 
-    :param client_bin: karaf client command bin
+    :param client: karaf client
     :param module: ansible module
     :param repo_url: url of repo to remove
     :return: command, ouput command message, error command message
     """
-    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format(client_bin, PACKAGE_STATE_MAP[STATE_ABSENT], repo_url)
-    out = run_with_check(module, cmd)
+    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format(PACKAGE_STATE_MAP[STATE_ABSENT], repo_url)
+    out = client.run_with_check(cmd)
 
     result = dict(
         changed=True,
@@ -143,7 +193,7 @@ def remove_repo(client_bin, module, repo_url):
         cmd = cmd,
     )
 
-    repos = get_existing_repos(module, client_bin)
+    repos = list_repos(client)
     if repo_url in repos:
         module.fail_json(msg='Repo ("%s") is still installed' % repo_url)
         raise Exception(out)
@@ -151,16 +201,16 @@ def remove_repo(client_bin, module, repo_url):
     return result
 
 
-def refresh_repo(client_bin, module, repo_url):
+def refresh_repo(client, module, repo_url):
     """Call karaf client command to refresh a repository
 
-    :param client_bin: karaf client command bin
+    :param client: karaf client
     :param module: ansible module
     :param repo_url: url of repo to remove
     :return: command, ouput command message, error command message
     """
-    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format(client_bin, PACKAGE_STATE_MAP[STATE_REFRESH], repo_url)
-    out = run_with_check(module, cmd)
+    cmd = CLIENT_KARAF_COMMAND_WITH_ARGS.format(PACKAGE_STATE_MAP[STATE_REFRESH], repo_url)
+    out = client.run_with_check(cmd)
     
     result = dict(
         changed=True,
@@ -173,40 +223,29 @@ def refresh_repo(client_bin, module, repo_url):
 
     return result
 
-def parse_error(string):
-    reason = "reason: "
-    try:
-        return string[string.index(reason) + len(reason):].strip()
-    except ValueError:
-        return string
-
-def check_client_bin_path(client_bin):
-    if os.path.isfile(client_bin):
-        return client_bin
-    
-    if os.path.isdir(client_bin):
-        test = os.path.join(client_bin, 'bin/client')
-        if os.path.isfile(test):
-            return test
-    else:
-        raise Exception('client_bin parameter not supported: %s' % client_bin)
-
 def main():
+    argument_spec = karaf_argument_spec()
+    argument_spec.update(
+        url=dict(required=True),
+        state=dict(default="present", choices=PACKAGE_STATE_MAP.keys()),
+        offline=dict(default=False, type="bool")
+    )
     module = AnsibleModule(
-        argument_spec=dict(
-            url=dict(required=True),
-            state=dict(default="present", choices=PACKAGE_STATE_MAP.keys()),
-            client_bin=dict(default="/opt/karaf/bin/client", type="path")
-        )
+        argument_spec=argument_spec
     )
 
     url = module.params["url"]
     state = module.params["state"]
-    client_bin = module.params["client_bin"]
 
-    client_bin = check_client_bin_path(client_bin)
+    if module.params["offline"]:
+        if state == STATE_REFRESH:
+            module.fail_json(msg='A repository can not be refreshed offline')
+        changed = offline_repo(module, karaf_home_path(module.params["client_bin"]), url, state)
+        module.exit_json(changed=changed, url=url, state=state, offline=True)
+
+    client = karaf_client(module)
     
-    existing_repos = get_existing_repos(module, client_bin)
+    existing_repos = list_repos(client)
 
     result = dict(
         changed=False,
@@ -215,15 +254,16 @@ def main():
     )
     
     if state == STATE_PRESENT and url not in existing_repos:
-        result = add_repo(client_bin, module, url)
+        result = add_repo(client, module, url)
     elif state == STATE_ABSENT and url in existing_repos:
-        result = remove_repo(client_bin, module, url)
+        result = remove_repo(client, module, url)
     elif state == STATE_REFRESH:
         if url not in existing_repos:
             module.fail_json(msg='The given repository ("%s") is not available and can therefore not be refreshed' % url)
         else:
-            result = refresh_repo(client_bin, module, url)
+            result = refresh_repo(client, module, url)
 
+    result['retries'] = client.retry_count
     module.exit_json(**result)
 
 if __name__ == '__main__':
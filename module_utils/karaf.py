@@ -0,0 +1,1882 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shared helpers for the karaf ansible modules
+(c) 2017, Matthieu Rémy <remy.matthieu@gmail.com>
+"""
+
+import base64
+import collections
+import contextlib
+import errno
+import hashlib
+import json
+import numbers
+import os
+import os.path
+import re
+import subprocess
+import time
+
+try:
+    import paramiko
+    HAS_PARAMIKO = True
+except ImportError:
+    HAS_PARAMIKO = False
+
+try:
+    import http.client as httplib
+    from urllib.parse import urlparse
+except ImportError:
+    import httplib
+    from urlparse import urlparse
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+ERROR_TRANSIENT = 'transient'
+ERROR_NOT_FOUND = 'not_found'
+ERROR_RESOLUTION = 'resolution'
+ERROR_SYNTAX = 'syntax'
+ERROR_LOCK = 'lock'
+ERROR_UNKNOWN = 'error'
+
+
+class KarafError(Exception):
+    """Error reported by the karaf client or console"""
+    kind = ERROR_UNKNOWN
+
+    def __init__(self, reason, out='', rc=None):
+        Exception.__init__(self, reason)
+        self.reason = reason
+        self.out = out
+        self.rc = rc
+
+
+class KarafTransientError(KarafError):
+    """Container not reachable yet, timeout or lock contention. Worth a retry."""
+    kind = ERROR_TRANSIENT
+
+
+class KarafLockError(KarafError):
+    """Another module run kept the karaf lock for too long"""
+    kind = ERROR_LOCK
+
+
+class KarafNotFoundError(KarafError):
+    """Feature, bundle, repository or pid does not exist"""
+    kind = ERROR_NOT_FOUND
+
+
+class KarafCommandNotFoundError(KarafNotFoundError):
+    """The console does not know the command: a typo, or a feature providing it is missing"""
+
+
+class KarafResolutionError(KarafError):
+    """The OSGi resolver could not satisfy the requirements"""
+    kind = ERROR_RESOLUTION
+
+
+class KarafSyntaxError(KarafError):
+    """The console rejected the command line itself"""
+    kind = ERROR_SYNTAX
+
+
+# Checked in order, the first match wins. Resolution errors often embed
+# "not found" or "timeout" in the nested cause, so they come first.
+_ERROR_PATTERNS = [
+    (KarafResolutionError, re.compile(
+        r'Unable to resolve|missing requirement|Uses constraint violation|'
+        r'Resolution failed|Could not start bundle .* Unresolved', re.I)),
+    (KarafNotFoundError, re.compile(
+        r'No feature named|No matching bundles|Bundle .* (is )?not (found|installed)|'
+        r'Unable to find|does not exist|Repository .* not found|'
+        r'No configuration found|Pid .* not found', re.I)),
+    (KarafSyntaxError, re.compile(
+        r'Unknown option|Too many arguments|Argument .* is required|'
+        r'Syntax error|Error parsing|Invalid argument|Unexpected token', re.I)),
+    (KarafTransientError, re.compile(
+        r'Connection refused|Connection reset|'
+        r'Failed to get the session|Connection closed|Broken pipe|ConnectException|'
+        r'timed out|Timeout|Resource temporarily unavailable|'
+        r'Unable to (acquire|obtain) lock|lock (is )?(held|contention)|'
+        r'Karaf is (still )?starting|SshException|Unable to connect', re.I)),
+]
+
+
+# "Command not found: feature:list" is what the console answers while the core
+# shell commands are still being registered during startup. A missing command
+# of another namespace is a typo, or a feature that is not installed.
+_COMMAND_NOT_FOUND = re.compile(r'Command not found:?\s*(?:([\w-]+):)?')
+_CORE_COMMAND_SCOPES = ('feature', 'features', 'bundle', 'osgi', 'config', 'system', 'shell')
+
+
+def parse_error(string):
+    reason = "reason: "
+    try:
+        return string[string.index(reason) + len(reason):].strip()
+    except ValueError:
+        return string.strip()
+
+
+_FAILURE_MARKERS = ('Error executing command', 'Command not found')
+_FAILURE_MARKERS_BYTES = tuple(marker.encode('ascii') for marker in _FAILURE_MARKERS)
+
+
+def classify_error(rc, out, err=''):
+    """Map the result of a client call to a typed error.
+
+    :param rc: return code of the client
+    :param out: standard output of the client, text or raw bytes
+    :param err: standard error of the client
+    :return: a KarafError instance, or None if the call succeeded
+    """
+    # Raw output is only decoded when the call failed
+    markers = _FAILURE_MARKERS_BYTES if isinstance(out, bytes) else _FAILURE_MARKERS
+    failed = rc != 0 or any(marker in out for marker in markers)
+
+    if not failed:
+        return None
+
+    out = _to_text(out)
+    text = '\n'.join(_to_text(s) for s in (out, err) if s)
+    reason = parse_error(text)
+
+    for error_class, pattern in _ERROR_PATTERNS:
+        if pattern.search(text):
+            return error_class(reason, out, rc)
+
+    match = _COMMAND_NOT_FOUND.search(text)
+    if match:
+        if match.group(1) in _CORE_COMMAND_SCOPES:
+            return KarafTransientError(reason, out, rc)
+        return KarafCommandNotFoundError(reason, out, rc)
+
+    return KarafError(reason, out, rc)
+
+
+LOCK_TIMEOUT = 600
+LOCK_POLL_INTERVAL = 0.2
+
+# Console commands that only read, and run without the lock
+_READ_ONLY_COMMAND = re.compile(
+    r'^([\w-]+:)?([\w-]*list|get|status|info|headers|display|tree-show|exports|imports|version)$'
+)
+
+
+def is_read_only_command(karaf_cmd):
+    """Whether every command of a (chained) console command line only reads"""
+    for part in re.split(r'&&|\n', karaf_cmd):
+        words = part.split()
+        if words and not _READ_ONLY_COMMAND.match(words[0]):
+            return False
+    return True
+
+
+def ensure_dir(path):
+    """Create a directory and its parents, unless it exists
+
+    Another module run may create it at the same time, which is fine.
+
+    :raise OSError: when the directory can not be created
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+class KarafLock(object):
+    """Host local advisory lock on a karaf installation
+
+    Every module run that changes the container takes it, so that parallel
+    plays, or async tasks, do not install or refresh at the same time. The
+    lock is reentrant within a module run, and is a no-op when the karaf
+    installation is not on the managed host.
+    """
+
+    def __init__(self, karaf_home, timeout=LOCK_TIMEOUT):
+        self.path = os.path.join(karaf_home, 'data', 'ansible', 'karaf.lock') if karaf_home else None
+        self.timeout = timeout
+        self._fd = None
+        self._depth = 0
+
+    def acquire(self):
+        """Take the lock, waiting at most timeout seconds
+
+        :raise KarafLockError: when the lock is still held after timeout, or
+                               the lock file can not be created
+        """
+        if self.path is None or fcntl is None:
+            return
+        if self._depth:
+            self._depth += 1
+            return
+
+        try:
+            ensure_dir(os.path.dirname(self.path))
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            raise KarafLockError('Can not create the lock %s: %s' % (self.path, e.strerror or e))
+
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    raise
+            if time.time() >= deadline:
+                os.close(fd)
+                raise KarafLockError('Timeout after %ss waiting for the lock %s' % (self.timeout, self.path))
+            time.sleep(LOCK_POLL_INTERVAL)
+
+        self._fd = fd
+        self._depth = 1
+
+    def release(self):
+        if self._fd is None:
+            return
+        self._depth -= 1
+        if self._depth == 0:
+            # Closing the file releases the lock
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+        return False
+
+
+@contextlib.contextmanager
+def karaf_lock(module, karaf_home):
+    """Hold the lock of a karaf installation, failing the module on timeout
+
+    :param module: ansible module, with the lock_timeout option
+    :param karaf_home: root of the karaf installation
+    """
+    lock = KarafLock(karaf_home, module.params["lock_timeout"])
+    try:
+        lock.acquire()
+    except KarafLockError as e:
+        module.fail_json(msg=e.reason, error_type=e.kind)
+    try:
+        yield lock
+    finally:
+        lock.release()
+
+
+_NO_LOCK = KarafLock(None)
+
+# Lines of a streamed output kept to classify an error
+STREAM_TAIL_LINES = 20
+
+
+# MBean operations that only read
+_JOLOKIA_READ_OPERATIONS = ('listProperties',)
+
+
+class KarafClient(object):
+    """Runs console commands through the karaf 'client' program.
+
+    Transient failures are retried with an exponential backoff, every other
+    error is raised right away.
+    """
+
+    def __init__(self, module, client_bin, retries=3, retry_delay=2):
+        self.module = module
+        self.client_bin = client_bin
+        self.karaf_home = os.path.dirname(os.path.dirname(client_bin)) if client_bin else None
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.retry_count = 0
+        # JolokiaConnection serving the listings, when transport is 'jolokia'
+        self.jolokia = None
+        # KarafLock taken by the commands that change the container
+        self.lock = KarafLock(self.karaf_home)
+
+    def execute(self, karaf_cmd, stdin=False, raw=False):
+        """Run a console command once
+
+        :param karaf_cmd: console command line
+        :param stdin: send the command on the standard input of the client
+                      (batch mode) instead of the command line
+        :param raw: return the standard output as undecoded bytes
+        :return: return code, standard output, standard error
+        """
+        kwargs = dict(encoding=None) if raw else {}
+        if stdin:
+            return self.module.run_command([self.client_bin, '-b'], data=karaf_cmd, **kwargs)
+        return self.module.run_command([self.client_bin, karaf_cmd], **kwargs)
+
+    def run(self, karaf_cmd, stdin=False, raw=False):
+        """Run a console command
+
+        :param karaf_cmd: console command line, e.g. 'feature:list -i'
+        :param stdin: send the command on the standard input of the client
+        :param raw: return the output as undecoded bytes, for the table parsers
+        :return: output of the command
+        :raise KarafError: when the command fails
+        """
+        def run_once():
+            # The lock is taken for every attempt, not while waiting for a retry
+            with self.locked(not is_read_only_command(karaf_cmd)):
+                rc, out, err = self.execute(karaf_cmd, stdin, raw)
+            error = classify_error(rc, out, err)
+            if error is not None:
+                raise error
+            return out
+
+        return self.retry(run_once)
+
+    def locked(self, mutating=True):
+        """Context holding the lock when mutating, doing nothing otherwise"""
+        return self.lock if mutating else _NO_LOCK
+
+    def stream(self, karaf_cmd):
+        """Run a console command and iterate over its output, line by line
+
+        The output is never held in memory, only its last lines are kept to
+        classify an error.
+
+        :param karaf_cmd: console command line
+        :return: generator of lines, without the line ending
+        :raise KarafError: once the output is consumed, when the command failed
+        """
+        proc = subprocess.Popen([self.client_bin, karaf_cmd], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        tail = collections.deque(maxlen=STREAM_TAIL_LINES)
+        try:
+            for line in iter(proc.stdout.readline, b''):
+                line = _to_text(line).rstrip('\r\n')
+                tail.append(line)
+                yield line
+        finally:
+            proc.stdout.close()
+            rc = proc.wait()
+
+        error = classify_error(rc, '\n'.join(tail))
+        if error is not None:
+            raise error
+
+    def retry(self, action):
+        """Call action, retrying it while it raises a KarafTransientError
+
+        A missing command is retried too right after a transient error, as the
+        container was still starting.
+
+        :param action: function without arguments
+        :return: what action returns
+        """
+        attempt = 0
+        starting = False
+        while True:
+            try:
+                return action()
+            except KarafCommandNotFoundError:
+                if not starting or attempt >= self.retries:
+                    raise
+            except KarafTransientError:
+                starting = True
+                if attempt >= self.retries:
+                    raise
+
+            time.sleep(self.retry_delay * (2 ** attempt))
+            attempt += 1
+            self.retry_count += 1
+
+    def request_with_check(self, requests):
+        """Send Jolokia requests and fail the module on error
+
+        :param requests: list of Jolokia requests
+        :return: list of values
+        """
+        mutating = any(r['type'] == 'exec' and r['operation'] not in _JOLOKIA_READ_OPERATIONS for r in requests)
+
+        def request_once():
+            with self.locked(mutating):
+                return self.jolokia.request(requests)
+
+        try:
+            return self.retry(request_once)
+        except KarafError as e:
+            self.fail(e)
+
+    def run_with_check(self, karaf_cmd, raw=False):
+        """Run a console command and fail the module on error
+
+        :param karaf_cmd: console command line
+        :param raw: return the output as undecoded bytes
+        :return: output of the command
+        """
+        try:
+            return self.run(karaf_cmd, raw=raw)
+        except KarafError as e:
+            self.fail(e)
+
+    def fail(self, error):
+        self.module.fail_json(
+            msg=error.reason,
+            error_type=error.kind,
+            retries=self.retry_count,
+            stdout=error.out
+        )
+
+
+if HAS_PARAMIKO:
+    class _RejectUnknownHostKeyPolicy(paramiko.MissingHostKeyPolicy):
+        """Refuses a host missing from known_hosts, with an error that is not retried"""
+
+        def missing_host_key(self, client, hostname, key):
+            raise KarafError(
+                'Host key of %s is not in known_hosts, add it with ssh-keyscan, set known_hosts, '
+                'or disable host_key_checking to accept it' % hostname
+            )
+
+
+class KarafSshClient(KarafClient):
+    """Runs console commands over the karaf ssh console, without a JVM.
+
+    A single ssh connection is opened lazily and shared by every command of
+    the module run.
+    """
+
+    def __init__(self, module, host, port, user, password=None, private_key=None,
+                 connect_timeout=10, client_bin=None, retries=3, retry_delay=2,
+                 host_key_checking=True, known_hosts=None):
+        KarafClient.__init__(self, module, client_bin, retries, retry_delay)
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.private_key = private_key
+        self.connect_timeout = connect_timeout
+        self.host_key_checking = host_key_checking
+        self.known_hosts = known_hosts
+        self._ssh = None
+
+    def connect(self):
+        """Open the ssh connection, checking the host key against known_hosts
+
+        :raise KarafError: when the host key is unknown or does not match
+        """
+        if self._ssh is None:
+            ssh = paramiko.SSHClient()
+            ssh.load_system_host_keys()
+            if self.known_hosts:
+                if not os.path.exists(self.known_hosts):
+                    open(self.known_hosts, 'a').close()
+                # Keys accepted without host_key_checking are saved there too
+                ssh.load_host_keys(self.known_hosts)
+
+            if self.host_key_checking:
+                ssh.set_missing_host_key_policy(_RejectUnknownHostKeyPolicy())
+            else:
+                # Karaf generates its host key on first start
+                ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+
+            try:
+                ssh.connect(
+                    self.host,
+                    port=self.port,
+                    username=self.user,
+                    password=self.password,
+                    key_filename=self.private_key,
+                    timeout=self.connect_timeout,
+                    allow_agent=self.private_key is None and self.password is None,
+                    look_for_keys=False
+                )
+            except paramiko.BadHostKeyException as e:
+                raise KarafError('Host key of %s does not match known_hosts: %s' % (self.host, e))
+            self._ssh = ssh
+        return self._ssh
+
+    def close(self):
+        if self._ssh is not None:
+            self._ssh.close()
+            self._ssh = None
+
+    def execute(self, karaf_cmd, stdin=False, raw=False):
+        # The command always goes over the ssh session, never on a command line
+        if not HAS_PARAMIKO:
+            raise KarafError('paramiko is required to reach the karaf ssh console')
+
+        try:
+            stdin, stdout, stderr = self.connect().exec_command(karaf_cmd)
+            stdin.close()
+            out = stdout.read()
+            if not raw:
+                out = _to_text(out)
+            err = _to_text(stderr.read())
+            rc = stdout.channel.recv_exit_status()
+        except KarafError:
+            self.close()
+            raise
+        except Exception as e:
+            # Reconnect on the next attempt
+            self.close()
+            return 255, b'' if raw else '', '%s: %s' % (type(e).__name__, e)
+
+        return rc, out, err
+
+    def stream(self, karaf_cmd):
+        if not HAS_PARAMIKO:
+            raise KarafError('paramiko is required to reach the karaf ssh console')
+
+        tail = collections.deque(maxlen=STREAM_TAIL_LINES)
+        try:
+            stdin, stdout, stderr = self.connect().exec_command(karaf_cmd)
+            stdin.close()
+            for line in stdout:
+                line = _to_text(line).rstrip('\r\n')
+                tail.append(line)
+                yield line
+            tail.append(_to_text(stderr.read()))
+            rc = stdout.channel.recv_exit_status()
+        except KarafError:
+            self.close()
+            raise
+        except Exception as e:
+            self.close()
+            rc = 255
+            tail.append('%s: %s' % (type(e).__name__, e))
+
+        error = classify_error(rc, '\n'.join(tail))
+        if error is not None:
+            raise error
+
+
+class JolokiaConnection(object):
+    """Bulk requests to the karaf MBeans through a Jolokia agent.
+
+    The HTTP connection is kept alive and reused by every request of the
+    module run.
+    """
+
+    BUNDLE_MBEAN = 'org.apache.karaf:type=bundle,name=root'
+    FEATURE_MBEAN = 'org.apache.karaf:type=feature,name=root'
+    CONFIG_MBEAN = 'org.apache.karaf:type=config,name=root'
+
+    def __init__(self, url, user=None, password=None, timeout=10, validate_certs=True):
+        parsed = urlparse(url)
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.path = parsed.path or '/jolokia'
+        if not self.path.endswith('/'):
+            self.path += '/'
+        self.timeout = timeout
+        self.validate_certs = validate_certs
+        self.headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+        if user:
+            token = base64.b64encode(('%s:%s' % (user, password or '')).encode('utf-8'))
+            self.headers['Authorization'] = 'Basic %s' % token.decode('ascii')
+        self._conn = None
+
+    def connect(self):
+        if self._conn is None:
+            if self.scheme == 'https':
+                context = None
+                if not self.validate_certs and ssl is not None and hasattr(ssl, '_create_unverified_context'):
+                    context = ssl._create_unverified_context()
+                self._conn = httplib.HTTPSConnection(self.netloc, timeout=self.timeout, context=context)
+            else:
+                self._conn = httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def request(self, requests):
+        """Send a bulk request
+
+        :param requests: list of Jolokia requests
+        :return: list of values, in the same order
+        :raise KarafError: when the agent or one of the requests fails
+        """
+        body = json.dumps(requests)
+        try:
+            conn = self.connect()
+            conn.request('POST', self.path, body, self.headers)
+            response = conn.getresponse()
+            status = response.status
+            data = response.read()
+        except Exception as e:
+            self.close()
+            raise KarafTransientError('Jolokia request failed: %s: %s' % (type(e).__name__, e))
+
+        # The agent, or the proxy in front of it, is not up yet
+        if 500 <= status < 600:
+            raise KarafTransientError('Jolokia answered HTTP %s' % status)
+        if status != 200:
+            raise KarafError('Jolokia answered HTTP %s' % status, _to_text(data))
+
+        responses = json.loads(_to_text(data))
+        values = []
+        for response in responses:
+            if response.get('status') != 200:
+                error = response.get('error', 'Jolokia request failed')
+                if response.get('status') == 404:
+                    raise KarafNotFoundError(error)
+                raise KarafError(error)
+            values.append(response.get('value'))
+        return values
+
+    @staticmethod
+    def read(mbean, attribute):
+        return dict(type='read', mbean=mbean, attribute=attribute)
+
+    @staticmethod
+    def execute(mbean, operation, *arguments):
+        return dict(type='exec', mbean=mbean, operation=operation, arguments=list(arguments))
+
+
+def _tabular_rows(data, key):
+    """Flatten the nested dicts Jolokia returns for TabularData
+
+    :param data: Jolokia value
+    :param key: a column present in every row
+    :return: list of rows
+    """
+    if not isinstance(data, dict):
+        return []
+    if key in data:
+        return [data]
+
+    rows = []
+    for value in data.values():
+        rows.extend(_tabular_rows(value, key))
+    return rows
+
+
+def _to_text(data):
+    """Decode like module.run_command does, so parsers see the same output"""
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8', 'replace')
+
+
+def _to_bytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode('utf-8')
+
+
+# Box drawing vertical line, as the client writes it in UTF-8
+_KARAF_COLUMN_SEPARATOR = b'\xe2\x94\x82'
+_SEPARATOR_WIDTH = len(_KARAF_COLUMN_SEPARATOR)
+
+
+class ConsoleTable(object):
+    """Rows of the tables of a console output
+
+    The output is kept as the bytes the client wrote. Lines are never copied:
+    rows and columns are found with bytes.find, and only the fields a parser
+    keeps are decoded, straight from a memoryview of the output.
+    """
+
+    def __init__(self, out):
+        self.data = _to_bytes(out)
+        self.view = memoryview(self.data)
+
+    def rows(self):
+        """Lines with at least two columns
+
+        :return: generator of lists of offsets in the output: the start of the
+                 line, every column separator, and the end of the line
+        """
+        data = self.data
+        find = data.find
+        separator = _KARAF_COLUMN_SEPARATOR
+        size = len(data)
+
+        pos = 0
+        while pos < size:
+            eol = find(b'\n', pos)
+            if eol < 0:
+                eol = size
+
+            i = find(separator, pos, eol)
+            if i >= 0:
+                bounds = [pos]
+                while i >= 0:
+                    bounds.append(i)
+                    i = find(separator, i + _SEPARATOR_WIDTH, eol)
+                bounds.append(eol)
+                yield bounds
+
+            pos = eol + 1
+
+    def text(self, bounds, column):
+        """Decoded text of a column, without its padding"""
+        start = bounds[column] + _SEPARATOR_WIDTH if column else bounds[0]
+        return _decode(self.view[start:bounds[column + 1]]).strip()
+
+    def raw(self, bounds, column):
+        """Bytes of a column, with its padding"""
+        start = bounds[column] + _SEPARATOR_WIDTH if column else bounds[0]
+        return self.data[start:bounds[column + 1]]
+
+
+if bytes is str:
+    # Python 2: parsers return native strings, the bytes themselves
+    def _decode(view):
+        return view.tobytes()
+else:
+    def _decode(view):
+        return str(view, 'utf-8', 'replace')
+
+
+# Underline of a table header: dashes up to karaf 3, box drawing characters
+# (U+2500 to U+257F) since karaf 4
+_TABLE_UNDERLINE = re.compile(b'^(?:-|\xe2\x94[\x80-\xbf]|\xe2\x95[\x80-\xbf])+$')
+
+
+def parse_name_list(out, header):
+    """Parse a listing with a single column, e.g. kar:list
+
+    :param out: console output, text or raw bytes
+    :param header: title of the column, as bytes
+    :return: list of names
+    """
+    names = []
+    for line in _to_bytes(out).split(b'\n'):
+        name = line.strip()
+        if not name or name == header or _TABLE_UNDERLINE.match(name):
+            continue
+        names.append(_decode(memoryview(name)))
+    return names
+
+
+# Karaf only shows one of the location or symbolic name columns at a time
+BUNDLE_LIST_COMMAND = 'bundle:list -t 0 -u && bundle:list -t 0 -s'
+
+
+def parse_mvn_url(url):
+    """Split a maven url into its coordinates
+
+    :param url: bundle url, e.g. 'wrap:mvn:com.google.code.gson/gson/2.8.5'
+    :return: (group, artifact, version) or None if this is not a maven url
+    """
+    url = strip_url_wrapper(url)
+    if not url.startswith('mvn:'):
+        return None
+
+    # Drop the optional repository prefix, e.g. mvn:http://repo!group/artifact/version
+    parts = url[len('mvn:'):].split('!')[-1].split('/')
+    if len(parts) < 3:
+        return None
+
+    return parts[0], parts[1], parts[2]
+
+
+def strip_url_wrapper(url):
+    """Remove the 'wrap:' handler and its instructions from a bundle url"""
+    if url.startswith('wrap:'):
+        url = url[len('wrap:'):]
+        i = url.find('$')
+        if i != -1:
+            url = url[:i]
+    return url
+
+
+def osgi_version(version):
+    """Convert a maven version to the version reported by the framework
+
+    1.0-SNAPSHOT becomes 1.0.0.SNAPSHOT, 2.8.5 stays 2.8.5
+    """
+    i = version.find('-')
+    if i == -1:
+        numbers, qualifier = version, ''
+    else:
+        numbers, qualifier = version[:i], version[i + 1:]
+
+    parts = numbers.split('.')
+    if not all(p.isdigit() for p in parts):
+        return version
+    parts += ['0'] * (3 - len(parts))
+
+    if qualifier:
+        parts.append(qualifier.replace('-', '_'))
+    return '.'.join(parts)
+
+
+def parse_bundle_list(out):
+    """Parse the output of BUNDLE_LIST_COMMAND
+
+    :param out: console output
+    :return: list of bundles
+    """
+    table = ConsoleTable(out)
+    tables = []
+    current = None
+
+    for row in table.rows():
+        if len(row) < 6:
+            continue
+
+        first = table.raw(row, 0).strip()
+        if first == b'ID':
+            current = {}
+            tables.append(current)
+            continue
+
+        if not first.isdigit():
+            continue
+        bundle_id = int(first)
+
+        # Without headers, a repeated id marks the start of the second table
+        if current is None or bundle_id in current:
+            current = {}
+            tables.append(current)
+
+        # Only the columns that are kept are decoded
+        if len(tables) == 1:
+            current[bundle_id] = (table.text(row, 1), int(table.raw(row, 2)), table.text(row, 3), table.text(row, 4))
+        else:
+            current[bundle_id] = table.text(row, 4)
+
+    if not tables:
+        return []
+
+    names = tables[1] if len(tables) > 1 else {}
+
+    bundles = []
+    for bundle_id, (state, start_level, version, url) in tables[0].items():
+        bundles.append({
+            'id':               bundle_id,
+            'state':            state,
+            'start_level':      start_level,
+            'version':          version,
+            'url':              url,
+            'symbolic_name':    names.get(bundle_id),
+            })
+    return bundles
+
+
+class BundleIndex(object):
+    """Installed bundles, indexed by url, symbolic name and maven artifact"""
+
+    def __init__(self, bundles):
+        self.bundles = bundles
+        self.by_url = {}
+        self.by_name = {}
+        self.by_name_version = {}
+        self.by_artifact = {}
+
+        for b in bundles:
+            self.by_url[b['url']] = b
+            self.by_url.setdefault(strip_url_wrapper(b['url']), b)
+
+            if b['symbolic_name']:
+                self.by_name.setdefault(b['symbolic_name'], []).append(b)
+                self.by_name_version[(b['symbolic_name'], b['version'])] = b
+
+            coordinates = parse_mvn_url(b['url'])
+            if coordinates is not None:
+                self.by_artifact.setdefault(coordinates[:2], []).append(b)
+
+    def find(self, url, symbolic_name=None):
+        """Find the bundle installed from url, or from an equivalent url
+
+        :param url: bundle url
+        :param symbolic_name: symbolic name of the bundle, to match a bundle
+                              installed from a different kind of url
+        :return: the bundle, or None when there is none or the match is ambiguous
+        """
+        bundle = self.by_url.get(url) or self.by_url.get(strip_url_wrapper(url))
+        if bundle is not None or not symbolic_name:
+            return bundle
+
+        coordinates = parse_mvn_url(url)
+        if coordinates is None:
+            # Without a version, the only bundle with this symbolic name will do
+            candidates = self.by_name.get(symbolic_name, [])
+            return candidates[0] if len(candidates) == 1 else None
+
+        return self.by_name_version.get((symbolic_name, osgi_version(coordinates[2])))
+
+    def find_other_version(self, url, symbolic_name=None):
+        """Find a bundle that is another version of the bundle at url
+
+        :param url: bundle url
+        :param symbolic_name: symbolic name of the bundle, otherwise the maven
+                              group and artifact of url are used
+        :return: the bundle or None
+        """
+        if symbolic_name:
+            candidates = self.by_name.get(symbolic_name, [])
+        else:
+            coordinates = parse_mvn_url(url)
+            candidates = self.by_artifact.get(coordinates[:2], []) if coordinates else []
+
+        return candidates[0] if len(candidates) == 1 else None
+
+
+def list_bundles(client, check=True):
+    """List the installed bundles
+
+    :param client: karaf client
+    :param check: fail the module on error, otherwise raise a KarafError
+    :return: BundleIndex
+    """
+    if client.jolokia is not None:
+        request = [JolokiaConnection.read(JolokiaConnection.BUNDLE_MBEAN, 'Bundles')]
+        value = client.request_with_check(request) if check else client.retry(lambda: client.jolokia.request(request))
+        return BundleIndex(parse_bundle_mbean(value[0]))
+
+    out = client.run_with_check(BUNDLE_LIST_COMMAND, raw=True) if check else client.run(BUNDLE_LIST_COMMAND, raw=True)
+    return BundleIndex(parse_bundle_list(out))
+
+
+def parse_bundle_mbean(value):
+    """Convert the Bundles attribute of the bundle MBean to a list of bundles"""
+    bundles = []
+    for row in _tabular_rows(value, 'ID'):
+        bundles.append({
+            'id':               int(row['ID']),
+            'state':            row.get('State'),
+            'start_level':      int(row.get('Start Level', 0)),
+            'version':          row.get('Version'),
+            'url':              row.get('Update Location') or row.get('Location'),
+            'symbolic_name':    row.get('Symbolic Name'),
+            })
+    return bundles
+
+
+def start_bundles(client, bundle_ids, action):
+    """Start or stop bundles with a single request to the bundle MBean
+
+    :param client: karaf client with a Jolokia connection
+    :param bundle_ids: ids of the bundles
+    :param action: 'start' or 'stop'
+    """
+    operation = 'startBundle' if action == 'start' else 'stopBundle'
+    client.request_with_check([
+        JolokiaConnection.execute(JolokiaConnection.BUNDLE_MBEAN, operation, str(bundle_id))
+        for bundle_id in bundle_ids
+    ])
+
+
+BATCH_MAX_ITEMS = 100
+BATCH_MAX_BYTES = 65536
+
+_BATCH_SEPARATOR = ' && '
+
+
+def chunk_commands(items, commands, max_items=BATCH_MAX_ITEMS, max_bytes=BATCH_MAX_BYTES):
+    """Group commands in chunks of at most max_items commands and max_bytes bytes
+
+    :param items: what each command acts on, reported back in the results
+    :param commands: console command for each item
+    :param max_items: maximum number of commands in a chunk
+    :param max_bytes: maximum size of a chunk, once joined
+    :return: generator of lists of (item, command)
+    """
+    chunk = []
+    size = 0
+    for item, cmd in zip(items, commands):
+        cmd_size = len(cmd.encode('utf-8')) + len(_BATCH_SEPARATOR)
+        if chunk and (len(chunk) >= max_items or size + cmd_size > max_bytes):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append((item, cmd))
+        size += cmd_size
+
+    if chunk:
+        yield chunk
+
+
+def run_batch(client, items, commands, max_items=BATCH_MAX_ITEMS, max_bytes=BATCH_MAX_BYTES):
+    """Run one console command per item, in chunks sent on the standard input
+
+    Each chunk runs as one console call, its commands chained with '&&'. The
+    first failing chunk stops the batch and fails the module, reporting the
+    items that were done and the ones left, starting with the failing chunk.
+
+    :param client: karaf client
+    :param items: what each command acts on, e.g. bundle urls
+    :param commands: console command for each item
+    :param max_items: maximum number of commands in a chunk
+    :param max_bytes: maximum size of a chunk
+    :return: list of chunk results
+    """
+    chunks = list(chunk_commands(items, commands, max_items, max_bytes))
+
+    results = []
+    done = []
+    for index, chunk in enumerate(chunks):
+        chunk_items = [item for item, cmd in chunk]
+        cmds = [cmd for item, cmd in chunk]
+        try:
+            client.run(_BATCH_SEPARATOR.join(cmds), stdin=True)
+        except KarafError as e:
+            results.append(dict(chunk=index, items=chunk_items, status='failed', error=e.reason))
+            remaining = [item for c in chunks[index:] for item, cmd in c]
+            client.module.fail_json(
+                msg='Batch failed at chunk %s of %s: %s' % (index + 1, len(chunks), e.reason),
+                error_type=e.kind,
+                completed=done,
+                remaining=remaining,
+                chunks=results,
+                retries=client.retry_count,
+                stdout=e.out
+            )
+
+        done.extend(chunk_items)
+        results.append(dict(chunk=index, items=chunk_items, status='ok'))
+
+    return results
+
+
+def batch_argument_spec():
+    """Options of the modules that run many commands at once"""
+    return dict(
+        batch_size=dict(default=BATCH_MAX_ITEMS, type="int"),
+        batch_bytes=dict(default=BATCH_MAX_BYTES, type="int"),
+    )
+
+
+FEATURE_STATE_UNINSTALLED = 'Uninstalled'
+FEATURE_LIST_COMMAND = 'feature:list -i'
+
+
+def parse_feature_list(out):
+    """Parse the output of FEATURE_LIST_COMMAND
+
+    :param out: console output
+    :return: list of features
+    """
+    table = ConsoleTable(out)
+    features = []
+    for row in table.rows():
+        if len(row) < 5:
+            continue
+
+        name = table.text(row, 0)
+        if name == 'Name':
+            continue
+
+        features.append({
+            'name':     name,
+            'version':  table.text(row, 1),
+            'required': table.text(row, 2),
+            'state':    table.text(row, 3),
+            })
+    return features
+
+
+def list_features(client, check=True):
+    """List the installed features
+
+    :param client: karaf client
+    :param check: fail the module on error, otherwise raise a KarafError
+    :return: list of features
+    """
+    if client.jolokia is not None:
+        request = [JolokiaConnection.read(JolokiaConnection.FEATURE_MBEAN, 'Features')]
+        value = client.request_with_check(request) if check else client.retry(lambda: client.jolokia.request(request))
+        return parse_feature_mbean(value[0])
+
+    out = client.run_with_check(FEATURE_LIST_COMMAND, raw=True) if check else client.run(FEATURE_LIST_COMMAND, raw=True)
+    return parse_feature_list(out)
+
+
+def parse_feature_mbean(value):
+    """Convert the Features attribute of the feature MBean to the installed features"""
+    features = []
+    for row in _tabular_rows(value, 'Name'):
+        if not row.get('Installed'):
+            continue
+        features.append({
+            'name':     row['Name'],
+            'version':  row.get('Version'),
+            'required': row.get('Required'),
+            'state':    'Started',
+            })
+    return features
+
+
+REPO_LIST_COMMAND = 'feature:repo-list'
+
+
+def list_repos(client):
+    """List the feature repositories
+
+    :param client: karaf client
+    :return: dict of repository url to repository
+    """
+    if client.jolokia is not None:
+        value = client.request_with_check([JolokiaConnection.read(JolokiaConnection.FEATURE_MBEAN, 'Repositories')])
+        return dict(
+            (row['Uri'], {'name': row.get('Name'), 'url': row['Uri']})
+            for row in _tabular_rows(value[0], 'Uri')
+        )
+
+    table = ConsoleTable(client.run_with_check(REPO_LIST_COMMAND, raw=True))
+
+    existing_repos = {}
+    for row in table.rows():
+        if len(row) != 3:
+            continue
+
+        repo_name = table.text(row, 0)
+        repo_url = table.text(row, 1)
+
+        existing_repos[repo_url] = {
+                'name': repo_name,
+                'url': repo_url,
+            }
+
+    return existing_repos
+
+
+LOG_GET_COMMAND = 'log:get ALL'
+LOG_LEVEL_DEFAULT = 'DEFAULT'
+
+
+def parse_log_levels(out):
+    """Parse the output of LOG_GET_COMMAND
+
+    :param out: console output
+    :return: dict of logger name to its level
+    """
+    table = ConsoleTable(out)
+    levels = {}
+    for row in table.rows():
+        if len(row) != 3:
+            continue
+
+        logger = table.text(row, 0)
+        if not logger or logger == 'Logger':
+            continue
+
+        levels[logger] = table.text(row, 1).upper()
+
+    return levels
+
+
+def list_log_levels(client):
+    """List the loggers that have a level set
+
+    :param client: karaf client
+    :return: dict of logger name to its level
+    """
+    return parse_log_levels(client.run_with_check(LOG_GET_COMMAND, raw=True))
+
+
+def list_config_properties(client, pid):
+    """List the properties of a configuration
+
+    :param client: karaf client
+    :param pid: service pid
+    :return: dict of property name to its value, as a string
+    """
+    if client.jolokia is not None:
+        value = client.request_with_check([
+            JolokiaConnection.execute(JolokiaConnection.CONFIG_MBEAN, 'listProperties', pid)
+        ])
+        return dict((k, '' if v is None else str(v)) for k, v in (value[0] or {}).items())
+
+    out = client.run_with_check('config:property-list --pid %s' % (quote_console_arg(pid),))
+
+    result = {}
+    for line in out.split('\n'):
+        if '=' not in line:
+            continue
+
+        i = line.find('=')
+        result[line[:i].strip()] = line[i+1:].strip()
+
+    return result
+
+
+CONFIG_LIST_COMMAND = 'config:list'
+
+
+def iter_config_list(lines):
+    """Parse the output of CONFIG_LIST_COMMAND as it is streamed
+
+    :param lines: iterable of output lines
+    :return: generator of (pid, property name, value). Every configuration
+             starts with (pid, None, None), so that empty ones are seen too
+    """
+    pid = None
+    in_properties = False
+
+    for line in lines:
+        if line.startswith('Pid:'):
+            pid = line[len('Pid:'):].strip()
+            in_properties = False
+            yield pid, None, None
+        elif line.startswith('Properties:'):
+            in_properties = True
+        elif line.startswith('---'):
+            pid = None
+            in_properties = False
+        elif in_properties and pid is not None and line[:1].isspace():
+            i = line.find('=')
+            if i > 0:
+                yield pid, line[:i].strip(), line[i + 1:].strip()
+
+
+def property_digest(value, numeric=False):
+    """Digest of the canonical form of a property value
+
+    :param value: property value, from the module parameters or as listed by karaf
+    :param numeric: compare by numeric value, like property_equals does when
+                    the desired value is a number
+    :return: hex string
+    """
+    text = canonical_property(value)
+    if numeric and _NUMBER.match(text) is not None:
+        text = _canonical_number(float(text))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def is_numeric_property(value):
+    """Whether a desired property value is compared by numeric value"""
+    if isinstance(value, _STRING_TYPES):
+        value = parse_config_literal(value.strip())
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+try:
+    _STRING_TYPES = (str, unicode)
+except NameError:
+    _STRING_TYPES = (str,)
+
+# Only true and false are booleans, yes or NO are strings like any other
+_BOOL_VALUES = {'true': True, 'false': False}
+
+_NUMBER = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$')
+
+# Typed values of the felix .config format: I"1", B"true", L[ "1", "2" ]
+_CONFIG_TYPES = {
+    'T': str, 'S': str, 'C': str,
+    'I': int, 'i': int, 'L': int, 'l': int, 'X': int, 'x': int,
+    'F': float, 'f': float, 'D': float, 'd': float,
+    'B': lambda v: v.lower() == 'true', 'b': lambda v: v.lower() == 'true',
+}
+_CONFIG_SCALAR = re.compile(r'^([TISLXFDBCilxfdbc])?"((?:[^"\\]|\\.)*)"$')
+_CONFIG_ARRAY = re.compile(r'^([TISLXFDBCilxfdbc])?[\[(]\s*(.*?)\s*[\])]$', re.S)
+_CONFIG_ARRAY_ITEM = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+# Characters the gogo shell does not interpret in an unquoted word
+_SAFE_CONSOLE_WORD = re.compile(r'^[A-Za-z0-9_.,:/@%+=-]+$')
+
+
+def parse_config_literal(value):
+    """Parse a value written with the typed .config syntax
+
+    :param value: e.g. 'I"8080"', 'B"true"' or '[ "a", "b" ]'
+    :return: the typed value, or value itself if it is not a typed literal
+    """
+    m = _CONFIG_SCALAR.match(value)
+    if m is not None:
+        raw = re.sub(r'\\(.)', r'\1', m.group(2))
+        convert = _CONFIG_TYPES.get(m.group(1) or 'T', str)
+        try:
+            return convert(raw)
+        except ValueError:
+            return raw
+
+    m = _CONFIG_ARRAY.match(value)
+    if m is not None and (not m.group(2) or m.group(2).startswith('"')):
+        convert = _CONFIG_TYPES.get(m.group(1) or 'T', str)
+        items = []
+        for raw in _CONFIG_ARRAY_ITEM.findall(m.group(2)):
+            raw = re.sub(r'\\(.)', r'\1', raw)
+            try:
+                items.append(convert(raw))
+            except ValueError:
+                items.append(raw)
+        return items
+
+    return value
+
+
+def _canonical_number(number):
+    if isinstance(number, float) and number.is_integer() and abs(number) < 1e16:
+        return str(int(number))
+    return repr(number) if isinstance(number, float) else str(number)
+
+
+def canonical_property(value):
+    """Canonical form of a property value.
+
+    Values that ConfigAdmin would treat the same get the same canonical form:
+    1 and 1.0; I"1" and 1; "true", B"true" and True; ['a', 'b'], "a,b", "[a, b]"
+    (how arrays are listed) and '[ "a", "b" ]' (typed .config syntax).
+    Other strings are kept as they are: "007" is not "7" and "no" is not False.
+
+    :param value: property value, from the module parameters or as listed by karaf
+    :return: string
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, numbers.Real):
+        return _canonical_number(value)
+    if isinstance(value, (list, tuple)):
+        return ','.join(canonical_property(v) for v in value)
+
+    text = value.strip() if isinstance(value, _STRING_TYPES) else str(value).strip()
+
+    typed = parse_config_literal(text)
+    if typed is not text:
+        return canonical_property(typed)
+
+    if text.lower() in _BOOL_VALUES:
+        return 'true' if _BOOL_VALUES[text.lower()] else 'false'
+
+    # Arrays are listed as [a, b]
+    if text.startswith('[') and text.endswith(']'):
+        return ','.join(canonical_property(v) for v in text[1:-1].split(',') if v.strip())
+
+    return text
+
+
+def property_equals(existing, desired):
+    """Compare a listed property value with the desired one
+
+    :param existing: value listed by karaf, a string
+    :param desired: value from the module parameters
+    """
+    if isinstance(desired, _STRING_TYPES):
+        desired = parse_config_literal(desired.strip())
+
+    # A number is equal to any string with the same numeric value, "1.0" == 1
+    if is_numeric_property(desired):
+        text = canonical_property(existing)
+        return _NUMBER.match(text) is not None and float(text) == float(desired)
+
+    return canonical_property(existing) == canonical_property(desired)
+
+
+def encode_property(value):
+    """String to set for a property value
+
+    The console and the config MBean only set strings. Booleans and numbers
+    are written in their canonical form, lists are joined with commas.
+    """
+    if isinstance(value, _STRING_TYPES):
+        typed = parse_config_literal(value.strip())
+        if typed is value.strip():
+            return value
+        value = typed
+    return canonical_property(value)
+
+
+def quote_console_arg(value):
+    """Quote a word for the karaf (gogo) shell
+
+    :param value: argument
+    :return: the argument, quoted if it contains characters the shell interprets
+    """
+    if value and _SAFE_CONSOLE_WORD.match(value):
+        return value
+    if "'" not in value:
+        return "'%s'" % value
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$')
+
+
+JOB_POLL_INTERVAL = 2
+
+# Runs the client detached from the module and records its return code once
+# it exits, so that a later module run can pick up the result.
+# The job holds the karaf lock (file descriptor 9) while it runs, when flock(1) is available
+_JOB_SCRIPT = (
+    'exec 9>>"$4"; '
+    'if command -v flock >/dev/null 2>&1 && ! flock -w "$5" 9; then '
+    'echo "Timeout after $5s waiting for the lock $4" > "$2"; echo 1 > "$3.tmp"; mv "$3.tmp" "$3"; exit; fi; '
+    '"$0" "$1" > "$2" 2>&1; echo $? > "$3.tmp"; mv "$3.tmp" "$3"'
+)
+
+
+def _job_paths(client, job_key):
+    jobs_dir = os.path.join(client.karaf_home, 'data', 'ansible', 'jobs')
+    job_id = hashlib.sha1(job_key.encode('utf-8')).hexdigest()
+    base = os.path.join(jobs_dir, job_id)
+    return jobs_dir, base + '.json', base + '.log', base + '.rc'
+
+
+def start_job(client, job_key, karaf_cmd):
+    """Start a console command in the background and return right away
+
+    :param client: karaf client
+    :param job_key: key identifying the job across module runs
+    :param karaf_cmd: console command line
+    :return: job description
+    """
+    if client.karaf_home is None or not os.path.isfile(client.client_bin or ''):
+        client.module.fail_json(msg='Background commands need the karaf client program on the managed host')
+
+    jobs_dir, job_file, log_file, rc_file = _job_paths(client, job_key)
+    try:
+        ensure_dir(jobs_dir)
+    except OSError as e:
+        client.module.fail_json(msg='Can not create %s: %s' % (jobs_dir, e.strerror or e))
+
+    for path in (log_file, rc_file):
+        if os.path.exists(path):
+            os.remove(path)
+
+    devnull = open(os.devnull, 'r+')
+    try:
+        proc = subprocess.Popen(
+            ['/bin/sh', '-c', _JOB_SCRIPT, client.client_bin, karaf_cmd, log_file, rc_file,
+             client.lock.path, str(client.lock.timeout)],
+            stdin=devnull, stdout=devnull, stderr=devnull,
+            close_fds=True, preexec_fn=os.setsid
+        )
+    finally:
+        devnull.close()
+
+    job = dict(key=job_key, cmd=karaf_cmd, pid=proc.pid, log=log_file, started=time.time())
+    with open(job_file, 'w') as f:
+        json.dump(job, f)
+
+    return job
+
+
+def job_status(client, job_key):
+    """Status of a background job started by start_job
+
+    :param client: karaf client
+    :param job_key: key identifying the job
+    :return: None if there is no such job, otherwise the job description with
+             'running', 'output' and 'error' (a KarafError or None) keys
+    """
+    if client.karaf_home is None:
+        return None
+
+    jobs_dir, job_file, log_file, rc_file = _job_paths(client, job_key)
+    if not os.path.isfile(job_file):
+        return None
+
+    with open(job_file) as f:
+        job = json.load(f)
+
+    job['output'] = ''
+    if os.path.isfile(log_file):
+        with open(log_file) as f:
+            job['output'] = f.read()
+
+    rc = ''
+    if os.path.isfile(rc_file):
+        with open(rc_file) as f:
+            rc = f.read().strip()
+
+    job['error'] = None
+    # The rc file is renamed into place once written, an empty one is not complete yet
+    job['running'] = not rc
+    if job['running']:
+        # The process may have been killed before it could write its rc
+        try:
+            os.kill(job['pid'], 0)
+        except OSError:
+            job['running'] = False
+            job['error'] = KarafError('Background job "%s" died' % job['cmd'], job['output'])
+        return job
+
+    job['error'] = classify_error(int(rc), job['output'])
+    return job
+
+
+def clear_job(client, job_key):
+    if client.karaf_home is None:
+        return
+
+    for path in _job_paths(client, job_key)[1:]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def wait_for_job(client, job_key, timeout):
+    """Poll a background job until it exits
+
+    :return: the last job status
+    """
+    deadline = time.time() + timeout
+    job = job_status(client, job_key)
+    while job is not None and job['running'] and time.time() < deadline:
+        time.sleep(JOB_POLL_INTERVAL)
+        job = job_status(client, job_key)
+    return job
+
+
+def resume_job(client, job_key, wait, timeout):
+    """Pick up a background job left by a previous module run.
+
+    A finished job is cleared, and the module fails if it ended with an error.
+
+    :param client: karaf client
+    :param job_key: key identifying the job
+    :param wait: wait for a running job to finish
+    :param timeout: how long to wait, in seconds
+    :return: None if there was no job, otherwise its last status
+    """
+    job = job_status(client, job_key)
+    if job is None:
+        return None
+
+    if job['running'] and wait:
+        job = wait_for_job(client, job_key, timeout)
+        if job['running']:
+            client.module.fail_json(
+                msg='Timed out after %ss waiting for "%s"' % (timeout, job['cmd']),
+                retries=client.retry_count
+            )
+
+    if job['running']:
+        return job
+
+    clear_job(client, job_key)
+    if job['error'] is not None:
+        client.fail(job['error'])
+    return job
+
+
+FEATURES_CFG = 'etc/org.apache.karaf.features.cfg'
+STARTUP_PROPERTIES = 'etc/startup.properties'
+
+
+def _is_continued(line):
+    stripped = line.rstrip('\r\n')
+    return (len(stripped) - len(stripped.rstrip('\\'))) % 2 == 1
+
+
+def _split_property(text):
+    """Split a logical properties line in its unescaped key and raw value"""
+    key = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == '\\' and i + 1 < len(text):
+            key.append(text[i + 1])
+            i += 2
+            continue
+        if c in '=: \t':
+            break
+        key.append(c)
+        i += 1
+
+    rest = text[i:].lstrip(' \t')
+    if rest[:1] in ('=', ':'):
+        rest = rest[1:]
+    return ''.join(key), rest.strip()
+
+
+def read_properties(path):
+    """Read a java properties file, keeping its layout
+
+    :param path: properties file
+    :return: list of (key, value, physical lines), key is None for comments and blank lines
+    """
+    entries = []
+    if not os.path.isfile(path):
+        return entries
+
+    with open(path) as f:
+        lines = f.readlines()
+
+    i = 0
+    while i < len(lines):
+        # Comments are never continued, even when they end with a backslash
+        first = lines[i].strip()
+        if not first or first[0] in '#!':
+            entries.append((None, None, [lines[i]]))
+            i += 1
+            continue
+
+        physical = [lines[i]]
+        while _is_continued(physical[-1]) and i + 1 < len(lines):
+            i += 1
+            physical.append(lines[i])
+        i += 1
+
+        # Java drops the backslash and the leading blanks of the continuation line
+        logical = ''.join((l.rstrip('\r\n')[:-1] if _is_continued(l) else l.strip('\r\n')).lstrip(' \t\f')
+                          for l in physical)
+        key, value = _split_property(logical.strip())
+        entries.append((key, value, physical))
+
+    return entries
+
+
+def escape_property_key(key):
+    return re.sub(r'([:= \\#!])', r'\\\1', key)
+
+
+def format_property(key, value):
+    """Format a property, one line per item when value is a list"""
+    if isinstance(value, (list, tuple)):
+        if not value:
+            return ['%s = \n' % escape_property_key(key)]
+        lines = ['%s = \\\n' % escape_property_key(key)]
+        for i, item in enumerate(value):
+            lines.append('    %s%s\n' % (item, ', \\' if i < len(value) - 1 else ''))
+        return lines
+    return ['%s = %s\n' % (escape_property_key(key), value)]
+
+
+def write_properties(module, path, entries, changes):
+    """Write changed properties back, leaving every other line untouched
+
+    :param module: ansible module
+    :param path: properties file
+    :param entries: what read_properties returned
+    :param changes: dict of key to its new value, a list or a string, or None to remove the key
+    """
+    lines = []
+    written = set()
+    for key, value, physical in entries:
+        if key is None or key not in changes:
+            lines.extend(physical)
+            continue
+        if key not in written and changes[key] is not None:
+            lines.extend(format_property(key, changes[key]))
+        written.add(key)
+
+    for key, value in changes.items():
+        if key not in written and value is not None:
+            if lines and not lines[-1].endswith('\n'):
+                lines[-1] += '\n'
+            lines.extend(format_property(key, value))
+
+    tmp_path = path + '.ansible.tmp'
+    with open(tmp_path, 'w') as f:
+        f.writelines(lines)
+    module.atomic_move(tmp_path, path)
+
+
+def split_list_property(value):
+    """Split a comma separated property value, keeping (...) stages of featuresBoot together"""
+    items = []
+    depth = 0
+    current = []
+    for c in value or '':
+        if c == ',' and depth == 0:
+            items.append(''.join(current).strip())
+            current = []
+            continue
+        depth += (c == '(') - (c == ')')
+        current.append(c)
+    items.append(''.join(current).strip())
+    return [item for item in items if item]
+
+
+def _matches_feature(item, name, version):
+    if version:
+        return item == '%s/%s' % (name, version)
+    return item == name or item.startswith(name + '/')
+
+
+def offline_list_update(module, karaf_home, path, key, item, state, matches=None):
+    """Add or remove an item of a comma separated property of a karaf configuration file
+
+    Used to prepare a container that is not running yet, e.g. featuresBoot
+    in etc/org.apache.karaf.features.cfg.
+
+    :param module: ansible module
+    :param karaf_home: root of the karaf installation
+    :param path: configuration file, relative to karaf_home
+    :param key: property
+    :param item: value to add or remove
+    :param state: 'present' or 'absent'
+    :param matches: function telling if an existing item stands for item
+    :return: True if the file changed
+    """
+    matches = matches or (lambda existing: existing == item)
+    full_path = os.path.join(karaf_home, path)
+
+    entries = read_properties(full_path)
+    values = [value for k, value, physical in entries if k == key]
+    items = split_list_property(values[-1] if values else '')
+
+    def remove(items):
+        result = []
+        for existing in items:
+            if existing.startswith('(') and existing.endswith(')'):
+                stage = [i for i in split_list_property(existing[1:-1]) if not matches(i)]
+                if stage:
+                    result.append('(%s)' % ', '.join(stage))
+            elif not matches(existing):
+                result.append(existing)
+        return result
+
+    def contains(items):
+        for existing in items:
+            if existing.startswith('(') and existing.endswith(')'):
+                if contains(split_list_property(existing[1:-1])):
+                    return True
+            elif matches(existing):
+                return True
+        return False
+
+    if state == 'present':
+        if contains(items):
+            return False
+        new_items = items + [item]
+    else:
+        new_items = remove(items)
+        if new_items == items:
+            return False
+
+    if not module.check_mode:
+        write_properties(module, full_path, entries, {key: new_items})
+    return True
+
+
+def offline_feature(module, karaf_home, name, version, state):
+    """Add or remove a feature of featuresBoot"""
+    item = '%s/%s' % (name, version) if version else name
+    with karaf_lock(module, karaf_home):
+        return offline_list_update(module, karaf_home, FEATURES_CFG, 'featuresBoot', item, state,
+                                   lambda existing: _matches_feature(existing, name, version))
+
+
+def offline_repo(module, karaf_home, url, state):
+    """Add or remove a repository of featuresRepositories"""
+    with karaf_lock(module, karaf_home):
+        return offline_list_update(module, karaf_home, FEATURES_CFG, 'featuresRepositories', url, state)
+
+
+def offline_bundle(module, karaf_home, url, start_level, state):
+    """Add or remove a bundle of etc/startup.properties
+
+    The bundle must also be available in the system/ maven repository of the
+    installation, this does not download it.
+    """
+    with karaf_lock(module, karaf_home):
+        full_path = os.path.join(karaf_home, STARTUP_PROPERTIES)
+        entries = read_properties(full_path)
+        current = dict((k, v) for k, v, physical in entries if k is not None)
+
+        if state == 'present':
+            if current.get(url) == str(start_level):
+                return False
+            changes = {url: str(start_level)}
+        else:
+            if url not in current:
+                return False
+            changes = {url: None}
+
+        if not module.check_mode:
+            write_properties(module, full_path, entries, changes)
+        return True
+
+
+def karaf_home_path(client_bin):
+    """Root of the karaf installation, from the client_bin option"""
+    return os.path.dirname(os.path.dirname(check_client_bin_path(client_bin)))
+
+
+def check_client_bin_path(client_bin):
+    if os.path.isfile(client_bin):
+        return client_bin
+
+    if os.path.isdir(client_bin):
+        test = os.path.join(client_bin, 'bin/client')
+        if os.path.isfile(test):
+            return test
+    else:
+        raise Exception('client_bin parameter not supported: %s' % client_bin)
+
+
+def karaf_argument_spec():
+    """Options shared by every karaf module"""
+    return dict(
+        client_bin=dict(default="/opt/karaf/bin/client", type="path"),
+        retries=dict(default=3, type="int"),
+        retry_delay=dict(default=2, type="int"),
+        transport=dict(default="client", choices=["client", "ssh", "jolokia"]),
+        jolokia_url=dict(default="http://localhost:8181/jolokia"),
+        validate_certs=dict(default=True, type="bool"),
+        host=dict(default="localhost"),
+        port=dict(default=8101, type="int"),
+        user=dict(default="karaf"),
+        password=dict(default=None, no_log=True),
+        private_key=dict(default=None, type="path"),
+        connect_timeout=dict(default=10, type="int"),
+        host_key_checking=dict(default=True, type="bool"),
+        known_hosts=dict(default=None, type="path"),
+        lock_timeout=dict(default=LOCK_TIMEOUT, type="int"),
+    )
+
+
+def karaf_client(module):
+    """Build a KarafClient from the shared module options"""
+    transport = module.params["transport"]
+    if transport == "jolokia":
+        # Commands the MBeans don't cover go through the console, with the
+        # client program if it is installed, over ssh otherwise
+        if os.path.exists(module.params["client_bin"]):
+            client = _karaf_console_client(module, "client")
+        else:
+            client = _karaf_console_client(module, "ssh")
+        client.jolokia = JolokiaConnection(
+            module.params["jolokia_url"],
+            user=module.params["user"],
+            password=module.params["password"],
+            timeout=module.params["connect_timeout"],
+            validate_certs=module.params["validate_certs"]
+        )
+        return client
+
+    if transport == "ssh" and not HAS_PARAMIKO:
+        module.fail_json(msg='paramiko is required for transport=ssh')
+
+    return _karaf_console_client(module, transport)
+
+
+def _karaf_console_client(module, transport):
+    if transport == "ssh":
+        # The karaf installation is optional, it is only used for local state
+        client_bin = module.params["client_bin"]
+        if not os.path.exists(client_bin):
+            client_bin = None
+        elif os.path.isdir(client_bin):
+            client_bin = os.path.join(client_bin, 'bin/client')
+
+        client = KarafSshClient(
+            module,
+            module.params["host"],
+            module.params["port"],
+            module.params["user"],
+            password=module.params["password"],
+            private_key=module.params["private_key"],
+            connect_timeout=module.params["connect_timeout"],
+            client_bin=client_bin,
+            retries=module.params["retries"],
+            retry_delay=module.params["retry_delay"],
+            host_key_checking=module.params["host_key_checking"],
+            known_hosts=module.params["known_hosts"]
+        )
+    else:
+        client = KarafClient(
+            module,
+            check_client_bin_path(module.params["client_bin"]),
+            retries=module.params["retries"],
+            retry_delay=module.params["retry_delay"]
+        )
+
+    client.lock.timeout = module.params["lock_timeout"]
+    return client
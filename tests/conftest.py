@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'module_utils'))
+
+import karaf
+
+# Ansible ships module_utils/karaf.py with the modules as ansible.module_utils.karaf
+import ansible.module_utils
+sys.modules['ansible.module_utils.karaf'] = karaf
+ansible.module_utils.karaf = karaf
+
+
+class ModuleExit(Exception):
+    """Raised instead of leaving the process on exit_json or fail_json"""
+
+    def __init__(self, failed, result):
+        Exception.__init__(self, result.get('msg'))
+        self.failed = failed
+        self.result = result
+
+
+class FakeModule(object):
+    """The parts of AnsibleModule the helpers of module_utils/karaf.py use"""
+
+    def __init__(self, **params):
+        self.params = dict(lock_timeout=karaf.LOCK_TIMEOUT)
+        self.params.update(params)
+        self.check_mode = False
+        # Commands run, and the (rc, out, err) they answer, in order
+        self.commands = []
+        self.answers = []
+
+    def run_command(self, args, data=None, **kwargs):
+        self.commands.append((args, data))
+        rc, out, err = self.answers.pop(0) if self.answers else (0, '', '')
+        if kwargs.get('encoding', 'utf-8') is None:
+            out = karaf._to_bytes(out)
+        return rc, out, err
+
+    def fail_json(self, **result):
+        raise ModuleExit(True, result)
+
+    def exit_json(self, **result):
+        raise ModuleExit(False, result)
+
+    def atomic_move(self, src, dest):
+        os.rename(src, dest)
+
+
+@pytest.fixture
+def module():
+    return FakeModule()
+
+
+@pytest.fixture
+def client(module, tmpdir):
+    """Client of a karaf installed in tmpdir, retrying without delay"""
+    return karaf.KarafClient(module, str(tmpdir.join('bin', 'client')), retry_delay=0)
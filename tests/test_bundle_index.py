@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import karaf
+
+
+def bundle(bundle_id, url, symbolic_name, version):
+    return {'id': bundle_id, 'state': 'Active', 'start_level': 80, 'version': version,
+            'url': url, 'symbolic_name': symbolic_name}
+
+
+@pytest.fixture
+def index():
+    return karaf.BundleIndex([
+        bundle(10, 'mvn:com.example/app/1.0-SNAPSHOT', 'com.example.app', '1.0.0.SNAPSHOT'),
+        bundle(11, 'wrap:mvn:com.google.code.gson/gson/2.8.5$Bundle-SymbolicName=gson', 'gson', '2.8.5'),
+        bundle(12, 'file:/opt/libs/lib-1.0.jar', 'com.example.lib', '1.0.0'),
+        bundle(13, 'file:/opt/libs/lib-2.0.jar', 'com.example.lib', '2.0.0'),
+        bundle(14, 'mvn:com.example/tool/1.2', 'com.example.tool', '1.2.0'),
+        bundle(15, 'mvn:org.other/tool/1.2', 'org.other.tool', '1.2.0'),
+    ])
+
+
+@pytest.mark.parametrize('version, expected', [
+    ('2.8.5', '2.8.5'),
+    ('1.0-SNAPSHOT', '1.0.0.SNAPSHOT'),
+    ('1', '1.0.0'),
+    ('1.2.3-rc-1', '1.2.3.rc_1'),
+    ('1.0.Final', '1.0.Final'),
+])
+def test_osgi_version(version, expected):
+    assert karaf.osgi_version(version) == expected
+
+
+def test_parse_mvn_url():
+    assert karaf.parse_mvn_url('mvn:com.example/app/1.0') == ('com.example', 'app', '1.0')
+    assert karaf.parse_mvn_url('wrap:mvn:com.example/app/1.0$Bundle-Version=1.0') == ('com.example', 'app', '1.0')
+    assert karaf.parse_mvn_url('mvn:http://repo.example.com!com.example/app/1.0') == ('com.example', 'app', '1.0')
+    assert karaf.parse_mvn_url('mvn:com.example/app') is None
+    assert karaf.parse_mvn_url('file:/opt/libs/lib.jar') is None
+
+
+def test_find_by_url(index):
+    assert index.find('mvn:com.example/app/1.0-SNAPSHOT')['id'] == 10
+    assert index.find('mvn:com.example/app/2.0') is None
+
+
+def test_find_without_the_wrap_handler(index):
+    # Installed with wrap: and its instructions, requested without, or the other way round
+    assert index.find('mvn:com.google.code.gson/gson/2.8.5')['id'] == 11
+    assert index.find('wrap:mvn:com.example/tool/1.2$Bundle-Version=1.2')['id'] == 14
+
+
+def test_find_by_symbolic_name_and_version(index):
+    # Installed from another repository, with the maven version of the url
+    assert index.find('mvn:http://repo.example.com!com.example/app/1.0-SNAPSHOT', 'com.example.app')['id'] == 10
+    assert index.find('mvn:http://repo.example.com!com.example/app/1.1-SNAPSHOT', 'com.example.app') is None
+
+
+def test_find_by_symbolic_name(index):
+    assert index.find('http://example.com/tool.jar', 'com.example.tool')['id'] == 14
+    assert index.find('http://example.com/tool.jar', 'com.example.missing') is None
+    assert index.find('http://example.com/tool.jar') is None
+
+
+def test_find_ambiguous_symbolic_name(index):
+    # Two versions of com.example.lib are installed, neither is the one
+    assert index.find('http://example.com/lib.jar', 'com.example.lib') is None
+
+
+def test_find_other_version_by_symbolic_name(index):
+    assert index.find_other_version('file:/opt/libs/tool-1.3.jar', 'com.example.tool')['id'] == 14
+    assert index.find_other_version('file:/opt/libs/lib-3.0.jar', 'com.example.lib') is None
+    assert index.find_other_version('file:/opt/libs/new.jar', 'com.example.new') is None
+
+
+def test_find_other_version_by_maven_artifact(index):
+    # What karaf_bundles upgrade=true relies on: same group and artifact, any version
+    assert index.find_other_version('mvn:com.example/app/1.1')['id'] == 10
+    assert index.find_other_version('wrap:mvn:com.google.code.gson/gson/2.10')['id'] == 11
+    assert index.find_other_version('mvn:com.example/tool/1.3')['id'] == 14
+    assert index.find_other_version('mvn:com.example/other/1.0') is None
+    assert index.find_other_version('file:/opt/libs/lib-3.0.jar') is None
+
+
+def test_find_other_version_ambiguous_artifact():
+    index = karaf.BundleIndex([
+        bundle(10, 'mvn:com.example/app/1.0', 'com.example.app', '1.0.0'),
+        bundle(11, 'mvn:com.example/app/1.1', 'com.example.app', '1.1.0'),
+    ])
+
+    assert index.find_other_version('mvn:com.example/app/2.0') is None
+    assert index.find_other_version('mvn:com.example/app/2.0', 'com.example.app') is None
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import karaf
+from conftest import ModuleExit
+
+RESOLUTION = ('Error executing command: Unable to resolve root: missing requirement [root] osgi.identity; '
+              'osgi.identity=camel-core; type=karaf.feature; version="[2.20.1,2.20.1]" '
+              '[caused by: Bundle com.example.lib not found, timed out]')
+
+
+@pytest.mark.parametrize('out, error_class, kind', [
+    (RESOLUTION, karaf.KarafResolutionError, karaf.ERROR_RESOLUTION),
+    ('Error executing command: No feature named \'foo\' with version \'0.0.0\' available',
+     karaf.KarafNotFoundError, karaf.ERROR_NOT_FOUND),
+    ('Error executing command: Pid com.example.app not found', karaf.KarafNotFoundError, karaf.ERROR_NOT_FOUND),
+    ('Error executing command: Unknown option: --foo', karaf.KarafSyntaxError, karaf.ERROR_SYNTAX),
+    ('Failed to get the session.', karaf.KarafTransientError, karaf.ERROR_TRANSIENT),
+    ('java.net.ConnectException: Connection refused', karaf.KarafTransientError, karaf.ERROR_TRANSIENT),
+    ('Error executing command: something unexpected', karaf.KarafError, karaf.ERROR_UNKNOWN),
+])
+def test_classify_error(out, error_class, kind):
+    error = karaf.classify_error(1, out)
+
+    assert type(error) is error_class
+    assert error.kind == kind
+    assert error.rc == 1
+    assert error.out == out
+
+
+def test_classify_error_success():
+    assert karaf.classify_error(0, 'ok') is None
+    assert karaf.classify_error(0, b'\xe2\x94\x82 ok') is None
+
+
+def test_classify_error_marker_with_rc_zero():
+    # The client exits with 0 when the console reports an error
+    error = karaf.classify_error(0, 'Error executing command: No matching bundles')
+
+    assert isinstance(error, karaf.KarafNotFoundError)
+    assert error.reason == 'Error executing command: No matching bundles'
+
+
+def test_classify_error_raw_output():
+    error = karaf.classify_error(0, u'Error executing command: Unknown option: --é'.encode('utf-8'))
+
+    assert isinstance(error, karaf.KarafSyntaxError)
+    assert error.out == u'Error executing command: Unknown option: --é'
+
+
+def test_classify_error_reason():
+    error = karaf.classify_error(1, 'Error executing command: Unable to install, reason: Unable to find foo')
+    assert error.reason == 'Unable to find foo'
+
+
+@pytest.mark.parametrize('command', ['feature:list', 'features:list', 'bundle:list', 'osgi:list',
+                                     'config:edit', 'system:shutdown', 'shell:echo'])
+def test_core_command_not_found_is_transient(command):
+    # The core commands are still being registered while the container starts
+    assert isinstance(karaf.classify_error(1, 'Command not found: %s' % command), karaf.KarafTransientError)
+
+
+@pytest.mark.parametrize('command', ['kar:install', 'log:set', 'instance:list', 'featur:list', 'foo'])
+def test_other_command_not_found(command):
+    error = karaf.classify_error(1, 'Command not found: %s' % command)
+
+    assert type(error) is karaf.KarafCommandNotFoundError
+    assert error.kind == karaf.ERROR_NOT_FOUND
+
+
+class Action(object):
+    """Raises the given errors in turn, then returns 'ok'"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+def transient():
+    return karaf.KarafTransientError('Failed to get the session')
+
+
+def command_not_found():
+    return karaf.KarafCommandNotFoundError('Command not found: kar:list')
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(karaf.time, 'sleep', delays.append)
+    return delays
+
+
+def test_retry_transient(client):
+    action = Action(transient(), transient())
+
+    assert client.retry(action) == 'ok'
+    assert action.calls == 3
+    assert client.retry_count == 2
+
+
+def test_retry_gives_up(client):
+    action = Action(*[transient() for i in range(10)])
+
+    with pytest.raises(karaf.KarafTransientError):
+        client.retry(action)
+
+    assert action.calls == client.retries + 1
+    assert client.retry_count == client.retries
+
+
+def test_retry_backoff(module, tmpdir, sleeps):
+    client = karaf.KarafClient(module, str(tmpdir.join('bin', 'client')), retries=3, retry_delay=2)
+
+    with pytest.raises(karaf.KarafTransientError):
+        client.retry(Action(*[transient() for i in range(10)]))
+
+    assert sleeps == [2, 4, 8]
+
+
+def test_retry_count_adds_up(client):
+    client.retry(Action(transient()))
+    client.retry(Action(transient(), transient()))
+
+    assert client.retry_count == 3
+
+
+@pytest.mark.parametrize('error', [
+    karaf.KarafNotFoundError('No feature named foo'),
+    karaf.KarafResolutionError('Unable to resolve root'),
+    karaf.KarafSyntaxError('Unknown option: --foo'),
+    karaf.KarafLockError('Timeout after 600s waiting for the lock'),
+    karaf.KarafError('something unexpected'),
+])
+def test_no_retry(client, error):
+    action = Action(error)
+
+    with pytest.raises(type(error)):
+        client.retry(action)
+
+    assert action.calls == 1
+    assert client.retry_count == 0
+
+
+def test_command_not_found_is_not_retried(client):
+    action = Action(command_not_found())
+
+    with pytest.raises(karaf.KarafCommandNotFoundError):
+        client.retry(action)
+
+    assert action.calls == 1
+
+
+def test_command_not_found_retried_after_transient_error(client):
+    # The container was not reachable yet, then still registering its commands
+    action = Action(transient(), command_not_found(), command_not_found())
+
+    assert client.retry(action) == 'ok'
+    assert action.calls == 4
+    assert client.retry_count == 3
+
+
+def test_command_not_found_retries_are_bounded(client):
+    action = Action(transient(), *[command_not_found() for i in range(10)])
+
+    with pytest.raises(karaf.KarafCommandNotFoundError):
+        client.retry(action)
+
+    assert action.calls == client.retries + 1
+
+
+def test_run_with_check_reports_the_error(module, client):
+    module.answers = [(1, 'Failed to get the session.', '')] * 2
+    module.answers.append((1, 'Error executing command: Unknown option: -x', ''))
+
+    with pytest.raises(ModuleExit) as e:
+        client.run_with_check('feature:list -x')
+
+    assert e.value.result['error_type'] == karaf.ERROR_SYNTAX
+    assert e.value.result['retries'] == 2
+    assert len(module.commands) == 3
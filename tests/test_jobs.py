@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import karaf
+from conftest import ModuleExit
+
+# Client program answering a command with the <command>.out and <command>.rc
+# files next to it
+CLIENT = '''#!/bin/sh
+cd "$(dirname "$0")"
+echo "$1" > last_command
+cat "$1.out"
+exit $(cat "$1.rc")
+'''
+
+KEY = 'feature:install camel'
+
+
+@pytest.fixture(autouse=True)
+def poll_fast(monkeypatch):
+    monkeypatch.setattr(karaf, 'JOB_POLL_INTERVAL', 0.05)
+
+
+@pytest.fixture
+def client(client, tmpdir):
+    path = tmpdir.join('bin').ensure(dir=True).join('client')
+    path.write(CLIENT)
+    path.chmod(0o755)
+    return client
+
+
+def answer(tmpdir, karaf_cmd, out, rc=0):
+    tmpdir.join('bin', karaf_cmd + '.out').write(out)
+    tmpdir.join('bin', karaf_cmd + '.rc').write(str(rc))
+
+
+def write_job(client, pid, rc=None):
+    """Leave a job behind, as a previous module run would"""
+    jobs_dir, job_file, log_file, rc_file = karaf._job_paths(client, KEY)
+    karaf.ensure_dir(jobs_dir)
+    with open(job_file, 'w') as f:
+        json.dump(dict(key=KEY, cmd=KEY, pid=pid, log=log_file, started=0), f)
+    with open(log_file, 'w') as f:
+        f.write('Installing camel\n')
+    if rc is not None:
+        with open(rc_file, 'w') as f:
+            f.write(rc)
+    return rc_file
+
+
+def dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    return proc.pid
+
+
+def test_job_runs_in_the_background(client, tmpdir):
+    answer(tmpdir, KEY, 'Installed camel\n')
+
+    job = karaf.start_job(client, KEY, KEY)
+    assert job['cmd'] == KEY
+
+    job = karaf.wait_for_job(client, KEY, 10)
+    assert not job['running']
+    assert job['error'] is None
+    assert job['output'] == 'Installed camel\n'
+    assert tmpdir.join('bin', 'last_command').read() == KEY + '\n'
+
+    # The rc file was renamed into place
+    jobs_dir = karaf._job_paths(client, KEY)[0]
+    assert not [name for name in os.listdir(jobs_dir) if name.endswith('.tmp')]
+
+
+def test_no_job(client):
+    assert karaf.job_status(client, KEY) is None
+    assert karaf.resume_job(client, KEY, True, 10) is None
+
+
+def test_empty_rc_file_is_running(client):
+    # The job is writing its rc file: the temporary one is not renamed yet
+    write_job(client, os.getpid(), rc='')
+
+    job = karaf.job_status(client, KEY)
+
+    assert job['running']
+    assert job['error'] is None
+    assert job['output'] == 'Installing camel\n'
+
+
+def test_running_job_is_kept(client):
+    write_job(client, os.getpid())
+
+    job = karaf.resume_job(client, KEY, False, 10)
+
+    assert job['running']
+    assert karaf.job_status(client, KEY) is not None
+
+
+def test_dead_job(client):
+    write_job(client, dead_pid())
+
+    job = karaf.job_status(client, KEY)
+
+    assert not job['running']
+    assert isinstance(job['error'], karaf.KarafError)
+    assert job['error'].reason == 'Background job "%s" died' % KEY
+
+
+def test_dead_job_fails_the_module(client):
+    write_job(client, dead_pid(), rc='')
+
+    with pytest.raises(ModuleExit) as e:
+        karaf.resume_job(client, KEY, True, 10)
+
+    assert e.value.failed
+    assert e.value.result['error_type'] == karaf.ERROR_UNKNOWN
+    assert karaf.job_status(client, KEY) is None
+
+
+def test_failed_job_is_classified_and_cleared(client, tmpdir):
+    answer(tmpdir, KEY, "Error executing command: No feature named 'camel' with version '0.0.0' available\n", 1)
+    karaf.start_job(client, KEY, KEY)
+
+    with pytest.raises(ModuleExit) as e:
+        karaf.resume_job(client, KEY, True, 10)
+
+    assert e.value.result['error_type'] == karaf.ERROR_NOT_FOUND
+    assert 'No feature named' in e.value.result['stdout']
+    assert karaf.job_status(client, KEY) is None
+    assert os.listdir(karaf._job_paths(client, KEY)[0]) == []
+
+
+def test_finished_job_is_cleared(client):
+    write_job(client, dead_pid(), rc='0\n')
+
+    job = karaf.resume_job(client, KEY, True, 10)
+
+    assert not job['running']
+    assert job['error'] is None
+    assert karaf.job_status(client, KEY) is None
+
+
+def test_restarted_job_forgets_the_previous_result(client, tmpdir):
+    rc_file = write_job(client, dead_pid(), rc='1\n')
+    answer(tmpdir, KEY, 'Installed camel\n')
+
+    karaf.start_job(client, KEY, KEY)
+    job = karaf.wait_for_job(client, KEY, 10)
+
+    assert job['error'] is None
+    with open(rc_file) as f:
+        assert f.read() == '0\n'
+
+
+@pytest.mark.skipif(subprocess.call('command -v flock', shell=True, stdout=subprocess.PIPE) != 0,
+                    reason='needs flock(1)')
+def test_job_waits_for_the_lock(client, tmpdir):
+    answer(tmpdir, KEY, 'Installed camel\n')
+    client.lock.timeout = 0
+
+    with client.lock:
+        karaf.start_job(client, KEY, KEY)
+        job = karaf.wait_for_job(client, KEY, 10)
+
+    assert isinstance(job['error'], karaf.KarafTransientError)
+    assert job['output'].startswith('Timeout after 0s waiting for the lock')
+    assert not tmpdir.join('bin', 'last_command').check()
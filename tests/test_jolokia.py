@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import fcntl
+import json
+import os
+import threading
+
+import pytest
+
+import karaf
+from conftest import ModuleExit
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class JolokiaServer(ThreadingMixIn, HTTPServer):
+    """Jolokia stand-in, each keep-alive connection served by its own thread"""
+
+    daemon_threads = True
+
+
+class JolokiaHandler(BaseHTTPRequestHandler):
+    """Answers every POST with the status and responses of its server"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        server.requests.append(json.loads(body.decode('utf-8')))
+        server.locked.append(server.lock_path is not None and is_locked(server.lock_path))
+
+        data = json.dumps(server.responses).encode('utf-8')
+        self.send_response(server.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def is_locked(path):
+    """Whether another open file description holds the flock on path"""
+    if not os.path.exists(path):
+        return False
+    fd = os.open(path, os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return True
+        raise
+    finally:
+        os.close(fd)
+    return False
+
+
+@pytest.fixture
+def jolokia():
+    server = JolokiaServer(('127.0.0.1', 0), JolokiaHandler)
+    server.status = 200
+    server.responses = []
+    server.requests = []
+    server.locked = []
+    server.lock_path = None
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def client(client, jolokia):
+    client.retries = 2
+    client.jolokia = karaf.JolokiaConnection('http://127.0.0.1:%s/jolokia' % jolokia.server_address[1])
+    jolokia.lock_path = client.lock.path
+    return client
+
+
+def ok(value):
+    return dict(status=200, value=value)
+
+
+BUNDLES = {
+    '10': {'ID': 10, 'State': 'Active', 'Start Level': 80, 'Version': '2.8.5',
+           'Location': 'mvn:com.example/app/2.8.5', 'Update Location': 'mvn:com.example/app/2.8.5',
+           'Symbolic Name': 'com.example.app'},
+    '11': {'ID': 11, 'State': 'Resolved', 'Start Level': 30, 'Version': '1.0.0',
+           'Location': 'file:/opt/libs/lib.jar', 'Symbolic Name': 'com.example.lib'},
+}
+
+FEATURES = {
+    'camel-core': {
+        '2.20.1': {'Name': 'camel-core', 'Version': '2.20.1', 'Installed': True, 'Required': True},
+        '2.19.0': {'Name': 'camel-core', 'Version': '2.19.0', 'Installed': False, 'Required': False},
+    },
+    'webconsole': {
+        '4.2.0': {'Name': 'webconsole', 'Version': '4.2.0', 'Installed': True, 'Required': False},
+    },
+}
+
+
+def test_parse_bundle_mbean():
+    bundles = dict((b['id'], b) for b in karaf.parse_bundle_mbean(BUNDLES))
+
+    assert bundles == {
+        10: {'id': 10, 'state': 'Active', 'start_level': 80, 'version': '2.8.5',
+             'url': 'mvn:com.example/app/2.8.5', 'symbolic_name': 'com.example.app'},
+        11: {'id': 11, 'state': 'Resolved', 'start_level': 30, 'version': '1.0.0',
+             'url': 'file:/opt/libs/lib.jar', 'symbolic_name': 'com.example.lib'},
+    }
+
+
+def test_parse_feature_mbean():
+    features = sorted(karaf.parse_feature_mbean(FEATURES), key=lambda f: f['name'])
+
+    assert features == [
+        {'name': 'camel-core', 'version': '2.20.1', 'required': True, 'state': 'Started'},
+        {'name': 'webconsole', 'version': '4.2.0', 'required': False, 'state': 'Started'},
+    ]
+
+
+def test_request_bulk(jolokia, client):
+    jolokia.responses = [ok(BUNDLES), ok(FEATURES)]
+    requests = [
+        karaf.JolokiaConnection.read(karaf.JolokiaConnection.BUNDLE_MBEAN, 'Bundles'),
+        karaf.JolokiaConnection.read(karaf.JolokiaConnection.FEATURE_MBEAN, 'Features'),
+    ]
+
+    assert client.jolokia.request(requests) == [BUNDLES, FEATURES]
+    assert jolokia.requests == [requests]
+
+
+def test_list_bundles(jolokia, client):
+    jolokia.responses = [ok(BUNDLES)]
+
+    index = karaf.list_bundles(client)
+
+    assert index.find('mvn:com.example/app/2.8.5')['id'] == 10
+    assert jolokia.locked == [False]
+
+
+@pytest.mark.parametrize('status', [500, 502, 503, 504])
+def test_request_server_error_is_transient(jolokia, client, status):
+    jolokia.status = status
+
+    with pytest.raises(karaf.KarafTransientError):
+        client.jolokia.request([karaf.JolokiaConnection.read(karaf.JolokiaConnection.BUNDLE_MBEAN, 'Bundles')])
+
+
+def test_request_server_error_is_retried(jolokia, client):
+    jolokia.status = 503
+
+    with pytest.raises(ModuleExit) as e:
+        client.request_with_check([karaf.JolokiaConnection.read(karaf.JolokiaConnection.BUNDLE_MBEAN, 'Bundles')])
+
+    assert e.value.result['error_type'] == karaf.ERROR_TRANSIENT
+    assert e.value.result['retries'] == 2
+    assert len(jolokia.requests) == 3
+
+
+def test_request_connection_refused_is_transient(jolokia, client):
+    port = jolokia.server_address[1]
+    jolokia.shutdown()
+    jolokia.server_close()
+    client.jolokia = karaf.JolokiaConnection('http://127.0.0.1:%s/jolokia' % port)
+
+    with pytest.raises(karaf.KarafTransientError):
+        client.jolokia.request([karaf.JolokiaConnection.read(karaf.JolokiaConnection.BUNDLE_MBEAN, 'Bundles')])
+
+
+def test_request_not_found(jolokia, client):
+    jolokia.responses = [dict(status=404, error='javax.management.InstanceNotFoundException')]
+
+    with pytest.raises(ModuleExit) as e:
+        client.request_with_check([karaf.JolokiaConnection.read('org.apache.karaf:type=kar,name=root', 'Kars')])
+
+    assert e.value.result['error_type'] == karaf.ERROR_NOT_FOUND
+    assert e.value.result['retries'] == 0
+    assert len(jolokia.requests) == 1
+
+
+def test_request_http_error(jolokia, client):
+    jolokia.status = 401
+
+    with pytest.raises(karaf.KarafError) as e:
+        client.jolokia.request([karaf.JolokiaConnection.read(karaf.JolokiaConnection.BUNDLE_MBEAN, 'Bundles')])
+
+    assert e.value.kind == karaf.ERROR_UNKNOWN
+
+
+def test_exec_takes_the_lock(jolokia, client):
+    jolokia.responses = [ok(None), ok(None)]
+
+    karaf.start_bundles(client, [10, 11], 'start')
+
+    assert jolokia.locked == [True]
+    assert [r['operation'] for r in jolokia.requests[0]] == ['startBundle', 'startBundle']
+    assert not is_locked(client.lock.path)
+
+
+def test_read_operation_does_not_take_the_lock(jolokia, client):
+    jolokia.responses = [ok({'size': '500'})]
+
+    assert karaf.list_config_properties(client, 'org.apache.karaf.log') == {'size': '500'}
+    assert jolokia.locked == [False]
+
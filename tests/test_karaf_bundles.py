@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+import karaf_bundles
+
+BUNDLES = [
+    {'id': 12, 'start_level': 80},
+    {'id': 10, 'start_level': 80},
+    {'id': 11, 'start_level': 30},
+]
+
+
+def test_start_resolves_the_set_first(module, client):
+    cmd = karaf_bundles.start_bundle_set(client, BUNDLES, 'start')
+
+    assert cmd == 'bundle:resolve 11 10 12 && bundle:start 11 10 12'
+    assert [args for args, data in module.commands] == [[client.client_bin, cmd]]
+
+
+def test_stop_in_reverse_start_level_order(module, client):
+    cmd = karaf_bundles.start_bundle_set(client, BUNDLES, 'stop')
+
+    assert cmd == 'bundle:stop 12 10 11'
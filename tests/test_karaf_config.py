@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import karaf
+import karaf_config
+from conftest import ModuleExit
+
+
+def test_set_properties_in_one_session(module, client):
+    module.answers = [(0, 'size = 500\nservice.pid = org.apache.karaf.log\n', '')]
+    properties = dict(('key%03d' % i, 'value %d' % i) for i in range(300))
+    properties['size'] = 500
+
+    result = karaf_config.config_property_set(client, module, 'org.apache.karaf.log', properties)
+
+    assert result['changed']
+    assert len(module.commands) == 2
+    args, data = module.commands[1]
+    assert args[1:] == ['-b']
+    cmds = data.split(' && ')
+    assert cmds[0] == 'config:edit org.apache.karaf.log'
+    assert cmds[-1] == 'config:update'
+    assert len(cmds) == 302
+    assert "config:property-set key000 'value 0'" in cmds
+    assert result['chunks'] == [dict(chunk=0, items=['org.apache.karaf.log'], status='ok')]
+
+
+def test_set_properties_unchanged(module, client):
+    module.answers = [(0, 'size = 500\n', '')]
+
+    result = karaf_config.config_property_set(client, module, 'org.apache.karaf.log', {'size': 500.0})
+
+    assert not result['changed']
+    assert len(module.commands) == 1
+
+
+class ListingJolokia(object):
+    """Jolokia connection answering listProperties, and nothing else"""
+
+    def __init__(self, properties):
+        self.properties = properties
+        self.requests = []
+
+    def request(self, requests):
+        self.requests.append(requests)
+        return [self.properties]
+
+
+def test_set_properties_with_jolokia(module, client):
+    client.jolokia = ListingJolokia({'size': '500', 'service.ranking': '10'})
+
+    result = karaf_config.config_property_set(client, module, 'org.apache.karaf.log', {'size': 1000, 'pattern': '%m'})
+
+    # Read through Jolokia, updated once in a console session that keeps the type of service.ranking
+    assert result['changed']
+    assert [r[0]['operation'] for r in client.jolokia.requests] == ['listProperties']
+    assert len(module.commands) == 1
+    cmds = module.commands[0][1].split(' && ')
+    assert cmds[0] == 'config:edit org.apache.karaf.log'
+    assert sorted(cmds[1:-1]) == ['config:property-set pattern %m', 'config:property-set size 1000']
+    assert cmds[-1] == 'config:update'
+
+
+def test_delete_properties_in_one_session(module, client):
+    module.answers = [(0, 'a = 1\nb = 2\nc = 3\n', '')]
+
+    karaf_config.config_property_delete(client, module, 'com.example.app', {'a': None, 'c': None, 'd': None})
+
+    cmds = module.commands[1][1].split(' && ')
+    assert cmds[0] == 'config:edit com.example.app'
+    assert sorted(cmds[1:-1]) == ['config:property-delete a', 'config:property-delete c']
+    assert cmds[-1] == 'config:update'
+
+
+def test_failed_session(module, client):
+    module.answers = [(0, '', ''), (1, 'Error executing command: Unknown option: --foo', '')]
+
+    with pytest.raises(ModuleExit) as e:
+        karaf_config.config_property_set(client, module, 'com.example.app', {'a': 1})
+
+    assert e.value.failed
+    assert e.value.result['error_type'] == karaf.ERROR_SYNTAX
+    assert e.value.result['remaining'] == ['com.example.app']
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import karaf_config_audit
+
+IGNORED = set(karaf_config_audit.IGNORED_PROPERTIES)
+
+
+def config_list(*pids):
+    """Lines of config:list for (pid, [(name, value), ...]) pairs"""
+    lines = []
+    for pid, properties in pids:
+        lines.append('-' * 64)
+        lines.append('Pid:            %s' % pid)
+        lines.append('BundleLocation: null')
+        lines.append('Properties:')
+        lines.append('   service.pid = %s' % pid)
+        lines.extend('   %s = %s' % (name, value) for name, value in properties)
+    return lines
+
+
+def audit(lines, desired, strict=False):
+    digests, found = karaf_config_audit.audit_config(lines, desired, IGNORED, strict)
+    return digests, karaf_config_audit.config_drift(desired, found, strict)
+
+
+def test_digest_ignores_property_order():
+    first, drift = audit(config_list(('com.example.app', [('a', '1'), ('b', 'x'), ('c', '[alpha, beta]')])), {})
+    second, drift = audit(config_list(('com.example.app', [('c', '[alpha, beta]'), ('a', '1'), ('b', 'x')])), {})
+
+    assert first == second
+    assert len(first['com.example.app']) == 40
+
+
+def test_digest_changes_with_a_value():
+    first, drift = audit(config_list(('com.example.app', [('a', '1'), ('b', 'x')])), {})
+    second, drift = audit(config_list(('com.example.app', [('a', '1'), ('b', 'y')])), {})
+    swapped, drift = audit(config_list(('com.example.app', [('a', 'x'), ('b', '1')])), {})
+
+    assert first['com.example.app'] != second['com.example.app']
+    assert first['com.example.app'] != swapped['com.example.app']
+
+
+def test_digest_leaves_ignored_properties_out():
+    digests, drift = audit(config_list(('com.example.app', [('a', '1')]),
+                                       ('org.example.other', [('a', '1')])), {})
+
+    # service.pid differs, and is ignored
+    assert digests['com.example.app'] == digests['org.example.other']
+
+
+def test_no_drift():
+    lines = config_list(('org.apache.karaf.log', [('size', '500'), ('pattern', '%m%n')]),
+                        ('com.example.app', [('hosts', '[alpha, beta]')]))
+
+    digests, drift = audit(lines, {
+        'org.apache.karaf.log': {'size': 500, 'pattern': '%m%n'},
+        'com.example.app': {'hosts': ['alpha', 'beta']},
+    })
+
+    assert drift == {}
+    assert sorted(digests) == ['com.example.app', 'org.apache.karaf.log']
+
+
+def test_numeric_comparison():
+    lines = config_list(('org.apache.karaf.log', [('size', '500.0'), ('count', '7'), ('code', '007')]))
+
+    digests, drift = audit(lines, {'org.apache.karaf.log': {'size': 500, 'count': 7.0, 'code': '7'}})
+
+    # Desired numbers match by value, a desired string is compared as it is
+    assert drift == {'org.apache.karaf.log': dict(missing=False, changed=['code'], missing_keys=[], extra_keys=[])}
+
+
+def test_changed_and_missing_keys():
+    lines = config_list(('com.example.app', [('port', '8080'), ('secure', 'false')]))
+
+    digests, drift = audit(lines, {'com.example.app': {'port': 8081, 'secure': False, 'host': 'example.com'}})
+
+    assert drift == {'com.example.app': dict(missing=False, changed=['port'], missing_keys=['host'], extra_keys=[])}
+
+
+def test_null_must_not_be_set():
+    lines = config_list(('com.example.app', [('port', '8080'), ('debug', 'true')]))
+
+    digests, drift = audit(lines, {'com.example.app': {'port': 8080, 'debug': None, 'trace': None}})
+
+    assert drift == {'com.example.app': dict(missing=False, changed=[], missing_keys=[], extra_keys=['debug'])}
+
+
+def test_strict_reports_extra_keys():
+    lines = config_list(('com.example.app', [('port', '8080'), ('debug', 'true'), ('trace', 'false')]))
+    desired = {'com.example.app': {'port': 8080}}
+
+    digests, drift = audit(lines, desired)
+    assert drift == {}
+
+    # service.pid is ignored, not an extra key
+    digests, drift = audit(lines, desired, strict=True)
+    assert drift == {'com.example.app': dict(missing=False, changed=[], missing_keys=[], extra_keys=['debug', 'trace'])}
+
+
+def test_missing_pid():
+    lines = config_list(('com.example.app', [('port', '8080')]))
+
+    digests, drift = audit(lines, {'com.example.app': {'port': 8080}, 'com.example.missing': {'a': 1},
+                                   'com.example.empty': None})
+
+    assert drift == {'com.example.missing': dict(missing=True), 'com.example.empty': dict(missing=True)}
+
+
+def test_desired_pid_without_properties():
+    digests, drift = audit(config_list(('com.example.empty', [])), {'com.example.empty': None})
+
+    assert drift == {}
+    assert 'com.example.empty' in digests
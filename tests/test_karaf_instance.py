@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+import karaf
+import karaf_instance
+from conftest import FakeModule, ModuleExit
+
+# Stands for the karaf JVM: logs its startup, optionally rotating the log on
+# the way, then listens on the ssh port until it gets SIGTERM
+FAKE_KARAF = '''
+import json, os, signal, socket, sys, time
+
+home = sys.argv[1]
+with open(os.path.join(home, 'etc', 'fake.json')) as f:
+    conf = json.load(f)
+
+log_path = os.path.join(home, 'data', 'log', 'karaf.log')
+pid_path = os.path.join(home, 'data', 'karaf.pid')
+with open(pid_path, 'w') as f:
+    f.write(str(os.getpid()))
+
+def log(line):
+    with open(log_path, 'a') as f:
+        f.write(line + '\\n')
+
+def stop(*args):
+    if os.path.exists(pid_path):
+        os.remove(pid_path)
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, stop)
+
+log('Starting karaf')
+if conf.get('rotate'):
+    os.rename(log_path, log_path + '.1')
+    log('Log rotated')
+time.sleep(conf.get('delay', 0.5))
+
+if conf.get('never_ready'):
+    while True:
+        time.sleep(1)
+
+sock = socket.socket()
+sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+sock.bind(('127.0.0.1', conf['port']))
+sock.listen(5)
+log('Done.')
+while True:
+    conn, addr = sock.accept()
+    conn.close()
+'''
+
+START = '''#!/bin/sh
+"{python}" "{home}/bin/fake_karaf.py" "{home}" > /dev/null 2>&1 &
+'''
+
+STOP = '''#!/bin/sh
+[ -f "{home}/data/karaf.pid" ] && kill $(cat "{home}/data/karaf.pid")
+exit 0
+'''
+
+STATUS = '''#!/bin/sh
+[ -f "{home}/data/karaf.pid" ] && kill -0 $(cat "{home}/data/karaf.pid") 2>/dev/null
+'''
+
+# Root container console, managing the child instances under instances/
+CLIENT = '''#!{python}
+import os, subprocess, sys
+
+home = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+words = sys.argv[1].split()
+child = os.path.join(home, 'instances', 'child1')
+
+if words[0] == 'instance:list':
+    alive = subprocess.call([os.path.join(child, 'bin', 'status')]) == 0
+    pid = open(os.path.join(child, 'data', 'karaf.pid')).read() if alive else '0'
+    print(u'SSH Port \\u2502 RMI Registry \\u2502 RMI Server \\u2502 State   \\u2502 PID   \\u2502 Name')
+    print(u'\\u2500' * 60)
+    print(u'    8101 \\u2502         1099 \\u2502      44444 \\u2502 Started \\u2502   123 \\u2502 root')
+    print(u'    %d \\u2502         1100 \\u2502      44445 \\u2502 %-7s \\u2502 %5s \\u2502 child1'
+          % ({port}, 'Started' if alive else 'Stopped', pid))
+elif words[0] in ('instance:start', 'instance:stop'):
+    subprocess.check_call([os.path.join(child, 'bin', words[0][len('instance:'):])])
+else:
+    print('Command not found: %s' % words[0])
+    sys.exit(1)
+'''
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def write_script(path, content, **values):
+    with open(path, 'w') as f:
+        f.write(content.format(**values))
+    os.chmod(path, 0o755)
+
+
+def fake_karaf(home, port, **conf):
+    """Create a karaf installation whose bin scripts run FAKE_KARAF"""
+    for d in ('bin', 'etc', os.path.join('data', 'log')):
+        os.makedirs(os.path.join(home, d))
+
+    conf['port'] = port
+    with open(os.path.join(home, 'etc', 'fake.json'), 'w') as f:
+        json.dump(conf, f)
+    with open(os.path.join(home, 'bin', 'fake_karaf.py'), 'w') as f:
+        f.write(FAKE_KARAF)
+
+    values = dict(python=sys.executable, home=home, port=port)
+    write_script(os.path.join(home, 'bin', 'start'), START, **values)
+    write_script(os.path.join(home, 'bin', 'stop'), STOP, **values)
+    write_script(os.path.join(home, 'bin', 'status'), STATUS, **values)
+    write_script(os.path.join(home, 'bin', 'client'), CLIENT, **values)
+    return home
+
+
+class RunModule(FakeModule):
+    """Module running its commands for real"""
+
+    def run_command(self, args, data=None, **kwargs):
+        self.commands.append((args, data))
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate(karaf._to_bytes(data) if data else None)
+        if kwargs.get('encoding', 'utf-8') is not None:
+            out = karaf._to_text(out)
+        return proc.returncode, out, karaf._to_text(err)
+
+
+@pytest.fixture
+def port():
+    return free_port()
+
+
+@pytest.fixture
+def home(tmpdir, port):
+    home = fake_karaf(str(tmpdir.join('karaf')), port)
+    yield home
+    subprocess.call([os.path.join(home, 'bin', 'stop')])
+
+
+@pytest.fixture
+def module():
+    return RunModule()
+
+
+def run_main(monkeypatch, **params):
+    module = RunModule(state='started', name=None, ready_pattern=None, wait_timeout=10,
+                       host='127.0.0.1', port=8101, client_bin='/opt/karaf', retries=0, retry_delay=0)
+    module.params.update(params)
+    monkeypatch.setattr(karaf_instance, 'AnsibleModule', lambda **kwargs: module)
+
+    with pytest.raises(ModuleExit) as e:
+        karaf_instance.main()
+    return e.value
+
+
+def test_start(module, home, port):
+    startup_time = karaf_instance.start_root(module, home, '127.0.0.1', port, r'Done\.', 10)
+
+    assert startup_time > 0
+    assert karaf_instance.is_running(module, home)
+    assert karaf_instance.is_port_open('127.0.0.1', port)
+
+
+def test_stop(module, home, port):
+    karaf_instance.start_root(module, home, '127.0.0.1', port, None, 10)
+    pid = karaf_instance.read_pid(home)
+
+    karaf_instance.stop_root(module, home, '127.0.0.1', port, 10)
+
+    assert not karaf_instance.is_process_alive(pid)
+    assert not karaf_instance.is_port_open('127.0.0.1', port)
+    # bin/status, which starts a JVM, is never polled
+    assert [os.path.basename(args[0]) for args, data in module.commands] == ['start', 'stop']
+
+
+def test_read_pid(tmpdir):
+    assert karaf_instance.read_pid(str(tmpdir)) is None
+
+    tmpdir.join('karaf.pid').write('4242\n')
+    assert karaf_instance.read_pid(str(tmpdir)) == 4242
+
+
+def test_main_started_is_idempotent(monkeypatch, home, port):
+    result = run_main(monkeypatch, client_bin=home, port=port).result
+    assert result['changed']
+    assert 'startup_time' in result
+
+    result = run_main(monkeypatch, client_bin=home, port=port).result
+    assert not result['changed']
+
+
+def test_main_restart(monkeypatch, home, port):
+    run_main(monkeypatch, client_bin=home, port=port)
+    with open(os.path.join(home, 'data', 'karaf.pid')) as f:
+        pid = f.read()
+
+    result = run_main(monkeypatch, client_bin=home, port=port, state='restarted', ready_pattern=r'Done\.').result
+
+    assert result['changed']
+    assert 'stop_time' in result and 'startup_time' in result
+    with open(os.path.join(home, 'data', 'karaf.pid')) as f:
+        assert f.read() != pid
+    assert karaf_instance.is_port_open('127.0.0.1', port)
+
+
+def test_main_stopped(monkeypatch, home, port):
+    run_main(monkeypatch, client_bin=home, port=port)
+
+    result = run_main(monkeypatch, client_bin=home, port=port, state='stopped').result
+
+    assert result['changed']
+    assert not karaf_instance.is_port_open('127.0.0.1', port)
+
+
+def test_start_timeout(module, tmpdir, port):
+    home = fake_karaf(str(tmpdir.join('karaf')), port, never_ready=True)
+    try:
+        with pytest.raises(ModuleExit) as e:
+            karaf_instance.start_root(module, home, '127.0.0.1', port, None, 1)
+    finally:
+        subprocess.call([os.path.join(home, 'bin', 'stop')])
+
+    assert e.value.failed
+    assert e.value.result['msg'] == 'Karaf not ready after 1s'
+    assert 'Starting karaf' in e.value.result['log']
+
+
+def test_start_log_rotation(module, tmpdir, port):
+    home = fake_karaf(str(tmpdir.join('karaf')), port, rotate=True)
+    # A previous run left a log larger than what the new one gets before being ready
+    with open(os.path.join(home, 'data', 'log', 'karaf.log'), 'w') as f:
+        f.write('previous run\n' * 1000)
+
+    try:
+        karaf_instance.start_root(module, home, '127.0.0.1', port, r'Log rotated[\s\S]*Done\.', 10)
+    finally:
+        subprocess.call([os.path.join(home, 'bin', 'stop')])
+
+
+def test_log_tail_follows_rotation(tmpdir):
+    path = tmpdir.join('karaf.log')
+    path.write('old\n')
+    log = karaf_instance.LogTail(str(path))
+    path.write('old\nstarting\n')
+    assert log.read() == 'starting\n'
+
+    path.rename(tmpdir.join('karaf.log.1'))
+    path.write('rotated and longer than before\n')
+
+    assert log.read() == 'rotated and longer than before\n'
+    assert log.read() == ''
+
+
+def test_log_tail_missing_file(tmpdir):
+    path = tmpdir.join('karaf.log')
+    log = karaf_instance.LogTail(str(path))
+    assert log.read() == ''
+
+    path.write('created\n')
+    assert log.read() == 'created\n'
+
+
+def test_parse_instance_list():
+    out = (u'SSH Port │ SSH Host │ RMI Registry │ RMI Server │ State   │ PID  │ Name\n'
+           u'─────────┼──────────┼──────────────┼────────────┼─────────┼──────┼───────\n'
+           u'    8101 │ 0.0.0.0  │         1099 │      44444 │ Started │ 4242 │ root\n'
+           u'    8102 │ 0.0.0.0  │         1100 │      44445 │ Stopped │    0 │ child1\n').encode('utf-8')
+
+    assert karaf_instance.parse_instance_list(out) == {
+        'root': {'ssh_port': 8101, 'state': 'Started', 'pid': 4242},
+        'child1': {'ssh_port': 8102, 'state': 'Stopped', 'pid': None},
+    }
+
+
+def test_child_start_and_stop(module, tmpdir, port):
+    home = str(tmpdir.join('karaf'))
+    os.makedirs(os.path.join(home, 'bin'))
+    write_script(os.path.join(home, 'bin', 'client'), CLIENT, python=sys.executable, port=port)
+    fake_karaf(os.path.join(home, 'instances', 'child1'), port)
+    client = karaf.KarafClient(module, os.path.join(home, 'bin', 'client'), retries=0)
+
+    try:
+        instance = karaf_instance.child_instance(client, module, 'child1')
+        assert instance == {'ssh_port': port, 'state': 'Stopped', 'pid': None}
+
+        karaf_instance.start_child(client, module, 'child1', '127.0.0.1', port, r'Done\.', 10)
+        instance = karaf_instance.child_instance(client, module, 'child1')
+        assert instance['state'] == 'Started'
+
+        karaf_instance.stop_child(client, module, 'child1', '127.0.0.1', port, instance['pid'], 10)
+        assert not karaf_instance.is_process_alive(instance['pid'])
+        assert not karaf_instance.is_port_open('127.0.0.1', port)
+    finally:
+        subprocess.call([os.path.join(home, 'instances', 'child1', 'bin', 'stop')])
+
+    # The state is never polled through the client
+    assert [args[1].split()[0] for args, data in module.commands] == [
+        'instance:list', 'instance:start', 'instance:list', 'instance:stop']
+
+
+def test_child_not_found(module, tmpdir, port):
+    home = str(tmpdir.join('karaf'))
+    os.makedirs(os.path.join(home, 'bin'))
+    write_script(os.path.join(home, 'bin', 'client'), CLIENT, python=sys.executable, port=port)
+    fake_karaf(os.path.join(home, 'instances', 'child1'), port)
+    client = karaf.KarafClient(module, os.path.join(home, 'bin', 'client'), retries=0)
+
+    with pytest.raises(ModuleExit) as e:
+        karaf_instance.child_instance(client, module, 'child2')
+
+    assert e.value.result['msg'] == 'Instance child2 not found'
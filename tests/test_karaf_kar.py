@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import karaf_kar
+from conftest import ModuleExit
+
+
+def test_checksum_round_trip(client):
+    karaf_kar.write_checksum(client, 'my-app-1.0', 'abc')
+    assert karaf_kar.read_checksum(client, 'my-app-1.0') == 'abc'
+
+    karaf_kar.write_checksum(client, 'my-app-1.0', None)
+    assert karaf_kar.read_checksum(client, 'my-app-1.0') is None
+
+
+def test_checksum_can_not_be_stored(client, tmpdir):
+    tmpdir.join('data').write('')
+
+    with pytest.raises(ModuleExit) as e:
+        karaf_kar.write_checksum(client, 'my-app-1.0', 'abc')
+
+    assert e.value.result['msg'].startswith('Can not store the checksum')
+
+
+def test_existing_kars_karaf4(module, client):
+    module.answers = [(0, u'KAR Name\n──────────────\nmy-app-1.0\nlégacy-2.0\n\n', '')]
+
+    assert karaf_kar.get_existing_kars(client) == set([u'my-app-1.0', u'légacy-2.0'])
+    assert module.commands[0][0][1] == 'kar:list'
+
+
+def test_existing_kars_karaf3(module, client):
+    module.answers = [(0, 'KAR Name\n--------\nmy-app-1.0\n', '')]
+
+    assert karaf_kar.get_existing_kars(client) == set(['my-app-1.0'])
+
+
+def test_no_existing_kars(module, client):
+    module.answers = [(0, u'KAR Name\n────────\n', '')]
+
+    assert karaf_kar.get_existing_kars(client) == set()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import karaf
+import karaf_log
+from conftest import FakeModule, ModuleExit
+
+LOG_GET = (u'Logger           │ Level\n'
+           u'─────────────────┼──────\n'
+           u'ROOT             │ INFO\n'
+           u'org.apache.camel │ warn\n')
+
+
+def test_parse_log_levels():
+    assert karaf.parse_log_levels(LOG_GET.encode('utf-8')) == {'ROOT': 'INFO', 'org.apache.camel': 'WARN'}
+
+
+def test_desired_levels():
+    levels = karaf_log.desired_levels(FakeModule(), {'ROOT': 'warn', 'com.example': None, 'org.apache': 'Default'})
+
+    assert levels == {'ROOT': 'WARN', 'com.example': 'DEFAULT', 'org.apache': 'DEFAULT'}
+
+
+def test_desired_levels_unquoted_off():
+    # levels: { com.example: OFF } reaches the module as False
+    assert karaf_log.desired_levels(FakeModule(), {'com.example': False}) == {'com.example': 'OFF'}
+
+
+def test_desired_levels_invalid():
+    with pytest.raises(ModuleExit) as e:
+        karaf_log.desired_levels(FakeModule(), {'com.example': 'LOUD'})
+
+    assert e.value.result['msg'].startswith('Invalid level LOUD for logger com.example')
+
+
+def test_root_can_not_be_reset():
+    with pytest.raises(ModuleExit):
+        karaf_log.desired_levels(FakeModule(), {'ROOT': None})
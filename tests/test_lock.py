@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+
+import pytest
+
+import karaf
+from conftest import FakeModule, ModuleExit
+
+
+def test_ensure_dir_exists(tmpdir):
+    path = str(tmpdir.join('data', 'ansible'))
+    karaf.ensure_dir(path)
+    karaf.ensure_dir(path)
+
+    assert os.path.isdir(path)
+
+
+def test_ensure_dir_concurrent(tmpdir):
+    # Every thread but one finds the directory created by another
+    path = str(tmpdir.join('data', 'ansible', 'jobs'))
+    errors = []
+
+    def create():
+        try:
+            karaf.ensure_dir(path)
+        except OSError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=create) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert os.path.isdir(path)
+
+
+def test_ensure_dir_file_in_the_way(tmpdir):
+    tmpdir.join('data').write('')
+
+    with pytest.raises(OSError):
+        karaf.ensure_dir(str(tmpdir.join('data', 'ansible')))
+
+
+def test_lock_is_reentrant(tmpdir):
+    lock = karaf.KarafLock(str(tmpdir))
+    with lock:
+        with lock:
+            pass
+        assert lock._fd is not None
+    assert lock._fd is None
+
+
+def test_lock_timeout(tmpdir):
+    holder = karaf.KarafLock(str(tmpdir))
+    waiter = karaf.KarafLock(str(tmpdir), timeout=0)
+
+    with holder:
+        with pytest.raises(karaf.KarafLockError) as e:
+            waiter.acquire()
+
+    assert e.value.kind == karaf.ERROR_LOCK
+    waiter.acquire()
+    waiter.release()
+
+
+def test_lock_can_not_be_created(tmpdir):
+    tmpdir.join('data').write('')
+    lock = karaf.KarafLock(str(tmpdir))
+
+    with pytest.raises(karaf.KarafLockError) as e:
+        lock.acquire()
+
+    assert e.value.reason.startswith('Can not create the lock')
+
+
+def test_karaf_lock_fails_the_module(tmpdir):
+    tmpdir.join('data').write('')
+
+    with pytest.raises(ModuleExit) as e:
+        with karaf.karaf_lock(FakeModule(), str(tmpdir)):
+            pass
+
+    assert e.value.result['error_type'] == karaf.ERROR_LOCK
+
+
+def test_start_job_jobs_dir_can_not_be_created(tmpdir):
+    tmpdir.join('bin').mkdir()
+    tmpdir.join('bin', 'client').write('')
+    tmpdir.join('data').write('')
+    client = karaf.KarafClient(FakeModule(), str(tmpdir.join('bin', 'client')))
+
+    with pytest.raises(ModuleExit) as e:
+        karaf.start_job(client, 'feature:install camel', 'feature:install camel')
+
+    assert e.value.result['msg'].startswith('Can not create')
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import karaf
+
+BUNDLE_LIST = u'''\
+ ID │ State    │ Lvl │ Version │ Location
+────┼──────────┼─────┼─────────┼───────────────────────────────
+ 10 │ Active   │  80 │ 2.8.5   │ mvn:com.example/app/2.8.5
+ 11 │ Resolved │  80 │ 1.0.0   │ wrap:file:/opt/libs/légacy.jar
+ ID │ State    │ Lvl │ Version │ Symbolic name
+────┼──────────┼─────┼─────────┼───────────────────────────────
+ 10 │ Active   │  80 │ 2.8.5   │ com.example.app
+ 11 │ Resolved │  80 │ 1.0.0   │ wrap_file_opt_libs_légacy.jar
+'''
+
+CONFIG_LIST = '''\
+----------------------------------------------------------------
+Pid:            org.apache.karaf.log
+BundleLocation: mvn:org.apache.karaf.log/org.apache.karaf.log.core/4.2.0
+Properties:
+   size = 500
+   service.pid = org.apache.karaf.log
+   pattern = %d | %-5.5p | %m%n
+----------------------------------------------------------------
+Pid:            org.apache.karaf.empty
+BundleLocation: null
+Properties:
+----------------------------------------------------------------
+Pid:            com.example.app
+Properties:
+   hosts = [alpha, beta]
+'''
+
+
+def by_id(bundles):
+    return dict((b['id'], b) for b in bundles)
+
+
+def test_parse_bundle_list():
+    bundles = by_id(karaf.parse_bundle_list(BUNDLE_LIST.encode('utf-8')))
+
+    assert bundles == {
+        10: {'id': 10, 'state': 'Active', 'start_level': 80, 'version': '2.8.5',
+             'url': 'mvn:com.example/app/2.8.5', 'symbolic_name': 'com.example.app'},
+        11: {'id': 11, 'state': 'Resolved', 'start_level': 80, 'version': '1.0.0',
+             'url': u'wrap:file:/opt/libs/légacy.jar', 'symbolic_name': u'wrap_file_opt_libs_légacy.jar'},
+    }
+
+
+def test_parse_bundle_list_decoded_output():
+    assert by_id(karaf.parse_bundle_list(BUNDLE_LIST)) == by_id(karaf.parse_bundle_list(BUNDLE_LIST.encode('utf-8')))
+
+
+def test_parse_bundle_list_without_headers():
+    # The second table starts at the first repeated id
+    out = u'\n'.join(line for line in BUNDLE_LIST.split(u'\n') if u'ID' not in line and u'─' not in line)
+
+    bundles = by_id(karaf.parse_bundle_list(out))
+
+    assert sorted(bundles) == [10, 11]
+    assert bundles[10]['symbolic_name'] == 'com.example.app'
+
+
+def test_parse_bundle_list_empty():
+    assert karaf.parse_bundle_list(b'') == []
+
+
+def test_iter_config_list():
+    assert list(karaf.iter_config_list(CONFIG_LIST.split('\n'))) == [
+        ('org.apache.karaf.log', None, None),
+        ('org.apache.karaf.log', 'size', '500'),
+        ('org.apache.karaf.log', 'service.pid', 'org.apache.karaf.log'),
+        ('org.apache.karaf.log', 'pattern', '%d | %-5.5p | %m%n'),
+        ('org.apache.karaf.empty', None, None),
+        ('com.example.app', None, None),
+        ('com.example.app', 'hosts', '[alpha, beta]'),
+    ]
+
+
+def test_property_equals_typed_values():
+    assert karaf.property_equals('8080', 8080)
+    assert karaf.property_equals('8080', 'I"8080"')
+    assert karaf.property_equals('1.0', 1)
+    assert karaf.property_equals('true', True)
+    assert karaf.property_equals('TRUE', 'B"true"')
+    assert karaf.property_equals('false', False)
+    assert karaf.property_equals('[alpha, beta]', ['alpha', 'beta'])
+    assert karaf.property_equals('[alpha, beta]', '[ "alpha", "beta" ]')
+
+
+def test_property_equals_differences():
+    assert not karaf.property_equals('8080', 8081)
+    assert not karaf.property_equals('007', '7')
+    assert not karaf.property_equals('abc', 1)
+    assert not karaf.property_equals('false', True)
+    # Only true and false are booleans, other strings are compared as they are
+    assert not karaf.property_equals('false', 'NO')
+    assert not karaf.property_equals('no', 'false')
+    assert not karaf.property_equals('no', 'n')
+    assert not karaf.property_equals('NO', 'no')
+    assert not karaf.property_equals('yes', True)
+    assert not karaf.property_equals('yes', 'B"true"')
+    assert not karaf.property_equals('[alpha, beta]', ['beta', 'alpha'])
+
+
+def test_read_properties(tmpdir):
+    path = tmpdir.join('org.apache.karaf.features.cfg')
+    path.write('# Boot features\n'
+               '# path C:\\\n'
+               'featuresBoot = a, b\n'
+               'featuresRepositories = \\\n'
+               '    mvn:org.apache.karaf.features/standard/4.2.0/xml/features, \\\n'
+               '    mvn:org.apache.karaf.features/enterprise/4.2.0/xml/features\n'
+               '\n'
+               'key\\:with\\ escapes : value\n')
+
+    entries = karaf.read_properties(str(path))
+
+    assert [(key, value) for key, value, physical in entries] == [
+        (None, None),
+        (None, None),
+        ('featuresBoot', 'a, b'),
+        ('featuresRepositories', 'mvn:org.apache.karaf.features/standard/4.2.0/xml/features, '
+                                 'mvn:org.apache.karaf.features/enterprise/4.2.0/xml/features'),
+        (None, None),
+        ('key:with escapes', 'value'),
+    ]
+    assert len(entries[1][2]) == 1
+    assert len(entries[3][2]) == 3
+
+
+def test_read_properties_missing_file(tmpdir):
+    assert karaf.read_properties(str(tmpdir.join('missing.cfg'))) == []
+
+
+def test_write_properties_keeps_layout(tmpdir, module):
+    path = tmpdir.join('startup.properties')
+    path.write('# Bundles started at boot\n'
+               'mvn\\:org.example/a/1.0 = 10\n'
+               'mvn\\:org.example/b/1.0 = 20\n'
+               'list = \\\n'
+               '    a, \\\n'
+               '    b\n')
+
+    entries = karaf.read_properties(str(path))
+    karaf.write_properties(module, str(path), entries, {
+        'mvn:org.example/a/1.0': None,
+        'list': ['a', 'b', 'c'],
+        'mvn:org.example/c/1.0': '30',
+    })
+
+    assert path.read() == ('# Bundles started at boot\n'
+                           'mvn\\:org.example/b/1.0 = 20\n'
+                           'list = \\\n'
+                           '    a, \\\n'
+                           '    b, \\\n'
+                           '    c\n'
+                           'mvn\\:org.example/c/1.0 = 30\n')
+    assert not os.path.exists(str(path) + '.ansible.tmp')
+
+
+def test_write_properties_round_trip(tmpdir, module):
+    path = tmpdir.join('custom.properties')
+    karaf.write_properties(module, str(path), [], {'key with spaces': 'v1', 'items': ['x', 'y']})
+
+    values = dict((key, value) for key, value, physical in karaf.read_properties(str(path)) if key)
+    assert values == {'key with spaces': 'v1', 'items': 'x, y'}
+
+
+def test_chunk_commands_by_count():
+    items = ['a', 'b', 'c', 'd', 'e']
+    chunks = list(karaf.chunk_commands(items, ['cmd %s' % i for i in items], max_items=2))
+
+    assert [[item for item, cmd in chunk] for chunk in chunks] == [['a', 'b'], ['c', 'd'], ['e']]
+    assert chunks[0] == [('a', 'cmd a'), ('b', 'cmd b')]
+
+
+def test_chunk_commands_by_size():
+    # Every command takes its size plus the ' && ' separator
+    items = ['a', 'b', 'c']
+    commands = ['x' * 6, 'y' * 6, 'z' * 6]
+
+    chunks = list(karaf.chunk_commands(items, commands, max_bytes=20))
+    assert [[item for item, cmd in chunk] for chunk in chunks] == [['a', 'b'], ['c']]
+
+    chunks = list(karaf.chunk_commands(items, commands, max_bytes=19))
+    assert [[item for item, cmd in chunk] for chunk in chunks] == [['a'], ['b'], ['c']]
+
+
+def test_chunk_commands_oversized_command():
+    # A command larger than max_bytes still gets a chunk of its own
+    chunks = list(karaf.chunk_commands(['a', 'b'], ['x' * 100, 'y'], max_bytes=10))
+    assert [[item for item, cmd in chunk] for chunk in chunks] == [['a'], ['b']]
+
+
+def test_chunk_commands_empty():
+    assert list(karaf.chunk_commands([], [])) == []
+
+
+def test_offline_list_update_after_continued_comment(tmpdir, module):
+    path = tmpdir.mkdir('etc').join('org.apache.karaf.features.cfg')
+    path.write('# path C:\\\nfeaturesBoot = a, b\n')
+
+    assert karaf.offline_list_update(module, str(tmpdir), 'etc/org.apache.karaf.features.cfg',
+                                     'featuresBoot', 'c', 'present')
+
+    entries = karaf.read_properties(str(path))
+    assert entries[0][2] == ['# path C:\\\n']
+    assert [(key, value) for key, value, physical in entries if key] == [('featuresBoot', 'a, b, c')]